@@ -22,7 +22,6 @@ step = 1e-4
 leapfrog = 100
 n_samples = 1000
 n_ics = 50
-ic_step = 3e-5
 T = 80
 
 results = {}
@@ -32,19 +31,20 @@ if method in ['kernel', 'constrained_kernel']:
 else:
 	systems = lti2x2.systems
 
-for i, (name, A) in enumerate(systems.items()):
-
-	nominal = torch.from_numpy(diff_to_transferop(A)).float()
-	
-	if method == 'baseline':
-		samples, posterior = perturb(n_samples, nominal, beta, method='euclidean', n_ics=n_ics, ic_step=ic_step, hmc_step=step)
-	elif method == 'kernel':
-		samples, posterior = perturb(n_samples, nominal, beta, method='kernel', n_ics=n_ics, ic_step=ic_step, hmc_step=step, kernel_T=T)
-	elif method == 'constrained_kernel':
-		samples, posterior = perturb(n_samples, nominal, beta, method='kernel', n_ics=n_ics, ic_step=ic_step, hmc_step=step, kernel_T=T, use_spectral_constraint=True)
-	elif method == 'discounted_kernel':
-		L = max(0, 2*np.log(spectral_radius(nominal).item()))
-		samples, posterior = perturb(n_samples, nominal, beta, method='kernel', n_ics=n_ics, ic_step=ic_step, hmc_step=step, kernel_T=T, kernel_L=L)
+# All systems' chains run in one batched job (see sampler.ugen.perturb_many)
+nominals = torch.stack([torch.from_numpy(diff_to_transferop(A)).float() for A in systems.values()])
+
+if method == 'baseline':
+	sets = perturb_many(n_samples, nominals, beta, method='euclidean', n_ics=n_ics, hmc_step=step)
+elif method == 'kernel':
+	sets = perturb_many(n_samples, nominals, beta, method='kernel', n_ics=n_ics, hmc_step=step, kernel_T=T)
+elif method == 'constrained_kernel':
+	sets = perturb_many(n_samples, nominals, beta, method='kernel', n_ics=n_ics, hmc_step=step, kernel_T=T, use_spectral_constraint=True)
+elif method == 'discounted_kernel':
+	L = [max(0, 2*np.log(spectral_radius(nominal).item())) for nominal in nominals]
+	sets = perturb_many(n_samples, nominals, beta, method='kernel', n_ics=n_ics, hmc_step=step, kernel_T=T, kernel_L=L)
+
+for (name, A), (samples, posterior) in zip(systems.items(), sets):
 
 	samples = [transferop_to_diff(s.numpy()) for s in samples]
 
@@ -42,7 +42,7 @@ def solve_mpc(t0: float, dt: float, x0: torch.Tensor, Ps: list, B: torch.Tensor,
 	while torch.abs(loss - prev_loss).item() > eps:
 		prev_loss = loss
 		loss = torch.max(torch.stack([
-			cost(u, obs.extrapolate(P, x0.unsqueeze(1), h, B=B, u=u.clamp(umin, umax), build_graph=True, unlift_every=False), window) for P in Ps
+			cost(u, obs.extrapolate(P, x0.unsqueeze(1), h, B=B, u=u.clamp(umin, umax), build_graph=True, unlift_every=False, adjoint=True), window) for P in Ps
 		]))
 		# print(loss.item())
 		opt.zero_grad()
@@ -8,6 +8,7 @@ from sampler.kernel import *
 from sampler.operators import *
 from sampler.utils import *
 from sampler.ugen import *
+from sampler.store import SampleStore
 import systems.duffing as duffing
 
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
@@ -73,14 +74,9 @@ n_ics = 12
 t = 800
 trajectories = [sample_2d_dynamics(P, obs, t, (-2,2), (-2,2), n_ics, n_ics) for P in random.choices(samples, k=n_trajectories)]
 
-results = {
-	'method': method,
-	'step': step,
-	'beta': beta,
-	'nominal': nominal.numpy(),
-	'posterior': posterior,
-	'samples': [s.numpy() for s in samples],
-	'trajectories': trajectories,
-}
 print('Saving..')
-hkl.dump(results, f'saved/duffing_{method}.hkl')
+store = SampleStore(f'saved/duffing_{method}', mode='w')
+store.set_meta(method=method, step=step, beta=beta)
+store.put('nominal', nominal)
+store.put('trajectories', np.array(trajectories))
+store.append(samples, posterior=posterior)
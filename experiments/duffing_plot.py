@@ -8,6 +8,7 @@ import scipy.stats as stats
 from sampler.utils import *
 from sampler.features import *
 from sampler.operators import *
+from sampler.store import load as store_load
 
 def get_color(z):
 	if z[0] > -1.5 and z[0] < -0.2 and z[1] > -0.5 and z[1] < 0.5:
@@ -63,11 +64,11 @@ if __name__ == '__main__':
 	# name = f'duffing_{method}'
 	name = 'duffing_uncertainty_set'
 
-	results = hkl.load(f'saved/{name}.hkl')
-	nominal = torch.from_numpy(results['nominal']).float()
-	posterior = results['posterior']
-	samples = [torch.from_numpy(s).float() for s in results['samples']]
-	trajectories = results['trajectories']
+	store = store_load(f'saved/{name}') # converts an older .hkl set on first use
+	nominal = store.get('nominal', as_tensor=True)
+	posterior = store.column('posterior')
+	samples = store.samples()
+	trajectories = store.get('trajectories')
 
 	# print('Saving trajectories...')
 	# n_perturbed = 21
@@ -75,14 +76,12 @@ if __name__ == '__main__':
 	# t = 800
 	# p, d, k = 5, 2, 15
 	# obs = PolynomialObservable(p, d, k)
-	# results['trajectories'] = []
-	# for P in random.choices(samples, k=n_perturbed):
-	# 	results['trajectories'].append(sample_2d_dynamics(P, obs, t, (-2,2), (-2,2), n_ics, n_ics))
-	# hkl.dump(results, f'saved/duffing_{method}.hkl')
+	# trajectories = [sample_2d_dynamics(P, obs, t, (-2,2), (-2,2), n_ics, n_ics) for P in random.choices(samples, k=n_perturbed)]
+	# store.put('trajectories', np.array(trajectories))
 
 	plot_perturbed(trajectories, 3, 7)
-	if 'beta' in results:
-		plot_posterior(posterior, results['beta'])
+	if 'beta' in store.meta:
+		plot_posterior(posterior, store.meta['beta'])
 	else:
 		plot_posterior(posterior)
 
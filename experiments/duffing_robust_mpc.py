@@ -12,6 +12,9 @@ import systems.duffing as duffing
 from sampler.features import *
 from sampler.operators import *
 from sampler.kernel import *
+from sampler.scenarios import select_scenarios
+from sampler.index import MetricIndex
+from sampler.store import load as store_load
 from experiments.duffing_mpc import mpc_loop, reference, cost
 from experiments.duffing_plot import plot_perturbed, plot_posterior
 
@@ -25,19 +28,21 @@ P, B = torch.from_numpy(data['P']).float(), torch.from_numpy(data['B']).float()
 dt = data['dt']
 print('Using dt:', dt)
 
-data = hkl.load('saved/duffing_uncertainty_set.hkl')
-posterior = data['posterior']
-# trajectories = data['trajectories']
-samples = [torch.from_numpy(s).float() for s in data['samples']]
-beta = data['beta']
+store = store_load('saved/duffing_uncertainty_set') # converts an older .hkl set on first use
+posterior = store.column('posterior')
+# trajectories = store.get('trajectories')
+samples = store.samples()
+beta = store.meta['beta']
 
 K = PFKernel(device, P.shape[0], 2, 80)
 dist_func = lambda x, y: K(x, y, normalize=True) 
 
 # Bound set
 radius = 0.2
-samples = [s for s in samples if dist_func(s, P).item() <= radius]
-posterior = [p for p in posterior if p <= radius]
+index = MetricIndex(samples, K)
+inside = index.radius(P, radius)[0]
+samples = [samples[i] for i in inside]
+posterior = [posterior[i] for i in inside]
 
 # # Resample trajectories
 p, d, k = 5, 2, 15
@@ -52,7 +57,11 @@ obs = PolynomialObservable(p, d, k)
 
 # Robust MPC
 print('Running MPC...')
-Ps = [P] + random.choices(samples, k=10)
+# The stored samples are HMC draws from the target, so each already carries mass 1/N: weighting them by the target density again
+# would count the posterior twice and pull scenarios towards the nominal. Only samples drawn from another distribution (e.g. a
+# store reweighted with sampler.reweight) need density-ratio weights here.
+scenarios, _ = select_scenarios(samples, K, 10, weights=None, nominal=P)
+Ps = [P] + [samples[i] for i in scenarios]
 
 # reference = lambda t: torch.full(t.shape, 0.)
 # reference = lambda t: torch.sign(torch.cos(t/4))
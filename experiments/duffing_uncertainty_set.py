@@ -9,6 +9,7 @@ from sampler.kernel import *
 from sampler.operators import *
 from sampler.utils import *
 from sampler.ugen import *
+from sampler.store import SampleStore
 import systems.duffing as duffing
 
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
@@ -46,15 +47,9 @@ n_ics = 12
 t = 800
 trajectories = [sample_2d_dynamics(P, obs, t, (-2,2), (-2,2), n_ics, n_ics) for P in random.choices(samples, k=n_trajectories)]
 
-results = {
-	'step': step,
-	'beta': beta,
-	'leapfrog': leapfrog,
-	'T': T,
-	'nominal': P.numpy(),
-	'posterior': posterior,
-	'samples': [s.numpy() for s in samples],
- 	'trajectories': trajectories,
-}
 print('Saving..')
-hkl.dump(results, 'saved/duffing_uncertainty_set.hkl')
+store = SampleStore('saved/duffing_uncertainty_set', mode='w')
+store.set_meta(step=step, beta=beta, leapfrog=leapfrog, T=T)
+store.put('nominal', P)
+store.put('trajectories', np.array(trajectories))
+store.append(samples, posterior=posterior)
@@ -30,6 +30,7 @@ P0, P1 = P0.detach().requires_grad_(), P1.detach().requires_grad_()
 
 m, T = 2, 20 
 K = PFKernel(device, d, m, T)
+Ts, Ls = [10, 20, 80], [0., 0.1] # distances along the descent at other horizons & discounts, from one power series
 
 eps = 1e-3
 step = 1e-3
@@ -38,6 +39,7 @@ print(d.item())
 
 i, n = 0, float('inf')
 loss = []
+sweep = []
 
 try:
 
@@ -47,10 +49,17 @@ try:
 		d = K(P0, P1, normalize=True)
 		print(d.item())
 		loss.append(d.item())
+		with torch.no_grad():
+			sweep.append(K.sweep(P0, P1, Ts, Ls, normalize=True).view(-1).tolist())
 		i += 1
 
 except KeyboardInterrupt:
 	pass
 
-plt.plot(loss)
+plt.plot(loss, label=f'T={T}, L=0 (descended)')
+if len(sweep) > 0:
+	labels = [f'T={t}, L={l}' for l in Ls for t in Ts]
+	for j, label in enumerate(labels):
+		plt.plot([s[j] for s in sweep], '--', label=label)
+plt.legend()
 plt.show()
\ No newline at end of file
@@ -5,7 +5,7 @@ from sampler.features import *
 from sampler.kernel import *
 from sampler.operators import *
 from sampler.utils import *
-from sampler.ugen import perturb
+from sampler.ugen import perturb_ladder
 import systems.vdp as vdp
 
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
@@ -39,15 +39,20 @@ dist_func = euclidean_matrix_kernel if baseline else (lambda x, y: K(x, y, norma
 
 rms_dist = []
 
-for beta in np.linspace(1, 100, 50):
-
-	samples = perturb(
-		30, P0, dist_func, beta,  
-		sp_div=(1.0, 1.0), # leave spectral gap wide to purely determine effect of `beta`
-		hmc_step=5e-4,
-		hmc_leapfrog=25,
-	)
-
+# All betas in one parallel-tempering run; sharp (high beta) chains mix through the broader ones.
+# Swaps move a state one rung per round, so each ladder needs hundreds of rounds (and a burn-in) to cross the 50 betas.
+betas = np.linspace(1, 100, 50)
+n_ics, n_rounds = 4, 500
+results = perturb_ladder(
+	n_rounds * n_ics, P0, betas,
+	method='euclidean' if baseline else 'kernel', kernel_T=T, # no spectral constraint, to purely determine effect of `beta`
+	n_ics=n_ics,
+	hmc_step=5e-4,
+	hmc_leapfrog=25,
+	hmc_burn=200,
+)
+
+for beta, (samples, _) in zip(betas, results):
 	rms = np.array([dist_func(P0, P).item() for P in samples])
 	rms = np.sqrt(np.mean(rms ** 2))
 	rms_dist.append([beta, rms])
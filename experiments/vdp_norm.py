@@ -18,9 +18,9 @@ set_seed(9001)
 p, d, k = 10, 2, 20
 obs = PolynomialObservable(p, d, k)
 
-# Initialize kernel
-m, T = 2, 10
-K = PFKernel(device, k, m, T)
+# Initialize kernel; all horizons & discounts are evaluated from one power series
+m, Ts, Ls = 2, [10, 20, 80], [0., 0.1]
+K = PFKernel(device, k, m, max(Ts))
 
 mu_0 = 0
 X, Y = vdp.dataset(mu_0)
@@ -30,15 +30,17 @@ P_0 = P_0.to(device)
 
 n = 70
 results = np.full((n, 2), np.nan)
+d_pfs = np.full((n, len(Ls), len(Ts)), np.nan)
 mu_rng = np.linspace(0, 3, n) + mu_0
 
 for i, mu in enumerate(mu_rng):
 	X, Y = vdp.dataset(mu)
 	P = edmd(X, Y, obs)
 	P = P.to(device)
-	d_pf = K(P_0, P, normalize=True)
+	d_pf = K.sweep(P_0, P, Ts, Ls, normalize=True)
 	d_fro = torch.norm(P - P_0)
-	results[i] = [d_pf.item(), d_fro.item()]
+	d_pfs[i] = d_pf.cpu().numpy()
+	results[i] = [d_pfs[i, 0, 0], d_fro.item()]
 
 print(results)
 
@@ -48,7 +50,10 @@ print(p)
 plt.figure()
 plt.title('Kernel distance vs. mu')
 plt.yscale('log')
-plt.plot(mu_rng, results[:, 0])
+for a, L in enumerate(Ls):
+	for b, T in enumerate(Ts):
+		plt.plot(mu_rng, d_pfs[:, a, b], label=f'T={T}, L={L}')
+plt.legend()
 plt.figure()
 plt.title('Probability vs. mu')
 plt.plot(mu_rng, p)
@@ -0,0 +1,114 @@
+'''
+Compiled potential functions.
+
+Potentials are evaluated eagerly once per leapfrog step with small tensors, so interpreter and dispatcher overhead
+dominate. CompiledPotential traces the potential (and, through autograd, its gradient) into a fused graph on first use
+and falls back to eager evaluation for inputs of other shapes or if compilation fails.
+'''
+import warnings
+import torch
+from typing import Callable
+
+class CompiledPotential:
+	def __init__(self, potential: Callable, backend='inductor'):
+		'''
+		potential: potential function of a params tuple, returning a scalar tensor
+		backend: 'inductor' (torch.compile), 'aot_eager' (torch.compile without code generation, for checking graphs) or
+			'script' (TorchScript trace)
+		'''
+		assert backend in ['inductor', 'aot_eager', 'script'], 'Unknown backend'
+		self.potential = potential
+		self.backend = backend
+		self.compiled = None
+		self.signature = None
+		self.failed = False
+
+	def __getstate__(self):
+		# Compiled graphs don't pickle; each process compiles on first use
+		state = self.__dict__.copy()
+		state['compiled'], state['signature'] = None, None
+		return state
+
+	def _compile(self, params: tuple):
+		fn = lambda *p: self.potential(p)
+		if self.backend != 'script':
+			return torch.compile(fn, backend=self.backend, dynamic=False)
+		else:
+			with warnings.catch_warnings():
+				warnings.simplefilter('ignore', torch.jit.TracerWarning)
+				return torch.jit.trace(fn, tuple(w.detach().requires_grad_() for w in params), check_trace=False)
+
+	def __call__(self, params: tuple):
+		signature = tuple((w.shape, w.dtype, w.device) for w in params)
+		if self.failed or (self.signature is not None and signature != self.signature):
+			return self.potential(params)
+		try:
+			if self.compiled is None:
+				self.compiled = self._compile(params)
+				self.signature = signature
+			if self.backend == 'script':
+				# The trace already removes interpreter overhead; the profiling executor's re-optimization costs minutes of warm-up
+				with torch.jit.optimized_execution(False):
+					return self.compiled(*params)
+			return self.compiled(*params)
+		except Exception as e:
+			warnings.warn(f'Compiling potential failed, falling back to eager: {e}')
+			self.failed = True
+			return self.potential(params)
+
+'''
+Tests
+'''
+if __name__ == '__main__':
+	import sys
+	import time
+	import cloudpickle
+	from sampler.hmc import PotentialCache
+	from sampler.kernel import PFKernel
+	from sampler.utils import set_seed
+
+	# Correctness check on a tiny problem; `--benchmark` times all backends on larger ones (minutes of compilation)
+	benchmark = '--benchmark' in sys.argv
+	set_seed(9001)
+	torch.set_num_threads(1)
+
+	m, beta = 2, 5.
+	T, n_evals, dims, backends = (80, 100, [2, 8, 15], ['eager', 'script', 'inductor']) if benchmark else (10, 4, [2], ['eager', 'script', 'aot_eager'])
+	pdf = torch.distributions.beta.Beta(torch.Tensor([1.]), torch.Tensor([beta]))
+
+	print(f'Per-leapfrog potential + gradient time (m={m}, T={T})')
+	for d in dims:
+		K = PFKernel('cpu', d, m, T)
+		model = torch.randn(d, d)
+		model = 0.9 * model / torch.linalg.eigvals(model).abs().max()
+		def potential(params: tuple):
+			d_k = K(model, params[0], normalize=True).clamp(1e-8)
+			return -pdf.log_prob(d_k)
+
+		positions = [(model + 1e-2*torch.randn(d, d),) for _ in range(n_evals)]
+		for backend in backends:
+			fn = potential if backend == 'eager' else CompiledPotential(potential, backend=backend)
+			start = time.perf_counter()
+			u, grad = PotentialCache(fn)(positions[0]) # includes compilation
+			for p in positions[:3]:
+				PotentialCache(fn)((p[0] + 1e-3,))
+			warmup_time = time.perf_counter() - start
+			if backend == 'eager':
+				u_ref, grad_ref = u, grad
+			else:
+				assert not fn.failed, 'compilation failed'
+				assert torch.allclose(u, u_ref, rtol=1e-4) and torch.allclose(grad[0], grad_ref[0], rtol=1e-3, atol=1e-5), 'compiled potential mismatch'
+
+			start = time.perf_counter()
+			for p in positions[1:]:
+				PotentialCache(fn)(p)
+			per_eval = (time.perf_counter() - start) / (n_evals - 1)
+			if backend == 'eager':
+				eager_time = per_eval
+			print(f'd={d:2d} {backend:9s}: {1e3*per_eval:7.3f} ms ({eager_time/per_eval:.1f}x), warm-up {warmup_time:.1f}s')
+
+	# Other shapes fall back to eager; pickling drops the compiled graph
+	fn = cloudpickle.loads(cloudpickle.dumps(CompiledPotential(lambda p: p[0].pow(2).sum(), backend='script')))
+	fn((torch.ones(2, 2),))
+	assert fn((torch.ones(3, 3),)).item() == 9 and fn.signature[0][0] == (2, 2) and not fn.failed
+	print('Fallback test passed')
@@ -0,0 +1,104 @@
+'''
+MCMC convergence diagnostics: split R-hat and bulk/tail effective sample size (Vehtari et al., https://arxiv.org/abs/1903.08008).
+
+All functions take draws of shape (chains, draws, ...) and are batched over trailing dimensions,
+so every operator entry of a sample set is diagnosed at once.
+'''
+import numpy as np
+import scipy.stats as stats
+
+def _split(x: np.ndarray):
+	''' Split each chain in half, doubling the number of chains '''
+	n = x.shape[1] // 2
+	return np.concatenate((x[:, :n], x[:, x.shape[1]-n:]), axis=0)
+
+def _rank_normalize(x: np.ndarray):
+	M, N = x.shape[:2]
+	flat = x.reshape((M*N,) + x.shape[2:])
+	ranks = np.argsort(np.argsort(flat, axis=0), axis=0) + 1
+	return stats.norm.ppf((ranks - 3/8) / (M*N + 1/4)).reshape(x.shape)
+
+def autocovariance(x: np.ndarray):
+	'''
+	Autocovariance of each chain along the draws axis via FFT.
+	'''
+	N = x.shape[1]
+	centered = x - x.mean(axis=1, keepdims=True)
+	n_fft = 2**int(np.ceil(np.log2(2*N)))
+	f = np.fft.rfft(centered, n=n_fft, axis=1)
+	acov = np.fft.irfft(f * np.conjugate(f), n=n_fft, axis=1)[:, :N]
+	return acov / N
+
+def rhat(x: np.ndarray):
+	'''
+	Split R-hat on rank-normalized draws.
+	'''
+	x = _rank_normalize(_split(x))
+	N = x.shape[1]
+	W = x.var(axis=1, ddof=1).mean(axis=0)
+	B = N * x.mean(axis=1).var(axis=0, ddof=1)
+	var_plus = (N-1)/N * W + B/N
+	return np.sqrt(var_plus / W)
+
+def _ess(x: np.ndarray):
+	M, N = x.shape[:2]
+	acov = autocovariance(x)
+	W = x.var(axis=1, ddof=1).mean(axis=0)
+	var_plus = (N-1)/N * W + x.mean(axis=1).var(axis=0, ddof=1) if M > 1 else (N-1)/N * W
+	rho = 1 - (W - acov.mean(axis=0)) / var_plus
+	rho[0] = 1.
+
+	# Geyer's initial monotone sequence on sums of consecutive autocorrelation pairs
+	n_pairs = N // 2
+	pairs = rho[0:2*n_pairs:2] + rho[1:2*n_pairs:2]
+	positive = np.cumprod(pairs > 0, axis=0).astype(bool)
+	pairs = np.minimum.accumulate(np.where(positive, pairs, 0.), axis=0)
+	tau = -1 + 2*pairs.sum(axis=0)
+	return M*N / np.maximum(tau, 1/np.log10(M*N))
+
+def ess_bulk(x: np.ndarray):
+	'''
+	Bulk effective sample size (split chains, rank-normalized draws).
+	'''
+	return _ess(_rank_normalize(_split(x)))
+
+def ess_tail(x: np.ndarray):
+	'''
+	Tail effective sample size: minimum ESS of the 5% and 95% quantile indicators.
+	'''
+	x = _split(x)
+	M, N = x.shape[:2]
+	flat = x.reshape((M*N,) + x.shape[2:])
+	lo, hi = np.quantile(flat, 0.05, axis=0), np.quantile(flat, 0.95, axis=0)
+	return np.minimum(_ess((x <= lo).astype(float)), _ess((x <= hi).astype(float)))
+
+def summarize(x: np.ndarray):
+	'''
+	Worst-case diagnostics over all quantities in x (chains, draws, ...).
+	'''
+	return {
+		'rhat': float(np.nanmax(rhat(x))),
+		'ess_bulk': float(np.nanmin(ess_bulk(x))),
+		'ess_tail': float(np.nanmin(ess_tail(x))),
+	}
+
+'''
+Tests
+'''
+if __name__ == '__main__':
+	np.random.seed(9001)
+
+	# AR(1) chains with known ESS = n (1 - phi) / (1 + phi)
+	M, N, phi = 4, 4000, 0.9
+	x = np.zeros((M, N, 3))
+	for t in range(1, N):
+		x[:, t] = phi*x[:, t-1] + np.random.randn(M, 3)
+	expected = M*N*(1-phi)/(1+phi)
+	print('AR(1): bulk ESS', ess_bulk(x), 'tail ESS', ess_tail(x), 'expected ~', expected, 'R-hat', rhat(x))
+	assert np.abs(ess_bulk(x).mean() / expected - 1) < 0.3
+	assert np.all(rhat(x) < 1.05)
+
+	# Chains stuck at different locations
+	x[0] += 5
+	print('Unmixed R-hat:', rhat(x))
+	assert np.all(rhat(x) > 1.1)
@@ -0,0 +1,124 @@
+'''
+Eigen-parametrization of real operators in real block-diagonal form, P = V B V^-1.
+
+B holds the real eigenvalues of a nominal operator as 1 x 1 blocks and each complex-conjugate pair r e^{+-i theta} as a
+2 x 2 block r [[cos theta, sin theta], [-sin theta, cos theta]]. Operators are represented by one flat vector
+x = (vec V, real eigenvalues, pair moduli, pair angles), so that bounds on eigenvalue moduli (such as a spectral radius
+window) are box constraints on x. The eigenvalue structure (numbers of real eigenvalues & complex pairs) is that of the nominal.
+'''
+import torch
+
+class EigenParametrization:
+	def __init__(self, model: torch.Tensor, tol=1e-6):
+		'''
+		model: nominal d x d operator, assumed diagonalizable
+		tol: relative imaginary part below which eigenvalues are treated as real
+		'''
+		d = model.shape[0]
+		self.d = d
+		lam, U = torch.linalg.eig(model.detach().double())
+		scale = lam.abs().max()
+		real = (lam.imag.abs() <= tol*scale).nonzero()[:, 0]
+		pairs = (lam.imag > tol*scale).nonzero()[:, 0]
+		self.n_real, self.n_pairs = len(real), len(pairs)
+		assert self.n_real + 2*self.n_pairs == d, 'Could not split spectrum into real eigenvalues & conjugate pairs'
+
+		columns = []
+		for i in real:
+			u = U[:, i]
+			u = u * u[u.abs().argmax()].conj() # remove complex phase
+			columns.append(u.real / u.real.norm())
+		for i in pairs:
+			u = U[:, i] / U[:, i].norm()
+			columns.extend([u.real, u.imag])
+		self.V0 = torch.stack(columns, dim=1).to(model.dtype)
+		self.lam0 = torch.cat((lam[real].real, lam[pairs].abs(), lam[pairs].angle())).to(model.dtype)
+
+		# Scatter indices of block entries: real eigenvalues on the diagonal, then (r cos, r cos, r sin, -r sin) per pair
+		k = torch.arange(self.n_pairs) * 2 + self.n_real
+		r = torch.arange(self.n_real)
+		self.rows = torch.cat((r, k, k+1, k, k+1))
+		self.cols = torch.cat((r, k, k+1, k+1, k))
+		self.dominant = int(torch.cat((lam[real].abs(), lam[pairs].abs())).argmax())
+		self.size = d*d + self.n_real + 2*self.n_pairs
+
+	def encode(self):
+		'''
+		Flat parameter vector of the nominal.
+		'''
+		return torch.cat((self.V0.reshape(-1), self.lam0))
+
+	def split(self, x: torch.Tensor):
+		'''
+		(V, real eigenvalues, pair moduli, pair angles) of parameter vectors x (..., size).
+		'''
+		d, n_r, n_p = self.d, self.n_real, self.n_pairs
+		V = x[..., :d*d].reshape(x.shape[:-1] + (d, d))
+		lam = x[..., d*d:]
+		return V, lam[..., :n_r], lam[..., n_r:n_r+n_p], lam[..., n_r+n_p:]
+
+	def decode(self, x: torch.Tensor):
+		'''
+		Operators P = V B V^-1 (..., d, d) of parameter vectors x (..., size); differentiable.
+		'''
+		V, real, moduli, angles = self.split(x)
+		c, s = moduli*torch.cos(angles), moduli*torch.sin(angles)
+		B = torch.zeros(x.shape[:-1] + (self.d, self.d), dtype=x.dtype, device=x.device)
+		B[..., self.rows, self.cols] = torch.cat((real, c, c, s, -s), dim=-1)
+		return torch.linalg.solve(V.transpose(-1, -2), (V @ B).transpose(-1, -2)).transpose(-1, -2) # V B V^-1
+
+	def spectral_bounds(self, vmin: float, vmax: float):
+		'''
+		Per-entry box (lower, upper) on parameter vectors for which all eigenvalue moduli are <= vmax and the
+		nominal's dominant eigenvalue (or pair) has modulus in [vmin, vmax], i.e. the spectral radius lies in [vmin, vmax].
+		Eigenvectors and angles are unconstrained.
+		'''
+		inf = float('inf')
+		lower = torch.full((self.size,), -inf)
+		upper = torch.full((self.size,), inf)
+		o = self.d*self.d
+		lower[o:o+self.n_real], upper[o:o+self.n_real] = -vmax, vmax
+		lower[o+self.n_real:o+self.n_real+self.n_pairs], upper[o+self.n_real:o+self.n_real+self.n_pairs] = 0., vmax
+		i = o + self.dominant
+		if self.dominant < self.n_real and self.lam0[self.dominant] < 0:
+			lower[i], upper[i] = -vmax, -vmin
+		else:
+			lower[i], upper[i] = vmin, vmax
+		return lower, upper
+
+	def gauge_prior(self, x: torch.Tensor, scale=1.):
+		'''
+		Gaussian potential on eigenvectors around the nominal's. P does not depend on the scaling (and pair rotation) of
+		eigenvectors, so without it these directions are unbounded random walks.
+		No Jacobian of decode is included: densities over x are not densities over P (see `sampler.ugen.perturb`).
+		'''
+		V, _, _, _ = self.split(x)
+		return 0.5 * ((V - self.V0.to(x.device)) ** 2).sum((-1, -2)) / scale**2
+
+'''
+Tests
+'''
+if __name__ == '__main__':
+	from sampler.utils import set_seed, spectral_radius
+
+	set_seed(9001)
+
+	for d in [2, 5, 8]:
+		model = torch.randn(d, d) / d**0.5
+		param = EigenParametrization(model)
+		x0 = param.encode()
+		assert torch.allclose(param.decode(x0), model, atol=1e-4), 'decode(encode(P)) != P'
+
+		# Random points of the spectral box have spectral radius in the window
+		r = spectral_radius(model).item()
+		lower, upper = param.spectral_bounds(r - 1e-2, r + 1e-2)
+		lo, hi = lower.clamp(min=-10.), upper.clamp(max=10.)
+		X = x0 + 0.1*torch.randn(100, param.size)
+		X = torch.max(torch.min(X, hi), lo)
+		radii = torch.linalg.eigvals(param.decode(X)).abs().max(-1)[0]
+		print(f'd={d}: {param.n_real} real, {param.n_pairs} pairs; spectral radii in [{radii.min():.4f}, {radii.max():.4f}], window [{r-1e-2:.4f}, {r+1e-2:.4f}]')
+		assert ((radii - r).abs() <= 1e-2 + 1e-4).all()
+
+		x = x0.clone().requires_grad_()
+		g = torch.autograd.grad(param.decode(x).sum() + param.gauge_prior(x), x)[0]
+		assert torch.isfinite(g).all()
@@ -5,6 +5,8 @@ import torch
 import random
 import numpy as np
 
+from sampler.rollout import lifted_rollout, unlifted_rollout
+
 '''
 Observables
 '''
@@ -28,13 +30,14 @@ class Observable:
 	def preimage(self, Y: torch.Tensor):
 		return Y
 
-	def extrapolate(self, P: torch.Tensor, X: torch.Tensor, t: int, B=None, u=None, unlift_every=True, build_graph=False):
+	def extrapolate(self, P: torch.Tensor, X: torch.Tensor, t: int, B=None, u=None, unlift_every=True, build_graph=False, adjoint=False):
 		'''
-		P: transfer operator
+		P: transfer operator, or a LowRankOperator (stepped in factored form)
 		X: initial conditions
 		t: trajectory length
 		B: (optional) control matrix
-		u: (optional) control inputs
+		u: (optional) control inputs (inputs x t, or inputs x t x 1)
+		adjoint: (with build_graph) differentiate via reverse-time adjoint recursion instead of storing the full graph
 		'''
 		assert X.shape[0] == self.d, "dimension mismatch"
 		assert X.shape[1] >= self.m, "insufficient initial conditions provided"
@@ -43,9 +46,22 @@ class Observable:
 		if u is not None:
 			assert B is not None, "Control matrix required"
 			assert u.shape[1] >= t, "insufficient control inputs provided"
+			u = u.reshape(u.shape[0], u.shape[1], -1) # (inputs, t) or (inputs, t, 1)
+			assert u.shape[2] == 1, "one control input vector per step required"
 			if not build_graph:
 				B, u = B.detach(), u.detach()
 
+		if build_graph and adjoint:
+			if u is not None:
+				W = B@u[:, self.m-1:t-1, 0]
+			else:
+				W = torch.zeros((self.k, t-self.m), device=X.device)
+			if unlift_every:
+				return unlifted_rollout(P, X[:, 0:1], W, self)
+			else:
+				z0 = self(X[:, 0:self.m], build_graph=True)
+				return self.preimage(lifted_rollout(P, z0, W))
+
 		if unlift_every:
 			if build_graph:
 				Y = [X[:,0]]
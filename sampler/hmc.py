@@ -1,3 +1,6 @@
+import os
+import time
+import pickle
 import torch
 import numpy as np
 import matplotlib.pyplot as plt
@@ -5,89 +8,289 @@ from typing import Callable
 from tqdm import tqdm
 
 from sampler.utils import *
+from sampler.utils import Divergence # raised by leapfrog & boundaries
+import sampler.stats as instrumentation
+
+class ChainDiverged(Exception):
+	'''
+	Raised by `sample` after `max_divergences` consecutive divergent proposals, with the samples returned so far
+	(so the chain can be continued from another state, see sampler.hmc_parallel).
+	'''
+	def __init__(self, samples: list, n_divergences: int):
+		super().__init__(f'{n_divergences} consecutive divergent proposals')
+		self.samples = samples
+
+def _is_finite(*values):
+	return all(bool(torch.isfinite(torch.as_tensor(v)).all()) for v in values)
+
+class PotentialCache:
+	'''
+	Fused potential value and gradient, cached by position. Within a proposal every position is evaluated once:
+	the Hamiltonian reuses the values computed for the leapfrog gradients, and the start of the next proposal
+	(the accepted end, or the pinned start if rejected) is still cached.
+
+	potential: once-differentiable potential function
+	zero_nan: replace NaN gradient entries with zeros
+	size: number of positions kept
+	name: label of evaluations in sampler.stats (e.g. 'surrogate' for a delayed-acceptance surrogate)
+	'''
+	def __init__(self, potential: Callable, zero_nan=False, size=2, name='potential'):
+		self.potential = potential
+		self.zero_nan = zero_nan
+		self.size = size
+		self.name = name
+		self.gradient_name = 'gradient' if name == 'potential' else f'{name}_gradient'
+		self.entries = []
+		self.pinned = None
+		self.n_evals = 0 # potential/gradient evaluations made
+
+	def __call__(self, params: tuple, pin=False):
+		'''
+		Potential value and gradient at params.
+
+		pin: keep this position cached until another is pinned (e.g. the start of a proposal)
+		'''
+		entries = self.entries if self.pinned is None else [self.pinned] + self.entries
+		for entry in entries:
+			(key, u, d_p) = entry
+			if len(key) == len(params) and all(torch.equal(k, w.detach()) for k, w in zip(key, params)):
+				instrumentation.count(f'{self.name}_cache_hits')
+				if pin:
+					self.pinned = entry
+				return u, d_p
+		p = tuple(w.detach().requires_grad_() for w in params)
+		with instrumentation.timer(self.name):
+			u = self.potential(p)
+		self.n_evals += 1
+		instrumentation.count(self.name)
+		if type(u) != torch.Tensor: # PyTorch doesn't understand how to differentiate constants
+			d_p = tuple(torch.zeros_like(w, device=w.device) for w in p)
+		else:
+			with instrumentation.timer(self.gradient_name):
+				d_p = torch.autograd.grad(u, p)
+			instrumentation.count(self.gradient_name)
+			u = u.detach()
+			if self.zero_nan: 
+				d_p = tuple(zero_if_nan(dw) for dw in d_p)
+		entry = (tuple(w.detach() for w in p), u, d_p)
+		self.entries = [entry] + self.entries[:self.size-1]
+		if pin:
+			self.pinned = entry
+		return u, d_p
+
+def evaluate(potential: Callable, params: tuple):
+	'''
+	Potential value alone (no gradient), e.g. for the second stage of delayed acceptance.
+	'''
+	with torch.no_grad(), instrumentation.timer('potential'):
+		u = potential(tuple(w.detach() for w in params))
+	instrumentation.count('potential')
+	return u
+
+def kinetic(momentum: tuple):
+	return sum([0.5 * (m * m).sum() for m in momentum])
 
 def hamiltonian(params: tuple, momentum: tuple, potential: Callable):
-	U = potential(params)
-	K = sum([0.5 * torch.trace(torch.mm(m.t(), m)) for m in momentum])
-	return U + K 
+	U = potential(params)[0] if isinstance(potential, PotentialCache) else potential(params)
+	return U + kinetic(momentum)
 
 def gibbs(params: tuple):
 	return tuple(torch.distributions.Normal(torch.zeros_like(w), torch.ones_like(w)).sample() for w in params)
 
 def leapfrog(
 		params: tuple, momentum: tuple, potential: Callable, boundary: Callable, n_leapfrog: int, step_size: float, 
-		zero_nan=False, debug=False, collision_resolution=20, max_refl=100
+		zero_nan=False, debug=False, collision_resolution=20, max_refl=100, h_old=None, max_energy_error=None
 	):
-	def params_grad(p):
-		p = tuple(w.detach().requires_grad_() for w in p)
-		u = potential(p)
-		if type(u) != torch.Tensor: # PyTorch doesn't understand how to differentiate constants
-			return tuple(torch.zeros_like(w, device=w.device) for w in p)
-		d_p = torch.autograd.grad(u, p)
-		if zero_nan: 
-			d_p = tuple(zero_if_nan(dw) for dw in d_p)
-		return d_p
+	'''
+	Raises Divergence as soon as positions, potentials or gradients become non-finite, reflections exceed max_refl, or
+	(given h_old, the energy at the start) the energy error exceeds max_energy_error, so diverging trajectories stop early.
 
-	momentum = zip_with(momentum, params_grad(params), lambda m, dp: m - 0.5*step_size*dp)
+	potential: potential function, or a PotentialCache to share evaluations with the caller (zero_nan is then the cache's)
+	'''
+	params_grad = potential if isinstance(potential, PotentialCache) else PotentialCache(potential, zero_nan=zero_nan)
+
+	momentum = zip_with(momentum, params_grad(params)[1], lambda m, dp: m - 0.5*step_size*dp)
 
 	for n in range(n_leapfrog):
 
 		old_eps = None
 		eps = step_size
 		r_i = 0
-		while old_eps is None or np.abs(eps - old_eps) > (step_size/collision_resolution): # While path is being exhausted
+		while eps > 0 and (old_eps is None or np.abs(eps - old_eps) > (step_size/collision_resolution)): # While path is being exhausted
 			old_eps = eps
-			params, momentum, eps = boundary(params, momentum, eps)
+			with instrumentation.timer('boundary'):
+				params, momentum, eps = boundary(params, momentum, eps)
+			instrumentation.count('boundary')
 			r_i += 1
 			if r_i > max_refl:
-				raise Exception('Maximum reflections exceeded')
+				raise Divergence('Maximum reflections exceeded')
 
-		momentum = zip_with(momentum, params_grad(params), lambda m, dp: m - step_size*dp)
+		u, d_p = params_grad(params)
+		if not _is_finite(u, *params, *d_p):
+			raise Divergence('Non-finite position, potential or gradient')
+		if h_old is not None and max_energy_error is not None:
+			# Energy with the momentum synchronized to the position (half a step)
+			h = u + kinetic(zip_with(momentum, d_p, lambda m, dp: m - 0.5*step_size*dp))
+			if not h - h_old <= max_energy_error:
+				raise Divergence(f'Energy error {(h - h_old).item():.3g} exceeds {max_energy_error}')
+
+		# Full momentum steps between position updates, half step after the last
+		scale = step_size if n < n_leapfrog-1 else 0.5*step_size
+		momentum = zip_with(momentum, d_p, lambda m, dp: m - scale*dp)
 
-	momentum = zip_with(momentum, params_grad(params), lambda m, dp: m - 0.5*step_size*dp)
 	# momentum = map(lambda m: -m, momentum)
 	return params, momentum
 
 def accept(h_old: torch.Tensor, h_new: torch.Tensor):
+	if torch.isnan(torch.as_tensor(h_old - h_new)).any(): # min() below would accept
+		return False
 	rho = min(0., h_old - h_new)
 	return rho >= torch.log(torch.rand(1).to(h_old.device))
 
+def chain_fingerprint(step_size: float, n_leapfrog: int, n_burn: int, random_step: bool, config=None):
+	''' Settings a chain checkpoint must match to be resumed (see `sample`) '''
+	return fingerprint(step_size=step_size, n_leapfrog=n_leapfrog, n_burn=n_burn, random_step=random_step, **(config or {}))
+
+def save_chain(checkpoint: str, params: tuple, samples: list, n: int, fingerprint: str, n_saved=0):
+	'''
+	Checkpoints a chain: its state, and its samples past the n_saved ones already saved, which are appended to checkpoint + '.samples'
+	instead of rewriting all of them. Returns the number of samples saved.
+	'''
+	new = [tuple(x.detach() for x in p) for p in samples[n_saved:]]
+	if n_saved == 0:
+		# Replaces any samples of an earlier chain; the checkpoint is written after, so it never counts samples which are not saved
+		tmp = checkpoint + '.samples.tmp'
+		with open(tmp, 'wb') as f:
+			pickle.dump(new, f)
+		os.replace(tmp, checkpoint + '.samples')
+	else:
+		append_records(checkpoint + '.samples', new)
+	save_checkpoint(checkpoint, {
+		'params': tuple(w.detach() for w in params),
+		'n_samples': len(samples),
+		'n': n,
+		'rng': get_rng_state(),
+		'fingerprint': fingerprint,
+	})
+	return len(samples)
+
+def load_chain(checkpoint: str):
+	''' State and samples of a chain checkpoint (older checkpoints hold all their samples in the state) '''
+	state = load_checkpoint(checkpoint)
+	if 'samples' in state:
+		return state, state['samples']
+	return state, load_records(checkpoint + '.samples', state['n_samples'])
+
 def sample(
 		n_samples: int, init_params: tuple, potential: Callable, boundary: Callable, 
 		step_size=0.03, n_leapfrog=10, n_burn=10, random_step=False, debug=False, return_first=False,
-		show_progress=True
+		show_progress=True, checkpoint=None, checkpoint_every=10, restore_rng=True, on_accept=None, stats=None, trace=None, surrogate=None,
+		max_energy_error=1000., max_divergences=None, config=None
 	):
 	'''
 	Leapfrog HMC 
 
+	Each proposal costs n_leapfrog potential/gradient evaluations (plus one for the first); rejected proposals restore the previous position.
+
 	potential: once-differentiable potential function 
 	boundary: boundary condition which returns either None or (boundary position, reflected momentum)
+	checkpoint: (optional) file to which chain state is saved every `checkpoint_every` proposals (new samples are appended to checkpoint + '.samples');
+		resumed from if it exists, unless it was written with another step size, number of leapfrog steps, burn-in or config (raises CheckpointMismatch)
+	config: (optional) dict of further settings (e.g. of the potential) which a checkpoint must match to be resumed
+	restore_rng: restore the RNG state on resume (disable when restarting after an error, so the chain takes a different path)
+	on_accept: (optional) called with each sample in order, starting with those restored from the checkpoint (so a resumed chain replays them)
+	stats: (optional) sampler.stats.Stats which receives evaluation/reflection counts & times, energy errors and the acceptance ratio
+	trace: (optional) file to which a torch.profiler Chrome trace of the run is exported
+	surrogate: (optional) cheap approximation of the potential for delayed acceptance. It drives the leapfrog dynamics and
+		a first accept test; only proposals which pass are tested against the potential (one evaluation, no gradient)
+		with the ratio exp(-(U_new - U_old) + (U~_new - U~_old)), which keeps the exact stationary distribution.
+	max_energy_error: energy error beyond which a trajectory is abandoned as divergent (see `leapfrog`); divergent proposals are rejected
+	max_divergences: (optional) raise ChainDiverged after this many consecutive divergent proposals
 	'''
 	params = tuple(x.clone().requires_grad_() for x in init_params)
 	ret_params = [init_params] if return_first else []
-	n = 0
-	if show_progress: pbar = tqdm(total=n_samples, desc='HMC') 
-	while len(ret_params) < n_samples:
-		momentum = gibbs(params)
-		h_old = hamiltonian(params, momentum, potential)
-
-		if random_step:
-			eps = torch.normal(step_size, 2*step_size, (1,)).clamp(step_size/10)
-		else:
-			eps = step_size
-		params, momentum = leapfrog(params, momentum, potential, boundary, n_leapfrog, eps, debug=debug)
-
-		params = tuple(w.detach().requires_grad_() for w in params)
-		h_new = hamiltonian(params, momentum, potential)
-
-		if accept(h_old, h_new) and n > n_burn:
-			ret_params.append(params)
-			if show_progress: pbar.update(1)
-
-		n += 1
-
+	n, n_saved = 0, 0
+	fp = chain_fingerprint(step_size, n_leapfrog, n_burn, random_step, config)
+	if checkpoint is not None and os.path.exists(checkpoint):
+		state, ret_params = load_chain(checkpoint)
+		check_fingerprint(checkpoint, state, fp)
+		params = tuple(x.clone().requires_grad_() for x in state['params'])
+		n = state['n']
+		n_saved = len(ret_params) if 'samples' not in state else 0 # older checkpoints are rewritten in the new format
+		if restore_rng:
+			set_rng_state(state['rng'])
+	if on_accept is not None:
+		for p in ret_params: # the initial condition (with return_first), or the samples restored from the checkpoint
+			on_accept(tuple(x.detach() for x in p))
+
+	def save():
+		nonlocal n_saved
+		n_saved = save_chain(checkpoint, params, ret_params, n, fp, n_saved)
+
+	cache = PotentialCache(potential) if surrogate is None else PotentialCache(surrogate, name='surrogate')
+	if show_progress: pbar = tqdm(total=n_samples, initial=len(ret_params), desc='HMC') 
+	with instrumentation.recording(stats), instrumentation.profiled(trace):
+		if surrogate is not None:
+			u_exact = evaluate(potential, params)
+		n_divergent = 0 # consecutive divergent proposals
+		while len(ret_params) < n_samples:
+			start = time.perf_counter()
+			momentum = gibbs(params)
+			h_old = cache(params, pin=True)[0] + kinetic(momentum)
+
+			if random_step:
+				eps = torch.normal(step_size, 2*step_size, (1,)).clamp(step_size/10)
+			else:
+				eps = step_size
+			instrumentation.count('proposals')
+			try:
+				proposal, momentum = leapfrog(params, momentum, cache, boundary, n_leapfrog, eps, debug=debug, h_old=h_old, max_energy_error=max_energy_error)
+				proposal = tuple(w.detach().requires_grad_() for w in proposal)
+				h_new = cache(proposal)[0] + kinetic(momentum)
+				instrumentation.record('energy_error', h_new - h_old)
+				if max_energy_error is not None and not h_new - h_old <= max_energy_error:
+					raise Divergence(f'Energy error {(h_new - h_old).item():.3g} exceeds {max_energy_error}')
+				n_divergent = 0
+				accepted = accept(h_old, h_new)
+			except Divergence as e:
+				instrumentation.count('divergences')
+				if debug:
+					print('Divergent proposal:', e)
+				n_divergent += 1
+				if max_divergences is not None and n_divergent >= max_divergences:
+					raise ChainDiverged([tuple(x.detach() for x in p) for p in ret_params], n_divergent)
+				accepted = False
+
+			if accepted and surrogate is not None:
+				# Second stage: the kinetic energies cancel, leaving the exact & surrogate potential differences
+				instrumentation.count('first_stage_accepted')
+				u_new = evaluate(potential, proposal)
+				accepted = accept(u_exact - cache(params)[0], u_new - cache(proposal)[0])
+				if accepted:
+					u_exact = u_new
+
+			if accepted:
+				params = proposal
+				instrumentation.count('accepted')
+				if n > n_burn:
+					ret_params.append(params)
+					if on_accept is not None:
+						on_accept(tuple(w.detach() for w in params))
+					if show_progress: pbar.update(1)
+			else:
+				instrumentation.add_time('rejected_proposals', time.perf_counter() - start)
+
+			n += 1
+			if checkpoint is not None and n % checkpoint_every == 0:
+				save()
+			instrumentation.add_time('proposals', time.perf_counter() - start)
+
+	if checkpoint is not None:
+		save()
 	if show_progress: pbar.close()
 	ratio = len(ret_params) / (n - n_burn)
+	if stats is not None:
+		stats.record('acceptance', ratio)
 	ret_params = list(map(lambda p: tuple(map(lambda x: x.detach(), p)), ret_params))
 	return ret_params, ratio
 
@@ -219,7 +422,7 @@ if __name__ == '__main__':
 
 	# params_init = (torch.zeros((2,1)),)
 	# potential = lambda _: 0 # uniform over [-1,1]x[-1,1]
-	# boundary = reflections.lp_boundary(lp, delta=0.1, vmax=1)
+	# boundary = reflections.lp_boundary(lp, vmax=1)
 
 	# samples, _ = sample(N, params_init, potential, boundary, step_size=step, n_leapfrog=L, n_burn=burn, return_first=True)
 	# samples = np.array([s.view(-1).numpy() for (s,) in samples])
@@ -1,57 +1,283 @@
 from typing import Callable, Any
 from itertools import repeat
+import os
 import multiprocessing
 import cloudpickle
 from tqdm import tqdm
 import traceback
+from contextlib import nullcontext
 import torch
 
 from sampler.utils import *
 import sampler.hmc as hmc
+import sampler.diagnostics as diagnostics
+from sampler.stats import Stats
 
 def worker(
 		n_samples: int, ic: tuple, 
 		potential: Any, boundary: Any,
 		step_size: float, n_leapfrog: int, n_burn: int, random_step: bool, debug: bool, return_first: bool,
-		seed: Any
+		seed: Any, checkpoint: Any, max_restarts: int, trace=None, queue=None, chain=None, annotate=None, surrogate=None,
+		max_divergences=None, healthy=None, config=None
 	):	
+	potential, boundary = cloudpickle.loads(potential), cloudpickle.loads(boundary)
+	surrogate = cloudpickle.loads(surrogate) if surrogate is not None else None
+	stats = Stats()
+	callbacks = []
+	if queue is not None:
+		annotate = cloudpickle.loads(annotate) if annotate is not None else (lambda _: None)
+		callbacks.append(lambda params: queue.put((chain, tuple(x.cpu().numpy() for x in params), annotate(params))))
+	healthy_state = None
+	if healthy is not None:
+		# Shared latest state of every chain, from which chronically diverging chains continue
+		callbacks.append(lambda params: healthy.__setitem__(chain, tuple(x.cpu().numpy() for x in params)))
+		def healthy_state():
+			others = [k for k in healthy.keys() if k != chain]
+			if len(others) == 0:
+				return None
+			return tuple(torch.from_numpy(x) for x in healthy[others[np.random.randint(len(others))]])
+	on_accept = (lambda params: [f(params) for f in callbacks]) if len(callbacks) > 0 else None
 	try:
-		potential, boundary = cloudpickle.loads(potential), cloudpickle.loads(boundary)
-		if seed is not None:
-			set_seed(seed)
-		samples, ratio = hmc.sample(n_samples, ic, potential, boundary, step_size=step_size, n_leapfrog=n_leapfrog, n_burn=n_burn, random_step=random_step, debug=debug, return_first=return_first, show_progress=False)
-		return samples
-	except:
-		print('Worker errored!')
-		print(traceback.format_exc())
-		return []
+		samples = _run_chain(
+			n_samples, ic, potential, boundary, step_size, n_leapfrog, n_burn, random_step, debug, return_first, seed, checkpoint, max_restarts, on_accept,
+			stats, trace, surrogate, max_divergences, healthy_state, config
+		)
+		return (samples if queue is None else [], stats) # streamed samples were already sent
+	finally:
+		if queue is not None:
+			queue.put((chain, None, stats)) # chain finished
+
+def _run_chain(
+		n_samples: int, ic: tuple, potential: Callable, boundary: Callable,
+		step_size: float, n_leapfrog: int, n_burn: int, random_step: bool, debug: bool, return_first: bool,
+		seed: Any, checkpoint: Any, max_restarts: int, on_accept: Any, stats=None, trace=None, surrogate=None, max_divergences=None, healthy_state=None,
+		config=None
+	):
+	'''
+	Runs a chain, restarting it after errors (at most max_restarts times). A chain raising hmc.ChainDiverged (max_divergences
+	consecutive divergent proposals) keeps its samples and continues from another chain's latest state given by healthy_state(),
+	or from its initial condition; it gives up after max_restarts consecutive continuations without a new sample.
+	The samples collected so far are returned if the chain gives up.
+	on_accept receives each position of the chain once: restarts replay the start of the chain (the initial condition or the
+	checkpoint's samples) and may redo samples lost since the last checkpoint, so only positions past those already emitted are passed on.
+	'''
+	samples = [] # collected before divergences, without a checkpoint (which holds them otherwise)
+	n_errors, n_stalled, n_collected, attempt = 0, 0, 0, 0
+	n_emitted = 0
+	def emitter(offset: int):
+		position = offset
+		def emit(params: tuple):
+			nonlocal position, n_emitted
+			if position >= n_emitted:
+				on_accept(params)
+				n_emitted += 1
+			position += 1
+		return emit
+
+	while True:
+		try:
+			if seed is not None:
+				set_seed(seed + 7919*attempt)
+			new_samples, ratio = hmc.sample(
+				n_samples, ic, potential, boundary, step_size=step_size, n_leapfrog=n_leapfrog, n_burn=n_burn, random_step=random_step, debug=debug, return_first=return_first, show_progress=False,
+				checkpoint=checkpoint, restore_rng=(attempt == 0), on_accept=emitter(len(samples)) if on_accept is not None else None, stats=stats, trace=trace, surrogate=surrogate, max_divergences=max_divergences,
+				config=config
+			)
+			return samples + new_samples
+		except hmc.ChainDiverged as e:
+			if stats is not None:
+				stats.count('divergence_restarts')
+			state = healthy_state() if healthy_state is not None else None
+			print(f'Chain diverged after {len(e.samples)} samples, continuing from ' + ('another chain' if state is not None else 'its initial condition'))
+			state = state if state is not None else ic
+			if checkpoint is not None:
+				# The checkpoint holds the samples so far; the continuation resumes from it without burn-in
+				hmc.save_chain(checkpoint, state, e.samples, n_burn + 1, hmc.chain_fingerprint(step_size, n_leapfrog, n_burn, random_step, config))
+				collected = e.samples
+			else:
+				samples, ic, n_samples, n_burn, return_first = samples + e.samples, state, n_samples - len(e.samples), 0, False
+				collected = samples
+			n_stalled = n_stalled + 1 if len(collected) == n_collected else 0
+			n_collected = len(collected)
+			if n_stalled > max_restarts:
+				print(f'Chain keeps diverging, returning its {len(collected)} samples')
+				return collected
+		except CheckpointMismatch:
+			raise # restarting would not help
+		except:
+			if stats is not None:
+				stats.count('restarts')
+			n_errors += 1
+			print(f'Worker errored! (attempt {n_errors} of {max_restarts+1})')
+			print(traceback.format_exc())
+			if n_errors > max_restarts:
+				break
+			if checkpoint is not None and os.path.exists(checkpoint):
+				print('Restarting from last checkpoint')
+		attempt += 1
+	if checkpoint is not None and os.path.exists(checkpoint):
+		return hmc.load_chain(checkpoint)[1]
+	return samples
+
+def _check_checkpoints(checkpoint_dir: Any, n_chains: int, step_size: float, n_leapfrog: int, n_burn: int, random_step: bool, config: Any):
+	''' Refuses to resume chain checkpoints written with other settings, before any chain starts '''
+	if checkpoint_dir is None:
+		return
+	fp = hmc.chain_fingerprint(step_size, n_leapfrog, n_burn, random_step, config)
+	for i in range(n_chains):
+		checkpoint = os.path.join(checkpoint_dir, f'chain_{i}.pt')
+		if os.path.exists(checkpoint):
+			check_fingerprint(checkpoint, load_checkpoint(checkpoint), fp)
 
 def sample(
 		n_samples: int, initial_conditions: list, potential: Callable, boundary: Callable,
 		step_size=0.03, n_leapfrog=10, n_burn=10, random_step=False, debug=False, return_first=False, 
-		deterministic=True
+		deterministic=True, checkpoint_dir=None, max_restarts=3, 
+		target_ess=None, annotate=None, check_every=None, return_diagnostics=False, stats=None, trace_dir=None, surrogate=None, max_divergences=None,
+		config=None
 	):
+	'''
+	checkpoint_dir: (optional) directory holding one checkpoint per chain; an interrupted run resumes from it
+	config: (optional) dict of further settings (e.g. of the potential) which checkpoints must match, along with the HMC settings
+		(CheckpointMismatch is raised otherwise)
+	max_restarts: times a failed chain is restarted (from its last checkpoint, if any) before it is dropped
+	target_ess: (optional) stop all chains once the bulk & tail ESS of every diagnosed quantity reach this
+	annotate: (optional) scalar function of a sample (e.g. distance to the nominal) diagnosed along with the sample entries
+	check_every: accepted samples between diagnostic updates (default: once per round of all chains)
+	return_diagnostics: also return the last diagnostics (split R-hat, bulk/tail ESS; see sampler.diagnostics)
+	stats: (optional) sampler.stats.Stats into which the stats of every finished chain are merged (acceptance is recorded per chain)
+	trace_dir: (optional) directory receiving a torch.profiler Chrome trace per chain
+	surrogate: (optional) cheap approximation of the potential for delayed acceptance (see sampler.hmc.sample)
+	max_divergences: (optional) consecutive divergent proposals after which a chain continues from another chain's latest state
+	'''
+	if target_ess is not None or return_diagnostics:
+		return _sample_diagnosed(
+			n_samples, initial_conditions, potential, boundary, step_size, n_leapfrog, n_burn, random_step, debug, return_first,
+			deterministic, checkpoint_dir, max_restarts, target_ess, annotate, check_every, return_diagnostics, stats, trace_dir, surrogate, max_divergences,
+			config
+		)
+
+	_check_checkpoints(checkpoint_dir, len(initial_conditions), step_size, n_leapfrog, n_burn, random_step, config)
 	potential, boundary = cloudpickle.dumps(potential), cloudpickle.dumps(boundary)
+	surrogate = cloudpickle.dumps(surrogate) if surrogate is not None else None
+	for directory in [checkpoint_dir, trace_dir]:
+		if directory is not None:
+			os.makedirs(directory, exist_ok=True)
 
 	samples = []
 	with tqdm(total=n_samples*len(initial_conditions), desc='Parallel HMC') as pbar:
 
-		def add_samples(results: list):
-			samples.extend(results)
-			pbar.update(len(results))
+		def add_samples(results: tuple):
+			chain_samples, chain_stats = results
+			samples.extend(chain_samples)
+			if stats is not None:
+				stats.merge(chain_stats)
+			pbar.update(len(chain_samples))
 
-		with multiprocessing.Pool() as pool:
+		with multiprocessing.Manager() if max_divergences is not None else nullcontext() as manager, multiprocessing.Pool() as pool:
+			healthy = manager.dict() if manager is not None else None
 			for i, ic in enumerate(initial_conditions):
 				seed = 1000+i if deterministic else None
+				checkpoint = os.path.join(checkpoint_dir, f'chain_{i}.pt') if checkpoint_dir is not None else None
+				trace = os.path.join(trace_dir, f'chain_{i}.json') if trace_dir is not None else None
 				pool.apply_async(worker, args=(
-					n_samples, ic, potential, boundary, step_size, n_leapfrog, n_burn, random_step, debug, return_first, seed
+					n_samples, ic, potential, boundary, step_size, n_leapfrog, n_burn, random_step, debug, return_first, seed, checkpoint, max_restarts, trace,
+					None, i, None, surrogate, max_divergences, healthy, config
 				), callback=add_samples)
 			pool.close()
 			pool.join()
 
 	return samples
 
+def _diagnose(chains: list, values: list):
+	''' Diagnostics over the common prefix of all chains '''
+	n = min(len(c) for c in chains)
+	if len(chains) < 2 or n < 4:
+		return None
+	x = np.stack([np.stack([np.concatenate([w.reshape(-1).numpy() for w in s]) for s in c[:n]]) for c in chains])
+	if values[0][0] is not None:
+		x = np.concatenate((x, np.array([v[:n] for v in values])[:, :, None]), axis=2)
+	result = diagnostics.summarize(x)
+	result['n_draws'] = n
+	return result
+
+def _sample_diagnosed(
+		n_samples: int, initial_conditions: list, potential: Callable, boundary: Callable,
+		step_size: float, n_leapfrog: int, n_burn: int, random_step: bool, debug: bool, return_first: bool,
+		deterministic: bool, checkpoint_dir: Any, max_restarts: int, target_ess: Any, annotate: Any, check_every: Any, return_diagnostics: bool,
+		stats: Any, trace_dir: Any, surrogate: Any, max_divergences: Any, config: Any
+	):
+	check_every = len(initial_conditions) if check_every is None else check_every
+	chains = [[] for _ in initial_conditions]
+	values = [[] for _ in initial_conditions]
+	result = None
+	for n, (i, s, v) in enumerate(stream(
+			n_samples, initial_conditions, potential, boundary, annotate=annotate, step_size=step_size, n_leapfrog=n_leapfrog, n_burn=n_burn, 
+			random_step=random_step, debug=debug, return_first=return_first, deterministic=deterministic, checkpoint_dir=checkpoint_dir, max_restarts=max_restarts,
+			stats=stats, trace_dir=trace_dir, surrogate=surrogate, max_divergences=max_divergences, config=config
+		)):
+		chains[i].append(s)
+		values[i].append(v)
+		if (n+1) % check_every == 0:
+			result = _diagnose(chains, values) or result
+			if debug and result is not None:
+				print('Diagnostics:', result)
+			if target_ess is not None and result is not None and min(result['ess_bulk'], result['ess_tail']) >= target_ess:
+				print(f'Target ESS {target_ess} reached after {n+1} samples, stopping chains.')
+				break
+	result = _diagnose(chains, values) or result
+
+	samples = [s for c in chains for s in c]
+	return (samples, result) if return_diagnostics else samples
+
+def stream(
+		n_samples: int, initial_conditions: list, potential: Callable, boundary: Callable, annotate=None, max_queue=1000,
+		step_size=0.03, n_leapfrog=10, n_burn=10, random_step=False, debug=False, return_first=False, 
+		deterministic=True, checkpoint_dir=None, max_restarts=3, stats=None, trace_dir=None, surrogate=None, max_divergences=None, config=None
+	):
+	'''
+	Generator variant of `sample` which yields (chain index, sample, annotate(sample)) as soon as any chain accepts a proposal.
+
+	annotate: (optional) function of an accepted sample evaluated in the worker (e.g. its distance to the nominal)
+	max_queue: maximum number of samples buffered between workers and the consumer; workers block when it is full
+	stats: (optional) sampler.stats.Stats into which the stats of each chain are merged as it finishes
+	'''
+	_check_checkpoints(checkpoint_dir, len(initial_conditions), step_size, n_leapfrog, n_burn, random_step, config)
+	potential, boundary = cloudpickle.dumps(potential), cloudpickle.dumps(boundary)
+	annotate = cloudpickle.dumps(annotate) if annotate is not None else None
+	surrogate = cloudpickle.dumps(surrogate) if surrogate is not None else None
+	for directory in [checkpoint_dir, trace_dir]:
+		if directory is not None:
+			os.makedirs(directory, exist_ok=True)
+
+	with multiprocessing.Manager() as manager, multiprocessing.Pool() as pool:
+		queue = manager.Queue(max_queue)
+		healthy = manager.dict() if max_divergences is not None else None
+		for i, ic in enumerate(initial_conditions):
+			seed = 1000+i if deterministic else None
+			checkpoint = os.path.join(checkpoint_dir, f'chain_{i}.pt') if checkpoint_dir is not None else None
+			trace = os.path.join(trace_dir, f'chain_{i}.json') if trace_dir is not None else None
+			pool.apply_async(worker, args=(
+				n_samples, ic, potential, boundary, step_size, n_leapfrog, n_burn, random_step, debug, return_first, seed, checkpoint, max_restarts, trace,
+				queue, i, annotate, surrogate, max_divergences, healthy, config
+			))
+		pool.close()
+
+		n_running = len(initial_conditions)
+		with tqdm(total=n_samples*len(initial_conditions), desc='Parallel HMC') as pbar:
+			while n_running > 0:
+				i, sample, value = queue.get()
+				if sample is None:
+					n_running -= 1
+					if stats is not None and value is not None:
+						stats.merge(value)
+					continue
+				pbar.update(1)
+				yield i, tuple(torch.from_numpy(x) for x in sample), value
+		pool.join()
+
 if __name__ == '__main__':
+	import tempfile
 	import scipy.stats as stats
 	import sampler.reflections as reflections
 
@@ -86,6 +312,51 @@ if __name__ == '__main__':
 	# plt.plot(-ones,x,color='black')
 	# plt.legend()
 
+	# Divergence restart: the chain started inside a stiff wall diverges on every proposal, then continues from the other chain
+	stiff = lambda params: 0.5*(params[0]**2).sum() + 1e6*torch.relu(params[0] - 2).pow(2).sum()
+	run_stats = Stats()
+	samples = sample(
+		100, [(torch.zeros(1),), (torch.full((1,), 3.),)], stiff, reflections.nil_boundary, step_size=0.5, n_leapfrog=5, n_burn=0,
+		max_divergences=5, stats=run_stats
+	)
+	assert len(samples) == 200 and all(x.item() < 2 for (x,) in samples), 'diverged chain did not continue from the healthy one'
+	print(f"{run_stats.counts['divergence_restarts']} divergence restart(s), {run_stats.counts['divergences']} divergent proposals")
+
+	# A chain which keeps diverging without a healthy chain to continue from returns the samples it collected
+	calls = [0]
+	def breaking(params):
+		calls[0] += 1
+		return 0.5*(params[0]**2).sum() * (1 if calls[0] < 200 else float('nan'))
+	samples = _run_chain(
+		100, (torch.zeros(1),), breaking, reflections.nil_boundary, 0.5, 5, 0, False, False, False,
+		9001, None, 2, None, max_divergences=5
+	)
+	assert 0 < len(samples) < 100, 'diverging chain lost its samples'
+	print(f'Diverging chain returned its {len(samples)} samples')
+
+	# Streamed samples: a resumed chain emits its checkpoint's samples, and a restarted chain does not repeat its initial condition
+	gaussian = lambda params: 0.5*(params[0]**2).sum()
+	checkpoint = os.path.join(tempfile.mkdtemp(), 'chain_0.pt')
+	_run_chain(30, (torch.zeros(2),), gaussian, reflections.nil_boundary, 0.3, 5, 5, False, False, True, 9001, checkpoint, 2, None)
+	emitted = []
+	samples = _run_chain(50, (torch.zeros(2),), gaussian, reflections.nil_boundary, 0.3, 5, 5, False, False, True, 9001, checkpoint, 2, emitted.append)
+	assert len(emitted) == 50 and all(torch.equal(e[0], s[0]) for e, s in zip(emitted, samples)), 'resumed chain lost streamed samples'
+	try:
+		_check_checkpoints(os.path.dirname(checkpoint), 1, 0.3, 5, 5, False, {'beta': 2.})
+		assert False, 'resumed a checkpoint written with other settings'
+	except CheckpointMismatch:
+		pass
+	calls = [0]
+	def flaky(params):
+		calls[0] += 1
+		if calls[0] == 150:
+			raise RuntimeError('Simulated worker error')
+		return gaussian(params)
+	emitted = []
+	_run_chain(40, (torch.zeros(2),), flaky, reflections.nil_boundary, 0.3, 5, 0, False, False, True, 9001, None, 2, emitted.append)
+	assert len(emitted) == 40, 'restarted chain streamed duplicate samples'
+	print('Streamed samples survive resumes & restarts')
+
 	# Gaussian test
 	mean = torch.Tensor([0.,0.,0.])
 	var = torch.Tensor([.5,1.,2.])**2
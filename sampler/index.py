@@ -0,0 +1,152 @@
+'''
+Vantage-point tree over an uncertainty set for radius and nearest-neighbor queries in the normalized PF-kernel distance.
+
+The normalized distance sqrt(1 - K(x,y)^2 / K(x,x)K(y,y)) is the sine of the angle between feature-space lines,
+which satisfies the triangle inequality; subtrees are pruned with it so most samples are never evaluated.
+'''
+import heapq
+import random
+import numpy as np
+import torch
+
+from sampler.kernel import PFKernel
+from sampler.pairwise import block_distances
+
+class MetricIndex:
+	def __init__(self, samples: list, K: PFKernel, leaf_size=32, block_size=64):
+		'''
+		samples: list of d x d operators (or an N x d x d tensor)
+		K: kernel used for the distance
+		leaf_size: samples per leaf, whose distances are evaluated in one batch
+		'''
+		P = torch.stack(tuple(samples)) if type(samples) == list else samples
+		self.K = K
+		self.N = P.shape[0]
+		self.leaf_size = leaf_size
+		self.block_size = block_size
+		self.n_evals = 0 # kernel evaluations made by queries
+		with torch.no_grad():
+			self.A = K.powers(P.detach().float().cpu())
+			self.diag = K.self_gram(self.A)
+		self.root = self._build(np.arange(self.N))
+
+	def _distances(self, a: torch.Tensor, diag_a: torch.Tensor, idx: np.ndarray):
+		idx = torch.from_numpy(np.asarray(idx))
+		return torch.cat([
+			block_distances(self.K, a, self.A[idx[i:i+self.block_size]], diag_a, self.diag[idx[i:i+self.block_size]])[0]
+			for i in range(0, len(idx), self.block_size)
+		]).numpy()
+
+	def _build(self, idx: np.ndarray):
+		# Nodes are either ('leaf', indices) or ('node', vantage point, median distance, inner, outer)
+		if len(idx) <= self.leaf_size:
+			return ('leaf', idx)
+		j = random.randrange(len(idx))
+		vp, rest = idx[j], np.delete(idx, j)
+		d = self._distances(self.A[[vp]], self.diag[[vp]], rest)
+		mu = np.median(d)
+		return ('node', vp, mu, self._build(rest[d <= mu]), self._build(rest[d > mu]))
+
+	def _query_powers(self, P: torch.Tensor):
+		with torch.no_grad():
+			a = self.K.powers(P.detach().float().cpu().unsqueeze(0))
+			return a, self.K.self_gram(a)
+
+	def radius(self, P: torch.Tensor, r: float):
+		'''
+		Indices and distances of all samples within distance r of operator P.
+		'''
+		a, diag_a = self._query_powers(P)
+		found, dists = [], []
+		stack = [self.root]
+		while stack:
+			node = stack.pop()
+			if node[0] == 'leaf':
+				if len(node[1]) == 0:
+					continue
+				d = self._distances(a, diag_a, node[1])
+				self.n_evals += len(node[1])
+				found.extend(node[1][d <= r])
+				dists.extend(d[d <= r])
+			else:
+				_, vp, mu, inner, outer = node
+				d = self._distances(a, diag_a, [vp])[0]
+				self.n_evals += 1
+				if d <= r:
+					found.append(vp)
+					dists.append(d)
+				if d - r <= mu: stack.append(inner)
+				if d + r > mu: stack.append(outer)
+		order = np.argsort(dists)
+		return np.asarray(found, dtype=int)[order], np.asarray(dists)[order]
+
+	def nearest(self, P: torch.Tensor, k: int):
+		'''
+		Indices and distances of the k samples closest to operator P.
+		'''
+		a, diag_a = self._query_powers(P)
+		heap = [] # max-heap of (-distance, index) holding the current k best
+		tau = lambda: -heap[0][0] if len(heap) == k else float('inf')
+
+		def push(d, i):
+			if len(heap) < k:
+				heapq.heappush(heap, (-d, i))
+			elif d < tau():
+				heapq.heapreplace(heap, (-d, i))
+
+		def search(node):
+			if node[0] == 'leaf':
+				if len(node[1]) == 0:
+					return
+				d = self._distances(a, diag_a, node[1])
+				self.n_evals += len(node[1])
+				for di, i in zip(d, node[1]):
+					push(di, i)
+			else:
+				_, vp, mu, inner, outer = node
+				d = self._distances(a, diag_a, [vp])[0]
+				self.n_evals += 1
+				push(d, vp)
+				first, second = (inner, outer) if d <= mu else (outer, inner)
+				search(first)
+				if np.abs(d - mu) <= tau():
+					search(second)
+
+		search(self.root)
+		result = sorted((-nd, i) for (nd, i) in heap)
+		return np.array([i for (_, i) in result], dtype=int), np.array([d for (d, _) in result])
+
+'''
+Tests
+'''
+if __name__ == '__main__':
+	import time
+	from sampler.utils import set_seed
+
+	set_seed(9001)
+
+	d, m, T, N = 4, 2, 20, 4000
+	K = PFKernel('cpu', d, m, T)
+	nominal = torch.randn(d, d) / np.sqrt(d)
+	samples = nominal + 5e-2*torch.randn(N, d, d)*torch.rand(N, 1, 1)
+
+	start = time.perf_counter()
+	index = MetricIndex(samples, K)
+	print(f'Built index over {N} samples in {time.perf_counter() - start:.2f}s')
+
+	query = nominal + 1e-2*torch.randn(d, d)
+	with torch.no_grad():
+		a = K.powers(query.unsqueeze(0))
+		exact = index._distances(a, K.self_gram(a), np.arange(N))
+
+	for r in [0.05, 0.1, 0.2]:
+		index.n_evals = 0
+		start = time.perf_counter()
+		idx, dists = index.radius(query, r)
+		print(f'radius={r}: {len(idx)} samples, {index.n_evals} evaluations, {time.perf_counter() - start:.3f}s')
+		assert set(idx) == set(np.nonzero(exact <= r)[0]), 'radius query mismatch'
+
+	index.n_evals = 0
+	idx, dists = index.nearest(query, 10)
+	print(f'10-nearest: {index.n_evals} evaluations')
+	assert np.allclose(dists, np.sort(exact)[:10]), 'nearest query mismatch'
@@ -1,8 +1,12 @@
+import math
+import warnings
+from typing import Any
 import torch
 from sampler.utils import is_semistable
+from sampler.lowrank import LowRankOperator, is_lowrank
 
 class PFKernel:
-	def __init__(self, device: torch.device, d: int, m: int, T: int, L=0.):
+	def __init__(self, device: torch.device, d: int, m: int, T: int, L=0., adjoint=False, checkpoint_every=None):
 		'''
 		TODOs: 
 		* allocate less memory
@@ -12,11 +16,23 @@ class PFKernel:
 		m: see paper
 		T: see paper
 		L: discounting factor
+		adjoint: differentiate through PowerSumMinors (bounded-memory hand-written backward) instead of autograd; low-rank
+			operands always take the factored path (see `factored`) with autograd, so it does not apply to them
+		checkpoint_every: power series terms stored for the adjoint backward pass (default sqrt(T))
 		'''
 		self.device = device
 		self.d = d
+		self.m = m
 		self.T = T
 		self.expL = torch.exp(torch.Tensor([-L]))
+		self.adjoint = adjoint
+		self.checkpoint_every = checkpoint_every if checkpoint_every is not None else max(1, int(math.sqrt(T)))
+		self._subindex = None # minor selectors, built on first dense evaluation (C(d,m)^2 entries)
+		self._combinations = None # m-subsets of indices (C(d,m) entries), for chunked evaluation
+		self._warned_adjoint = False
+
+	def _build_subindex(self):
+		d, m, device = self.d, self.m, self.device
 		with torch.no_grad():
 			index = torch.arange(d, device=device).expand(m, -1)
 			product = torch.meshgrid(index.unbind())
@@ -24,24 +40,238 @@ class PFKernel:
 			subindex = (torch.masked_select(x, mask) for x in product) # select unique combinations
 			subindex = torch.stack(tuple(subindex)).t() # submatrix index I in paper
 			n = subindex.shape[0]
-			self.subindex_row = subindex.unsqueeze(1).repeat(1, n, 1).view(n*n, -1) # row selector
-			self.subindex_col = subindex.unsqueeze(1).repeat(n, 1, 1).view(n*n, -1) 
-			self.subindex_col = self.subindex_col.t().repeat(m, 1, 1).permute(2, 0, 1) # column selector different due to Torch API
+			subindex_row = subindex.unsqueeze(1).repeat(1, n, 1).view(n*n, -1) # row selector
+			subindex_col = subindex.unsqueeze(1).repeat(n, 1, 1).view(n*n, -1) 
+			subindex_col = subindex_col.t().repeat(m, 1, 1).permute(2, 0, 1) # column selector different due to Torch API
+		return subindex_row, subindex_col
 
 	def __call__(self, P1: torch.Tensor, P2: torch.Tensor, normalize=False):
 		# P1, P2 must be square and same shape
 		# assert P1.shape == (self.d, self.d) and P2.shape == P1.shape
 		if normalize:
 			return torch.sqrt((1 - self.__call__(P1, P2).pow(2) / (self.__call__(P1, P1) * self.__call__(P2, P2))).clamp(1e-8)) # clamp to prevent subgradient/NaN issue around sqrt(0)
+		elif is_lowrank(P1) or is_lowrank(P2):
+			if self.adjoint and not self._warned_adjoint:
+				warnings.warn('adjoint=True does not apply to low-rank operands; differentiating their factored kernel with autograd')
+				self._warned_adjoint = True
+			return self.factored(LowRankOperator.of(P1), LowRankOperator.of(P2))
+		elif self.adjoint:
+			return PowerSumMinors.apply(P1, P2, self, self.checkpoint_every)
 		else:
 			sum_powers = torch.eye(self.d, device=self.device)
 			power = torch.eye(self.d, device=self.device)
 			for t in range(self.T-1):
-				power = P1@power@P2.t() * self.expL
-				sum_powers += power 
-			submatrices = torch.gather(sum_powers[self.subindex_row], 2, self.subindex_col) 
-			result = submatrices.det().sum()
-			return result
+				power = P1@power@P2.transpose(-1, -2) * self.expL # batched over leading dimensions of either operand
+				sum_powers = sum_powers + power 
+			return self.sum_minors(sum_powers)
+
+	def sum_minors(self, S: torch.Tensor):
+		'''
+		Sum of all m x m minors of S (..., d, d), batched over leading dimensions.
+		'''
+		if self._subindex is None:
+			self._subindex = self._build_subindex()
+		subindex_row, subindex_col = self._subindex
+		rows = S[..., subindex_row, :]
+		cols = subindex_col.expand(rows.shape[:-1] + (subindex_col.shape[-1],))
+		submatrices = torch.gather(rows, -1, cols)
+		return submatrices.det().sum(-1)
+
+	def _minor_blocks(self, S: torch.Tensor, max_elements: int):
+		# Row & column index sets of all m x m minors, in blocks of row sets whose submatrices of S have <= max_elements entries
+		if self._combinations is None:
+			self._combinations = torch.combinations(torch.arange(self.d, device=S.device), self.m)
+		I = self._combinations.to(S.device)
+		n = I.shape[0]
+		block = max(1, max_elements // (n * self.m**2 * (S.numel() // (self.d*self.d))))
+		for i in range(0, n, block):
+			yield I[i:i+block, None, :, None], I[None, :, None, :] # (b, 1, m, 1), (1, n, 1, m)
+
+	def sum_minors_chunked(self, S: torch.Tensor, max_elements=2**22):
+		'''
+		sum_minors without the C(d,m)^2 selectors, gathering submatrices in blocks of <= max_elements entries
+		(closed form G^T S G / 2 for m = 2).
+		'''
+		if self.m == 2:
+			return 0.5 * (_sign_conj(S) * S).sum((-1, -2))
+		total = 0.
+		for rows, cols in self._minor_blocks(S, max_elements):
+			total = total + S[..., rows, cols].det().sum((-1, -2))
+		return total
+
+	def sum_minors_grad(self, S: torch.Tensor, max_elements=2**22):
+		'''
+		Gradient of sum_minors w.r.t. S (..., d, d): the cofactors of every minor, added to the entries they come from.
+		'''
+		if self.m == 2:
+			return _sign_conj(S)
+		batch = S.shape[:-2]
+		grad = torch.zeros(batch + (self.d*self.d,), device=S.device, dtype=S.dtype)
+		for rows, cols in self._minor_blocks(S, max_elements):
+			C = _cofactors(S[..., rows, cols])
+			index = (rows*self.d + cols).expand(C.shape[-4:])
+			grad.index_add_(-1, index.reshape(-1), C.reshape(batch + (-1,)))
+		return grad.view(batch + (self.d, self.d))
+
+	def factored(self, P1: LowRankOperator, P2: LowRankOperator):
+		'''
+		Kernel value of low-rank operators P = U V^T (batched over leading dimensions of the factors).
+		The power sum is S = I + U1 M U2^T with the r1 x r2 core series M = sum_{t>=1} e^{-Lt} C1^(t-1) V1^T V2 (C2^T)^(t-1),
+		C = V^T U, so it costs O(T r^3 + d r^2) instead of O(T d^3). For m = 2 the sum of minors is also evaluated in factored form.
+		'''
+		expL = self.expL.to(P1.device)
+		C1, C2t = P1.core(), P2.core().transpose(-1, -2)
+		X = P1.V.transpose(-1, -2) @ P2.V * expL
+		M = X if self.T > 1 else torch.zeros_like(X)
+		for t in range(self.T-2):
+			X = C1@X@C2t * expL
+			M = M + X
+		L, R = P1.U, P2.U @ M.transpose(-1, -2)
+		if self.m == 2:
+			return sum_minors2_lowrank(L, R)
+		return self.sum_minors(torch.eye(self.d, device=L.device, dtype=L.dtype) + L @ R.transpose(-1, -2))
+
+	def sweep(self, P1: torch.Tensor, P2: torch.Tensor, Ts: list, Ls: list, normalize=False):
+		'''
+		Kernel values for every horizon in Ts and discount in Ls from a single power series up to max(Ts),
+		with shape (len(Ls), len(Ts)) and horizons in increasing order. The discounted partial sums of all Ls are accumulated together and their minors
+		are taken whenever t reaches a horizon, so the result matches PFKernel(device, d, m, T, L)(P1, P2) for each (L, T).
+		'''
+		Ts = sorted(Ts)
+		Ls = torch.as_tensor(Ls, dtype=P1.dtype, device=P1.device)
+		if normalize:
+			A, B = torch.stack((P1, P1, P2)), torch.stack((P2, P1, P2)) # K(P1, P2), K(P1, P1), K(P2, P2) in one series
+		else:
+			A, B = P1.unsqueeze(0), P2.unsqueeze(0)
+		# Powers are discounted by the smallest L, so the other sums' extra weights are <= 1
+		L_min = Ls.min()
+		expL_min, weight_step = torch.exp(-L_min), torch.exp(-(Ls - L_min)).view(-1, 1, 1)
+		power = torch.eye(self.d, device=P1.device, dtype=P1.dtype).expand(A.shape)
+		weights = torch.ones_like(weight_step)
+		sum_powers = power.unsqueeze(1).repeat(1, len(Ls), 1, 1) # (pairs, Ls, d, d)
+		values = []
+		for t in range(1, Ts[-1]+1):
+			while len(values) < len(Ts) and Ts[len(values)] == t:
+				values.append(self.sum_minors(sum_powers))
+			if len(values) == len(Ts):
+				break
+			power = A@power@B.transpose(-1, -2) * expL_min
+			weights = weights * weight_step
+			sum_powers = sum_powers + weights * power.unsqueeze(1)
+		k = torch.stack(values, dim=-1) # (pairs, Ls, Ts)
+		if normalize:
+			return torch.sqrt((1 - k[0].pow(2) / (k[1] * k[2])).clamp(1e-8))
+		return k[0]
+
+	def powers(self, P: torch.Tensor):
+		'''
+		Discounted power sequence exp(-Lt/2) P^t for t < T of P (..., d, d), with shape (..., T, d, d).
+		Kernel values between operators only depend on these, so they can be computed once per operator.
+		'''
+		scale = torch.sqrt(self.expL).to(P.device)
+		power = torch.eye(self.d, device=P.device).expand(P.shape)
+		seq = [power]
+		for t in range(self.T-1):
+			power = P@power * scale
+			seq.append(power)
+		return torch.stack(seq, dim=-3)
+
+	def gram(self, A1: torch.Tensor, A2: torch.Tensor):
+		'''
+		Kernel values between every pair from two batches of power sequences A1 (N1, T, d, d), A2 (N2, T, d, d).
+		'''
+		S = torch.einsum('itab,jtcb->ijac', A1, A2)
+		return self.sum_minors(S)
+
+	def self_gram(self, A: torch.Tensor):
+		'''
+		Kernel values K(P, P) for a batch of power sequences A (N, T, d, d).
+		'''
+		S = torch.einsum('itab,itcb->iac', A, A)
+		return self.sum_minors(S)
+
+class PowerSumMinors(torch.autograd.Function):
+	'''
+	Unnormalized PF kernel value k = sum of m x m minors of S = sum_{t<T} e^{-Lt} P1^t (P2^t)^T, with a hand-written backward.
+
+	dk/dS is the scatter of each minor's cofactors (for m = 2, G^T S G with G_ij = sign(j - i)), and gradients w.r.t. P1, P2
+	follow from the adjoint recursion Lambda_t = dk/dS + e^{-L} P1^T Lambda_{t+1} P2 over X_t = e^{-L} P1 X_{t-1} P2^T.
+	Only every `checkpoint_every`-th X_t is stored; the others are recomputed segment-wise during the backward pass,
+	so memory is O((T/c + c) d^2) instead of growing with T and C(d, m)^2 as with autograd.
+	'''
+	@staticmethod
+	def forward(ctx, P1: torch.Tensor, P2: torch.Tensor, K: 'PFKernel', checkpoint_every: int):
+		expL = K.expL.to(P1.device, P1.dtype)
+		X = torch.eye(K.d, device=P1.device, dtype=P1.dtype).expand(torch.broadcast_shapes(P1.shape, P2.shape))
+		S, checkpoints = X.clone(), [X]
+		for t in range(1, K.T):
+			X = P1@X@P2.transpose(-1, -2) * expL
+			S = S + X
+			if t % checkpoint_every == 0:
+				checkpoints.append(X)
+		ctx.K, ctx.checkpoint_every = K, checkpoint_every
+		ctx.save_for_backward(P1, P2, S, *checkpoints)
+		return K.sum_minors_chunked(S)
+
+	@staticmethod
+	def backward(ctx, g: torch.Tensor):
+		P1, P2, S, *checkpoints = ctx.saved_tensors
+		K, c = ctx.K, ctx.checkpoint_every
+		expL = K.expL.to(P1.device, P1.dtype)
+		G = K.sum_minors_grad(S) * g.unsqueeze(-1).unsqueeze(-1) # dk/dS
+		P1t, P2t = P1.transpose(-1, -2), P2.transpose(-1, -2)
+
+		# Transitions t = end, ..., start+1 of each segment, from the last; X_{t-1} is recomputed from the segment's checkpoint
+		dP1, dP2 = 0., 0. # batched over leading dimensions, summed over those an operand was broadcast along
+		Lambda = None
+		for j in range((K.T-2) // c, -1, -1):
+			start, end = j*c, min((j+1)*c, K.T-1)
+			X = [checkpoints[j]]
+			for t in range(start+1, end):
+				X.append(P1@X[-1]@P2t * expL)
+			for t in range(end, start, -1):
+				Lambda = G if Lambda is None else G + P1t@Lambda@P2 * expL # Lambda_t = dk/dX_t
+				dP1 = dP1 + Lambda@P2@X[t-1-start].transpose(-1, -2) * expL
+				dP2 = dP2 + Lambda.transpose(-1, -2)@P1@X[t-1-start] * expL
+		dP1 = _unbroadcast(dP1, P1) if ctx.needs_input_grad[0] else None
+		dP2 = _unbroadcast(dP2, P2) if ctx.needs_input_grad[1] else None
+		return dP1, dP2, None, None
+
+def _sign_sum(X: torch.Tensor):
+	# G X for the antisymmetric sign matrix G_ij = sign(j - i), along dimension -2
+	c = X.cumsum(-2)
+	return c[..., -1:, :] - 2*c + X
+
+def _unbroadcast(grad: Any, x: torch.Tensor):
+	# Gradient of a batched expression w.r.t. x, which was broadcast along the leading dimensions
+	if not isinstance(grad, torch.Tensor):
+		return torch.zeros_like(x)
+	while grad.dim() > x.dim():
+		grad = grad.sum(0)
+	return grad
+
+def _sign_conj(S: torch.Tensor):
+	# G^T S G = G S G^T for the antisymmetric sign matrix G; the gradient of the sum of 2 x 2 minors of S
+	return _sign_sum(_sign_sum(S).transpose(-1, -2)).transpose(-1, -2)
+
+def _cofactors(A: torch.Tensor):
+	# Cofactor matrices of (..., m, m) from their (m-1) x (m-1) minors, so singular matrices are handled exactly
+	m = A.shape[-1]
+	if m == 1:
+		return torch.ones_like(A)
+	keep = torch.tensor([[k for k in range(m) if k != i] for i in range(m)], device=A.device)
+	signs = torch.tensor([[(-1.)**(i+j) for j in range(m)] for i in range(m)], device=A.device, dtype=A.dtype)
+	return A[..., keep[:, None, :, None], keep[None, :, None, :]].det() * signs
+
+def sum_minors2_lowrank(L: torch.Tensor, R: torch.Tensor):
+	'''
+	Sum of all 2 x 2 minors of I + L R^T for L, R (..., d, r), in O(d r^2).
+	The sum of 2 x 2 minors of S is tr(G^T S G S^T) / 2 with G_ij = sign(j - i), which expands over the low-rank term.
+	'''
+	d = L.shape[-2]
+	GL, GR = _sign_sum(L), _sign_sum(R)
+	LGL, RGR = L.transpose(-1, -2) @ GL, R.transpose(-1, -2) @ GR
+	return 0.5 * (d*(d-1) + 2*(GL*GR).sum((-1, -2)) - (LGL * RGR.transpose(-1, -2)).sum((-1, -2)))
 
 '''
 Tests for P-F kernel
@@ -83,4 +313,28 @@ if __name__ == '__main__':
 	print('L:', L.item())
 	K = PFKernel(device, d, m, T, L=L)
 	x = K(A, A, normalize=True)
-	print('K(A, A) = ', x.item())
\ No newline at end of file
+	print('K(A, A) = ', x.item())
+	print('Horizon & discount sweep')
+	d, Ts, Ls = 10, [10, 20, 80], [0., 0.1, 0.5]
+	set_seed(9001)
+	A = torch.randn(d, d, device=device)
+	A = 0.9 * A / spectral_radius(A) # stable, so the float32 series neither overflows nor cancels at T = 80
+	B = A + 0.05*torch.randn(d, d, device=device)
+	B = 0.9 * B / spectral_radius(B)
+	K = PFKernel(device, d, 2, max(Ts))
+	x = K.sweep(A, B, Ts, Ls, normalize=True)
+	for i, L in enumerate(Ls):
+		for j, T in enumerate(Ts):
+			y = PFKernel(device, d, 2, T, L=L)(A, B, normalize=True)
+			assert torch.allclose(x[i, j], y, rtol=1e-4, atol=1e-6), f'sweep mismatch at T={T}, L={L}'
+	print('K(A, B) over (L, T):', x.tolist())
+
+	print('Adjoint backward')
+	for d, m, T in [(8, 2, 30), (6, 3, 12)]:
+		A = torch.randn(d, d, device=device)
+		A = 0.9 * A / spectral_radius(A)
+		B = (A + 0.05*torch.randn(d, d, device=device)).requires_grad_()
+		(grad,) = torch.autograd.grad(PFKernel(device, d, m, T, L=0.1)(A, B, normalize=True), B)
+		(grad_adjoint,) = torch.autograd.grad(PFKernel(device, d, m, T, L=0.1, adjoint=True, checkpoint_every=4)(A, B, normalize=True), B)
+		assert torch.allclose(grad, grad_adjoint, rtol=1e-3, atol=1e-5), f'adjoint gradient mismatch (d={d}, m={m})'
+	print('Adjoint gradients match autograd')
@@ -0,0 +1,152 @@
+'''
+Low-rank operators P = U V^T, stored as their d x r factors.
+
+Products, rollouts and PF-kernel power series of such operators only need the factors and the r x r core V^T U,
+since P^t = U (V^T U)^(t-1) V^T for t >= 1.
+'''
+import torch
+
+def is_lowrank(P) -> bool:
+	'''
+	Whether P is a factored operator (anything holding factors U & V, like LowRankOperator) rather than a dense tensor.
+	Kernels & rollouts dispatch on this instead of the class, so operators of any copy of this module are recognized.
+	'''
+	return not torch.is_tensor(P) and hasattr(P, 'U') and hasattr(P, 'V')
+
+class LowRankOperator:
+	def __init__(self, U: torch.Tensor, V: torch.Tensor):
+		'''
+		U, V: factors (..., d, r) with P = U V^T
+		'''
+		assert U.shape == V.shape, 'Factors must have the same shape'
+		self.U = U
+		self.V = V
+
+	@staticmethod
+	def from_dense(P: torch.Tensor, rank: int):
+		'''
+		Best rank-r approximation of P (truncated SVD), with singular values split evenly between the factors.
+		'''
+		U, S, Vh = torch.linalg.svd(P.detach())
+		s = S[..., :rank].sqrt().unsqueeze(-2)
+		return LowRankOperator(U[..., :rank] * s, Vh[..., :rank, :].transpose(-1, -2) * s)
+
+	@staticmethod
+	def of(P):
+		'''
+		P as a LowRankOperator (a dense d x d operator is the full-rank factorization P I^T).
+		'''
+		if is_lowrank(P):
+			return P
+		return LowRankOperator(P, torch.eye(P.shape[-1], device=P.device, dtype=P.dtype).expand(P.shape))
+
+	@property
+	def shape(self):
+		return self.U.shape[:-1] + (self.U.shape[-2],)
+
+	@property
+	def rank(self):
+		return self.U.shape[-1]
+
+	@property
+	def device(self):
+		return self.U.device
+
+	def core(self):
+		'''
+		r x r matrix V^T U, whose eigenvalues are the nonzero eigenvalues of P.
+		'''
+		return self.V.transpose(-1, -2) @ self.U
+
+	def dense(self):
+		return self.U @ self.V.transpose(-1, -2)
+
+	def detach(self):
+		return LowRankOperator(self.U.detach(), self.V.detach())
+
+	def t(self):
+		return LowRankOperator(self.V, self.U)
+
+	def __matmul__(self, X: torch.Tensor):
+		return self.U @ (self.V.transpose(-1, -2) @ X)
+
+class LowRankParametrization:
+	def __init__(self, model: torch.Tensor, rank: int):
+		'''
+		Flat parameter vectors x = (vec U, vec V) of rank-r operators around a nominal model.
+		'''
+		self.d, self.rank = model.shape[0], rank
+		self.nominal = LowRankOperator.from_dense(model, rank)
+		self.size = 2 * self.d * rank
+
+	def encode(self):
+		'''
+		Flat parameter vector of the nominal's truncated SVD.
+		'''
+		return torch.cat((self.nominal.U.reshape(-1), self.nominal.V.reshape(-1)))
+
+	def decode(self, x: torch.Tensor):
+		'''
+		LowRankOperator of parameter vectors x (..., size); differentiable.
+		'''
+		n = self.d * self.rank
+		shape = x.shape[:-1] + (self.d, self.rank)
+		return LowRankOperator(x[..., :n].reshape(shape), x[..., n:].reshape(shape))
+
+	def gauge_prior(self, x: torch.Tensor, scale=1.):
+		'''
+		Gaussian potential on the factors around the nominal's. U V^T is invariant to U -> U A, V -> V A^-T,
+		so without it these directions are unbounded random walks.
+		No Jacobian of decode is included: densities over the factors are not densities over P (see `sampler.ugen.perturb`).
+		'''
+		P = self.decode(x)
+		U0, V0 = self.nominal.U.to(x.device), self.nominal.V.to(x.device)
+		return 0.5 * (((P.U - U0) ** 2).sum((-1, -2)) + ((P.V - V0) ** 2).sum((-1, -2))) / scale**2
+
+'''
+Tests
+'''
+if __name__ == '__main__':
+	import time
+	from sampler.kernel import PFKernel
+	from sampler.rollout import lifted_rollout
+	from sampler.utils import set_seed
+
+	set_seed(9001)
+	torch.set_default_dtype(torch.float64)
+
+	# Factored kernel matches the dense kernel (m = 2 closed form & general m)
+	d, r, T = 6, 3, 20
+	P1 = LowRankOperator(torch.randn(d, r) / d**0.5, torch.randn(d, r) / d**0.5)
+	P2 = LowRankOperator(P1.U + 0.1*torch.randn(d, r), P1.V + 0.1*torch.randn(d, r))
+	for m in [2, 3]:
+		K = PFKernel('cpu', d, m, T, L=0.1)
+		dense, factored = K(P1.dense(), P2.dense()), K(P1, P2)
+		print(f'm={m}: dense {dense.item():.6f}, factored {factored.item():.6f}')
+		assert torch.allclose(dense, factored, rtol=1e-8)
+		assert torch.allclose(K(P1.dense(), P2.dense(), normalize=True), K(P1.dense(), P2, normalize=True))
+
+	# Factored rollout gradients match autograd through the dense rollout
+	n = 50
+	U, V = P1.U.clone().requires_grad_(), P1.V.clone().requires_grad_()
+	z0, W = torch.randn(d, 1), torch.randn(d, n-1)
+	lifted_rollout(LowRankOperator(U, V), z0, W).pow(2).sum().backward()
+	dU, dV = U.grad.clone(), V.grad.clone()
+	U.grad, V.grad = None, None
+	Z = [z0.view(-1)]
+	for i in range(n-1):
+		Z.append(U@(V.t()@Z[-1]) + W[:, i])
+	torch.stack(Z, 1).pow(2).sum().backward()
+	assert torch.allclose(dU, U.grad) and torch.allclose(dV, V.grad), 'factored rollout gradient mismatch'
+	print('Factored rollout gradients match')
+
+	# Cost for a large dictionary
+	torch.set_default_dtype(torch.float32)
+	d, r, T = 128, 8, 80
+	K = PFKernel('cpu', d, 2, T)
+	P1 = LowRankOperator(torch.randn(d, r) / d**0.5, torch.randn(d, r) / d**0.5)
+	P2 = LowRankOperator(P1.U + 1e-2*torch.randn(d, r), P1.V + 1e-2*torch.randn(d, r))
+	start = time.perf_counter()
+	for _ in range(100):
+		K(P1, P2, normalize=True)
+	print(f'd={d}, r={r}, T={T}: {1e3*(time.perf_counter() - start)/100:.2f} ms per normalized kernel evaluation')
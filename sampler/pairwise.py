@@ -0,0 +1,155 @@
+'''
+Pairwise normalized PF-kernel distances among the operators of an uncertainty set.
+'''
+import os
+import multiprocessing
+import traceback
+import numpy as np
+import torch
+from tqdm import tqdm
+
+from sampler.kernel import PFKernel
+
+def normalized_distance(K_xy: torch.Tensor, K_xx: torch.Tensor, K_yy: torch.Tensor):
+	'''
+	Same normalization as PFKernel(..., normalize=True), from precomputed kernel values.
+	'''
+	return torch.sqrt((1 - K_xy.pow(2) / (K_xx * K_yy)).clamp(1e-8))
+
+def block_distances(K: PFKernel, A1: torch.Tensor, A2: torch.Tensor, diag1: torch.Tensor, diag2: torch.Tensor):
+	'''
+	A1, A2: power sequences (see PFKernel.powers) of two blocks of operators
+	diag1, diag2: self-kernels K(P, P) of those operators
+	'''
+	with torch.no_grad():
+		return normalized_distance(K.gram(A1, A2), diag1.unsqueeze(1), diag2.unsqueeze(0))
+
+def worker(K: PFKernel, i: int, j: int, A1: np.ndarray, A2: np.ndarray, diag1: np.ndarray, diag2: np.ndarray):
+	try:
+		D = block_distances(K, torch.from_numpy(A1), torch.from_numpy(A2), torch.from_numpy(diag1), torch.from_numpy(diag2))
+		return i, j, D.numpy()
+	except:
+		print('Worker errored!')
+		print(traceback.format_exc())
+		return i, j, None
+
+def distance_matrix(
+		samples: list, K: PFKernel, block_size=16, parallel=True, path=None, show_progress=True
+	):
+	'''
+	Full N x N matrix of normalized PF-kernel distances among `samples`, computed in blocks.
+
+	samples: list of d x d operators (or an N x d x d tensor)
+	K: kernel used for the distance
+	block_size: operators per block; memory scales with block_size^2 * C(d,m)^2
+	parallel: distribute blocks over a process pool
+	path: (optional) .npy file the matrix is written to as blocks finish; an existing file is resumed
+
+	Raises RuntimeError naming the blocks whose workers failed; with `path`, the finished blocks are kept and rerunning
+	with the same `path` computes only the failed ones.
+	'''
+	P = torch.stack(tuple(samples)) if type(samples) == list else samples
+	P = P.detach().float().cpu()
+	N = P.shape[0]
+
+	# Power sequences and self-kernels are computed once per operator
+	with torch.no_grad():
+		A = K.powers(P)
+		diag = K.self_gram(A)
+
+	if path is not None and os.path.exists(path):
+		D = np.load(path, mmap_mode='r+')
+		assert D.shape == (N, N), 'stored distance matrix does not match samples'
+	elif path is not None:
+		D = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=(N, N))
+		D[:] = np.nan
+	else:
+		D = np.full((N, N), np.nan, dtype=np.float32)
+
+	starts = range(0, N, block_size)
+	blocks = [(i, j) for i in starts for j in starts if j >= i and np.isnan(D[i:i+block_size, j:j+block_size]).any()]
+
+	def write_block(result):
+		i, j, B = result
+		if B is not None:
+			if i == j:
+				B = (B + B.T) / 2
+			D[i:i+B.shape[0], j:j+B.shape[1]] = B
+			D[j:j+B.shape[1], i:i+B.shape[0]] = B.T
+		if show_progress: pbar.update(1)
+
+	if show_progress: pbar = tqdm(total=len(blocks), desc='Distance matrix')
+	if parallel:
+		A_np, diag_np = A.numpy(), diag.numpy()
+		with multiprocessing.Pool() as pool:
+			for (i, j) in blocks:
+				pool.apply_async(worker, args=(
+					K, i, j, A_np[i:i+block_size], A_np[j:j+block_size], diag_np[i:i+block_size], diag_np[j:j+block_size]
+				), callback=write_block)
+			pool.close()
+			pool.join()
+	else:
+		for (i, j) in blocks:
+			B = block_distances(K, A[i:i+block_size], A[j:j+block_size], diag[i:i+block_size], diag[j:j+block_size])
+			write_block((i, j, B.numpy()))
+	if show_progress: pbar.close()
+
+	if path is not None:
+		D.flush()
+	failed = [(i, j) for (i, j) in blocks if np.isnan(D[i:i+block_size, j:j+block_size]).any()]
+	if len(failed) > 0:
+		hint = f'; rerun with path={path} to compute only these' if path is not None else ''
+		raise RuntimeError(f'{len(failed)} of {len(blocks)} distance blocks failed (block row/column offsets {failed}){hint}')
+	return D
+
+def load_distance_matrix(path: str):
+	'''
+	Memory-mapped read-only view of a distance matrix written by `distance_matrix`.
+	'''
+	return np.load(path, mmap_mode='r')
+
+'''
+Tests
+'''
+if __name__ == '__main__':
+	import tempfile
+	from sampler.utils import set_seed
+
+	set_seed(9001)
+
+	d, m, T, N = 5, 2, 20, 40
+	K = PFKernel('cpu', d, m, T, L=0.1)
+	nominal = torch.randn(d, d) / np.sqrt(d)
+	samples = [nominal + 1e-2*torch.randn(d, d) for _ in range(N)]
+
+	with tempfile.TemporaryDirectory() as tmp:
+		path = os.path.join(tmp, 'distances.npy')
+		D = distance_matrix(samples, K, block_size=8, path=path)
+		D_serial = distance_matrix(samples, K, block_size=8, parallel=False)
+		D_loaded = load_distance_matrix(path)
+
+		for (i, j) in [(0, 1), (3, 17), (25, 39)]:
+			d_ref = K(samples[i], samples[j], normalize=True).item()
+			print('D[i,j] =', D_loaded[i, j], 'direct =', d_ref)
+			assert np.abs(D_loaded[i, j] - d_ref) < 1e-3
+		assert np.allclose(D_loaded, D_serial, atol=1e-5)
+		assert np.allclose(D_loaded, D_loaded.T)
+
+		# A failed block is reported, and rerunning with the same path fills it
+		path = os.path.join(tmp, 'resumed.npy')
+		_block_distances = block_distances
+		def block_distances(K, A1, A2, diag1, diag2):
+			if A1.shape[0] == 8 and torch.equal(A1, A[8:16]) and torch.equal(A2, A[16:24]):
+				raise RuntimeError('Simulated worker error')
+			return _block_distances(K, A1, A2, diag1, diag2)
+		with torch.no_grad():
+			A = K.powers(torch.stack(samples).float())
+		try:
+			distance_matrix(samples, K, block_size=8, path=path)
+			assert False, 'failed block was not reported'
+		except RuntimeError as e:
+			print(e)
+			assert '(8, 16)' in str(e)
+		block_distances = _block_distances
+		D_resumed = distance_matrix(samples, K, block_size=8, path=path)
+		assert np.allclose(D_resumed, D_serial, atol=1e-5)
@@ -3,94 +3,192 @@ Boundary helper functions
 ''' 
 
 from typing import Callable
+import numpy as np
 import torch
 
 from sampler.utils import *
+import sampler.stats as instrumentation
 
 def nil_boundary(params: tuple, momentum: tuple, step: float):
 	params = zip_with(params, momentum, lambda p, m: p + step*m)
 	return params, momentum, 0.
 
-def lp_boundary(lp: float, vmax=float('inf'), delta=1e-2, offset=0):
+def _l2_exit(y: torch.Tensor, m: torch.Tensor, r: float):
+	# Positive root of |y + t m|^2 = r^2; a start slightly outside the ball (by round-off) moving outward exits immediately
+	a, b, c = (m*m).sum(1), 2*(y*m).sum(1), (y*y).sum(1) - r**2
+	t = ((-b + torch.sqrt((b**2 - 4*a*c).clamp(0))) / (2*a)).clamp(0)
+	return t, y + t.unsqueeze(1)*m
+
+def _l1_exit(y: torch.Tensor, m: torch.Tensor, r: float):
+	# |y + t m|_1 is convex & piecewise linear in t; interpolate between its breakpoints
+	f = lambda t: (y.unsqueeze(1) + t.unsqueeze(2)*m.unsqueeze(1)).abs().sum(2)
+	tb = -y / m
+	tb = torch.where(tb > 0, tb, torch.full_like(tb, float('inf'))).sort(1)[0]
+	finite = torch.isfinite(tb)
+	t_last = torch.where(finite, tb, torch.zeros_like(tb)).max(1)[0]
+	f_last = f(t_last.unsqueeze(1))[:, 0]
+	t_ext = t_last + ((r - f_last) / m.abs().sum(1)).clamp(0)
+	t_cand = torch.cat((torch.zeros_like(t_last).unsqueeze(1), torch.where(finite, tb, t_last.unsqueeze(1)), t_ext.unsqueeze(1)), 1)
+	f_cand = f(t_cand)
+	f_cand[:, -1] = torch.where(f_last < r, torch.full_like(f_last, r), torch.full_like(f_last, float('inf')))
+	k = (f_cand[:, 1:] >= r).float().argmax(1, keepdim=True) + 1 # the start may lie on the boundary
+	t0, t1 = t_cand.gather(1, k-1)[:, 0], t_cand.gather(1, k)[:, 0]
+	f0, f1 = f_cand.gather(1, k-1)[:, 0], f_cand.gather(1, k)[:, 0]
+	t = t0 + (t1 - t0) * ((r - f0) / (f1 - f0).clamp(1e-12)).clamp(0, 1)
+	x = y + t.unsqueeze(1)*m
+	return t, torch.where(x != 0, x.sign(), m.sign())
+
+def _box_exit(y: torch.Tensor, m: torch.Tensor, lo: torch.Tensor, hi: torch.Tensor):
+	# First coordinate of y + t m to leave [lo, hi]
+	bound = torch.where(m > 0, hi, lo)
+	t_i = torch.where(m != 0, (bound - y) / m, torch.full_like(y, float('inf'))).clamp(0)
+	t, i = t_i.min(1)
+	normal = torch.zeros_like(y).scatter_(1, i.unsqueeze(1), 1.)
+	return t, normal
+
+def _ray_boundary(exit: Callable, batch_dims: int, max_refl: int, project=None):
 	'''
-	Boundary imposed on lp norm of parameter elements.
+	Boundary which follows each ray to its exit time in closed form, reflects, and repeats until the step is used up.
+	Every tensor in params is constrained separately; its first `batch_dims` dimensions index independent chains.
+	exit(x, m) returns the exit times (chains,) and outward normals (chains, entries) for positions x & momenta m (chains, entries).
 	'''
 	def boundary(params: tuple, momentum: tuple, step: float):
-		p, m = params[0], momentum[0] # TODO generalize to n-d
-		p_cand = p + step*m
-
-		if p_cand.norm(p=lp) > vmax:
-			p_cand = p.detach()
-			eps = step
-			while (p_cand + delta*m).norm(p=lp) <= vmax:
-				p_cand += delta*m
-				eps -= delta
-			p_cand = p_cand.requires_grad_()
-			grad = torch.autograd.grad(p_cand.norm(p=lp), p_cand)[0]
-			m_para = ((m.t()@grad) / (grad.t()@grad)) * grad
-			m_refl = m - 2*m_para
-			return (p_cand.detach().requires_grad_(),), (m_refl.detach().requires_grad_(),), eps
-
-		return (p_cand,), momentum, 0.
-
+		step = float(step)
+		params_out, momentum_out = [], []
+		for (p, m) in zip(params, momentum):
+			shape = p.shape
+			x = p.detach().reshape(int(np.prod(shape[:batch_dims])), -1)
+			v = m.detach().reshape(x.shape)
+			remaining = torch.full((x.shape[0],), step, device=x.device)
+			for _ in range(max_refl):
+				t, normal = exit(x, v)
+				instrumentation.count('reflection_probes')
+				hit = t < remaining
+				dt = torch.where(hit, t, remaining)
+				x = x + dt.unsqueeze(1)*v
+				if project is not None:
+					x = project(x)
+				remaining = remaining - dt
+				if not hit.any():
+					break
+				instrumentation.count('reflections', int(hit.sum()))
+				coef = (v*normal).sum(1) / (normal*normal).sum(1)
+				v = torch.where(hit.unsqueeze(1), v - 2*coef.unsqueeze(1)*normal, v)
+			else:
+				raise Divergence('Maximum reflections exceeded')
+			params_out.append(x.reshape(shape).requires_grad_())
+			momentum_out.append(v.reshape(shape).requires_grad_())
+		return tuple(params_out), tuple(momentum_out), 0.
 	return boundary
 
-def rect_boundary(vmin: float, vmax: float):
+def lp_boundary(lp: float, vmax=float('inf'), offset=0, batch_dims=0, max_refl=100):
 	'''
-	Rectangular boundary imposed on parameter values.
+	Boundary imposed on lp norm of parameter elements (|p - offset|_lp <= vmax, separately for each tensor in params).
+	Intersections are computed in closed form for lp = 1, 2, inf; other norms locate crossings by root finding.
+
+	batch_dims: leading dimensions of each parameter tensor which index independent chains
 	'''
-	assert vmin < vmax
-	v0 = (vmin + vmax) / 2
-	c = vmax - v0
-	return lp_boundary(float('inf'), vmax=c, offset=v0)
+	if lp == 2:
+		exit = lambda x, m: _l2_exit(x - offset, m, vmax)
+	elif lp == 1:
+		exit = lambda x, m: _l1_exit(x - offset, m, vmax)
+	elif lp == float('inf'):
+		return rect_boundary(offset - vmax, offset + vmax, batch_dims=batch_dims, max_refl=max_refl)
+	else:
+		assert batch_dims == 0, 'Only l1, l2 and l-inf boundaries are vectorized over chains'
+		def boundary(params: tuple, momentum: tuple, step: float):
+			norms = [((lambda *ps, i=i: (ps[i] - offset).norm(p=lp)), -float('inf'), vmax) for i in range(len(params))]
+			return constraint_boundary(norms)(params, momentum, step)
+		return boundary
+	return _ray_boundary(exit, batch_dims, max_refl)
+
+def rect_boundary(vmin, vmax, batch_dims=0, max_refl=100):
+	'''
+	Rectangular boundary imposed on parameter values; vmin & vmax may be scalars or per-entry bounds.
+	'''
+	vmin, vmax = torch.as_tensor(vmin, dtype=torch.float), torch.as_tensor(vmax, dtype=torch.float)
+	assert (vmin < vmax).all()
+	def exit(x, m):
+		lo, hi = vmin.to(x.device).reshape(1, -1), vmax.to(x.device).reshape(1, -1)
+		return _box_exit(x, m, lo, hi)
+	def project(x):
+		return torch.max(torch.min(x, vmax.to(x.device).reshape(1, -1)), vmin.to(x.device).reshape(1, -1))
+	return _ray_boundary(exit, batch_dims, max_refl, project=project)
 
-def fn_boundary(fn: Callable, vmin=-float('inf'), vmax=float('inf'), boundary_resolution=20, tolerance=1e-6):
+def fn_boundary(fn: Callable, vmin=-float('inf'), vmax=float('inf'), tolerance=1e-6, xtol=1e-3, max_iter=50):
 	'''
 	1D boundary imposed on differentiable scalar function of parameters.
 	'''
 	assert vmin < vmax
+	return constraint_boundary([(fn, vmin, vmax)], tolerance=tolerance, xtol=xtol, max_iter=max_iter)
+
+def constraint_boundary(constraints: list, tolerance=1e-6, xtol=1e-3, max_iter=50):
+	'''
+	Boundary imposed by several constraints vmin <= fn(*params) <= vmax, given as a list of (fn, vmin, vmax).
+	Each fn receives all parameter tensors as arguments and must be differentiable.
+
+	The crossing along a step is located by safeguarded regula falsi (Illinois) on the largest constraint violation,
+	to within xtol of the step, or until the violation is within tolerance; momentum is then reflected across the
+	plane orthogonal to the gradient of the violated constraint.
+	'''
+	for (fn, vmin, vmax) in constraints:
+		assert vmin < vmax
+
+	def violations(params: tuple):
+		# Positive where violated; one entry per (constraint, side)
+		v = []
+		for (fn, vmin, vmax) in constraints:
+			y = fn(*params)
+			v.append(y - vmax if vmax < float('inf') else -float('inf'))
+			v.append(vmin - y if vmin > -float('inf') else -float('inf'))
+		return v
+
 	def boundary(params: tuple, momentum: tuple, step: float):
-		p, m = params[0], momentum[0] # TODO generalize to n-d
-		p_cand = p + step*m
-		v = fn(p_cand)
-
-		if v > vmax + tolerance:
-			eps = step
-			delta = step/boundary_resolution
-			p_cand = p.detach()
-			j = 0
-			while fn(p_cand + delta*m) <= vmax:
-				p_cand += delta*m
-				eps -= delta
-				j += 1
-				if j > boundary_resolution + 5: 
-					print('vmax:', vmax, 'current:', fn(p_cand).item(), 'violating:', fn(p+step*m).item())
-					raise Exception('vmax loop')
-			p_cand = p_cand.requires_grad_()
-			# Reflect along plane orthogonal to gradient
-			grad = torch.autograd.grad(fn(p_cand), p_cand)[0]
-			m_para = (torch.trace(m.t()@grad) / torch.trace(grad.t()@grad)) * grad
-			m_refl = m - 2*m_para
-			return (p_cand.detach().requires_grad_(),), (m_refl.detach().requires_grad_(),), eps
-
-		elif v < vmin - tolerance:
-			eps = step
-			delta = step/boundary_resolution
-			p_cand = p.detach()
-			j = 0
-			while fn(p_cand + delta*m) >= vmin:
-				p_cand += delta*m
-				eps -= delta
-				j += 1
-				if j > boundary_resolution + 5: 
-					print('vmin:', vmin, 'current:', fn(p_cand).item(), 'violating:', fn(p+step*m).item())
-					raise Exception('vmin loop')
-			p_cand = p_cand.requires_grad_()
-			# Reflect along plane orthogonal to gradient
-			grad = -torch.autograd.grad(fn(p_cand), p_cand)[0]
-			m_para = (torch.trace(m.t()@grad) / torch.trace(grad.t()@grad)) * grad
-			m_refl = m - 2*m_para
-			return (p_cand.detach().requires_grad_(),), (m_refl.detach().requires_grad_(),), eps
-
-		return (p_cand,), momentum, 0.
+		step = float(step)
+		p = tuple(w.detach() for w in params)
+		m = tuple(w.detach() for w in momentum)
+		advance = lambda s: zip_with(p, m, lambda w, dw: w + s*dw)
+		def h(s):
+			instrumentation.count('reflection_probes')
+			return max(float(x) for x in violations(advance(s)))
+
+		with torch.no_grad():
+			h_hi = h(step)
+			if h_hi <= tolerance:
+				return tuple(w.requires_grad_() for w in advance(step)), momentum, 0.
+
+			# Bracket [lo, hi] with the start feasible and the full step infeasible
+			lo, hi, h_lo = 0., step, h(0.)
+			side = 0
+			for _ in range(max_iter):
+				if h_lo > 0 or hi - lo <= xtol*step or -tolerance <= h_lo:
+					break
+				s = hi - h_hi*(hi - lo)/(h_hi - h_lo)
+				if not lo < s < hi:
+					s = (lo + hi) / 2
+				h_s = h(s)
+				if h_s > 0:
+					hi, h_hi = s, h_s
+					if side == 1: h_lo /= 2
+					side = 1
+				else:
+					lo, h_lo = s, h_s
+					if side == -1: h_hi /= 2
+					side = -1
+
+		# Reflect along plane orthogonal to gradient of the violated constraint
+		instrumentation.count('reflections')
+		x = tuple(w.requires_grad_() for w in advance(lo))
+		violated = advance(hi)
+		with torch.no_grad():
+			k = int(np.argmax([float(v) for v in violations(violated)]))
+		(fn, _, _) = constraints[k // 2]
+		grad = torch.autograd.grad(fn(*x), x, allow_unused=True)
+		grad = tuple(torch.zeros_like(w) if g is None else g for (w, g) in zip(x, grad))
+		if k % 2 == 1: # lower bound
+			grad = tuple(-g for g in grad)
+		m_dot_g = sum((dw*g).sum() for (dw, g) in zip(m, grad))
+		g_dot_g = sum((g*g).sum() for g in grad)
+		m_refl = zip_with(m, grad, lambda dw, g: (dw - 2*(m_dot_g/g_dot_g)*g).requires_grad_())
+		return tuple(w.detach().requires_grad_() for w in x), m_refl, step - lo
 	return boundary
@@ -0,0 +1,98 @@
+'''
+Importance reweighting of uncertainty sets to other Beta distance distributions.
+
+`ugen.perturb` samples operators P with density proportional to Beta(d(P); alpha, beta) (times a parametrization prior, if any),
+so a set sampled at (alpha, beta) is a weighted sample of the target at any (alpha', beta') with self-normalized weights
+w_i ~ Beta(d_i; alpha', beta') / Beta(d_i; alpha, beta), from the stored distances alone. The effective sample size of the
+weights tells whether the set still represents the new target, or a new one has to be generated.
+'''
+import numpy as np
+import scipy.stats as stats
+import torch
+
+def log_weights(distances, beta: float, new_beta: float, alpha=1., new_alpha=None):
+	'''
+	Unnormalized log importance weights of samples at these distances, drawn at (alpha, beta), for the target at (new_alpha, new_beta).
+	'''
+	new_alpha = alpha if new_alpha is None else new_alpha
+	d = np.maximum(np.asarray(distances, dtype=np.float64), 1e-8) # as in the potential
+	return stats.beta.logpdf(d, new_alpha, new_beta) - stats.beta.logpdf(d, alpha, beta)
+
+def normalize(log_w: np.ndarray):
+	'''
+	Self-normalized weights from log weights.
+	'''
+	w = np.exp(log_w - np.max(log_w))
+	return w / w.sum()
+
+def ess(weights: np.ndarray):
+	'''
+	Kish effective sample size of normalized weights.
+	'''
+	return 1. / np.sum(weights ** 2)
+
+def systematic_resample(weights: np.ndarray, n=None, rng=None):
+	'''
+	Indices of n samples drawn with probabilities `weights` by systematic resampling (one uniform draw, lower variance than multinomial).
+	'''
+	n = len(weights) if n is None else n
+	rng = np.random if rng is None else rng
+	positions = (rng.random_sample() + np.arange(n)) / n
+	cumulative = np.cumsum(weights)
+	cumulative[-1] = 1.
+	return np.searchsorted(cumulative, positions)
+
+def reweight(distances, beta: float, new_beta: float, alpha=1., new_alpha=None):
+	'''
+	Normalized weights and their ESS for the target at (new_alpha, new_beta).
+	'''
+	w = normalize(log_weights(distances, beta, new_beta, alpha=alpha, new_alpha=new_alpha))
+	return w, ess(w)
+
+def reweight_store(store, new_beta: float, new_alpha=None, n=None, min_ess=None, column='posterior'):
+	'''
+	Resample a SampleStore generated at store.meta['beta'] (and meta 'alpha', default 1) for a new Beta target.
+	Returns (samples, indices, ess), or None if the ESS is below min_ess, i.e. a new set should be generated.
+
+	n: number of resampled operators (default: len(store))
+	column: per-sample distances to the nominal
+	'''
+	alpha = store.meta.get('alpha', 1.)
+	w, n_eff = reweight(store.column(column), store.meta['beta'], new_beta, alpha=alpha, new_alpha=new_alpha)
+	if min_ess is not None and n_eff < min_ess:
+		return None
+	indices = systematic_resample(w, n=n)
+	samples = store.column('samples', as_tensor=True)
+	return [samples[i] for i in indices], indices, n_eff
+
+'''
+Tests
+'''
+if __name__ == '__main__':
+	import os
+	import tempfile
+	from sampler.store import SampleStore
+
+	np.random.seed(9001)
+
+	# Draws of Beta(1, 5) reweighted to Beta(1, 8) & Beta(2, 5): weighted means match the targets'
+	d = np.random.beta(1., 5., size=20000)
+	for new_alpha, new_beta in [(1., 8.), (2., 5.), (1., 50.)]:
+		w, n_eff = reweight(d, 5., new_beta, new_alpha=new_alpha)
+		mean, expected = (w * d).sum(), new_alpha / (new_alpha + new_beta)
+		print(f'alpha={new_alpha}, beta={new_beta}: weighted mean {mean:.4f} (expected {expected:.4f}), ESS {n_eff:.0f} of {len(d)}')
+		if n_eff > 1000:
+			assert abs(mean / expected - 1) < 0.05
+	assert reweight(d, 5., 5.)[1] > len(d) - 1e-6 # identical target: uniform weights
+
+	indices = systematic_resample(w, n=5000)
+	assert abs(d[indices].mean() / (1./51) - 1) < 0.1
+
+	with tempfile.TemporaryDirectory() as tmp:
+		store = SampleStore(os.path.join(tmp, 'set'))
+		store.set_meta(beta=5.)
+		store.append(torch.from_numpy(d[:500, None, None]).float().expand(-1, 2, 2), posterior=d[:500])
+		samples, indices, n_eff = reweight_store(store, 8., n=100)
+		assert len(samples) == 100 and samples[0].shape == (2, 2) and np.allclose(samples[0][0, 0].item(), d[indices[0]], rtol=1e-6)
+		assert reweight_store(store, 500., min_ess=100) is None
+	print('Store reweighting test passed')
@@ -0,0 +1,109 @@
+'''
+Scenario reduction: representative subsets of an uncertainty set under the PF-kernel distance.
+'''
+import numpy as np
+import torch
+
+from sampler.kernel import PFKernel
+from sampler.pairwise import block_distances
+
+def select_scenarios(samples: list, K: PFKernel, k: int, weights=None, nominal=None, block_size=64):
+	'''
+	Greedy weighted farthest-point selection of k scenarios, followed by assignment of every
+	sample to its nearest scenario. Costs N kernel evaluations per selected scenario (O(N k) total).
+
+	samples: list of d x d operators (or an N x d x d tensor)
+	K: kernel used for the distance
+	k: number of scenarios
+	weights: (optional) probability mass of each sample; selection maximizes weight * distance to the selected set
+	nominal: (optional) operator which is always a scenario (e.g. the nominal model); not counted in k and not returned in indices
+
+	Returns the indices of the selected samples and the mass of samples closest to each scenario
+	(with the nominal's share first, if given).
+	'''
+	P = torch.stack(tuple(samples)) if type(samples) == list else samples
+	P = P.detach().float().cpu()
+	N = P.shape[0]
+	k = min(k, N)
+	w = np.full(N, 1/N) if weights is None else np.asarray(weights, dtype=np.float64) / np.sum(weights)
+
+	with torch.no_grad():
+		A = K.powers(P)
+		diag = K.self_gram(A)
+
+	def distances_from(a: torch.Tensor, diag_a: torch.Tensor):
+		return torch.cat([
+			block_distances(K, a, A[i:i+block_size], diag_a, diag[i:i+block_size])[0] for i in range(0, N, block_size)
+		]).numpy()
+
+	centers = []
+	if nominal is not None:
+		with torch.no_grad():
+			a = K.powers(nominal.detach().float().cpu().unsqueeze(0))
+			centers.append(distances_from(a, K.self_gram(a)))
+		min_dist = centers[0].copy()
+		indices = []
+	else:
+		indices = [int(np.argmax(w))]
+		centers.append(distances_from(A[indices], diag[indices]))
+		min_dist = centers[0].copy()
+		min_dist[indices[0]] = 0.
+
+	while len(indices) < k:
+		score = w * min_dist
+		score[indices] = -1.
+		j = int(np.argmax(score))
+		indices.append(j)
+		centers.append(distances_from(A[[j]], diag[[j]]))
+		min_dist = np.minimum(min_dist, centers[-1])
+		min_dist[j] = 0.
+
+	dist = np.stack(centers) # (n_centers, N)
+	if nominal is not None:
+		dist[1 + np.arange(len(indices)), indices] = 0.
+	else:
+		dist[np.arange(len(indices)), indices] = 0.
+	nearest = np.argmin(dist, axis=0)
+	cell_weights = np.bincount(nearest, weights=w, minlength=dist.shape[0])
+
+	return indices, cell_weights
+
+def coverage_radius(samples: list, K: PFKernel, indices: list, nominal=None, block_size=64):
+	'''
+	Largest distance from any sample to its nearest selected scenario.
+	'''
+	P = torch.stack(tuple(samples)) if type(samples) == list else samples
+	P = P.detach().float().cpu()
+	scenarios = P[indices]
+	if nominal is not None:
+		scenarios = torch.cat((nominal.detach().float().cpu().unsqueeze(0), scenarios))
+	with torch.no_grad():
+		A, A_s = K.powers(P), K.powers(scenarios)
+		diag, diag_s = K.self_gram(A), K.self_gram(A_s)
+		min_dist = torch.cat([
+			block_distances(K, A[i:i+block_size], A_s, diag[i:i+block_size], diag_s).min(1)[0] for i in range(0, P.shape[0], block_size)
+		])
+	min_dist[indices] = 0.
+	return min_dist.max().item()
+
+'''
+Tests
+'''
+if __name__ == '__main__':
+	import random
+	from sampler.utils import set_seed
+
+	set_seed(9001)
+
+	d, m, T, N, k = 4, 2, 20, 300, 10
+	K = PFKernel('cpu', d, m, T)
+	nominal = torch.randn(d, d) / np.sqrt(d)
+	samples = [nominal + 5e-2*torch.randn(d, d) for _ in range(N)]
+
+	indices, cell_weights = select_scenarios(samples, K, k, nominal=nominal)
+	assert len(set(indices)) == k and np.isclose(cell_weights.sum(), 1.)
+	r_fps = coverage_radius(samples, K, indices, nominal=nominal)
+	r_rand = coverage_radius(samples, K, random.sample(range(N), k), nominal=nominal)
+	print('Coverage radius, farthest-point:', r_fps, 'random:', r_rand)
+	print('Scenario weights:', cell_weights)
+	assert r_fps <= r_rand
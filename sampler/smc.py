@@ -0,0 +1,132 @@
+'''
+Sequential Monte Carlo with adaptive tempering.
+
+A population of particles is drawn from a Gaussian reference q around a start point and annealed through
+pi_lambda ~ q^(1-lambda) exp(-lambda U) to the target exp(-U). Each stage picks the next lambda by bisection so that the conditional
+ESS of the incremental weights is a fixed fraction of the population, resamples when the ESS is low, and moves every particle
+with a few batched HMC steps which leave pi_lambda invariant. Potentials are evaluated for the whole population at once,
+and particles only interact through resampling. The product of the mean incremental weights estimates the normalizing
+constant of exp(-U).
+'''
+import math
+from typing import Callable
+from tqdm import tqdm
+import torch
+
+import sampler.stats as instrumentation
+import sampler.hmc_batched as hmc_batched
+
+def _log_ess(log_w: torch.Tensor):
+	# log of the Kish ESS of unnormalized log weights
+	return 2*torch.logsumexp(log_w, 0) - torch.logsumexp(2*log_w, 0)
+
+def _systematic_resample(log_w: torch.Tensor):
+	n = len(log_w)
+	cumulative = torch.softmax(log_w, 0).cumsum(0)
+	cumulative[-1] = 1.
+	positions = (torch.rand(1, device=log_w.device) + torch.arange(n, device=log_w.device)) / n
+	return torch.searchsorted(cumulative, positions).clamp(max=n-1)
+
+def sample(
+		n_particles: int, start: torch.Tensor, potential: Callable, reference_scale: float, feasible=None,
+		target_ess=0.5, resample_ess=0.5, n_moves=5, step_size=1e-2, n_leapfrog=10, max_stages=1000, show_progress=True, stats=None
+	):
+	'''
+	Returns particles (n_particles, ...), their normalized weights and the log normalizing constant of exp(-U).
+
+	start: center of the Gaussian reference
+	potential: batched potential U of particles (n, ...) -> (n,)
+	reference_scale: standard deviation of the reference around start
+	feasible: (optional) boolean mask of particles (n, ...) satisfying the constraints; the reference is truncated to it
+	target_ess: fraction of the population kept as ESS by each tempering increment
+	resample_ess: resample once the ESS falls below this fraction of the population
+	n_moves: HMC steps per stage; step_size is adapted between stages towards acceptance rates in [0.5, 0.8]
+	stats: (optional) sampler.stats.Stats which receives the schedule, ESS & acceptance of every stage
+	'''
+	dims = tuple(range(1, start.dim()+1))
+	start = start.detach()
+	reference = lambda X: 0.5*((X - start)**2).sum(dims) / reference_scale**2
+	evaluate = lambda X: torch.nan_to_num(potential(X), nan=float('inf'))
+
+	with instrumentation.recording(stats), torch.no_grad():
+		X = start + reference_scale*torch.randn((n_particles,) + start.shape, device=start.device)
+		log_w = torch.zeros(n_particles, device=start.device)
+		if feasible is not None:
+			log_w[~feasible(X)] = -float('inf')
+		# log Z of the (truncated) reference exp(-reference)
+		log_Z = 0.5*start.numel()*math.log(2*math.pi*reference_scale**2) + (torch.logsumexp(log_w, 0) - math.log(n_particles)).item()
+		u, u_ref = evaluate(X), reference(X)
+		lam, stage = 0., 0
+
+		pbar = tqdm(total=1., desc='SMC', disable=not show_progress, bar_format='{l_bar}{bar}| lambda={n:.4f}')
+		while lam < 1. and stage < max_stages:
+			# Next lambda: largest increment whose incremental weights keep a conditional ESS of target_ess of the population
+			log_W = log_w - torch.logsumexp(log_w, 0)
+			increment = lambda delta: -delta*(u - u_ref)
+			log_cess = lambda delta: math.log(n_particles) + 2*torch.logsumexp(log_W + increment(delta), 0) - torch.logsumexp(log_W + 2*increment(delta), 0)
+			target = math.log(target_ess * n_particles)
+			if log_cess(1. - lam) >= target:
+				delta = 1. - lam
+			else:
+				lo, hi = 0., 1. - lam
+				for _ in range(50):
+					mid = (lo + hi) / 2
+					lo, hi = (mid, hi) if log_cess(mid) >= target else (lo, mid)
+				delta = max(lo, 1e-12)
+			new_log_w = log_w + increment(delta)
+			log_Z += (torch.logsumexp(new_log_w, 0) - torch.logsumexp(log_w, 0)).item()
+			log_w, lam = new_log_w, min(lam + delta, 1.)
+			stage += 1
+			instrumentation.count('smc_stages')
+			instrumentation.record('smc_lambda', lam)
+			instrumentation.record('smc_ess', _log_ess(log_w).exp().item() / n_particles)
+
+			if _log_ess(log_w) < math.log(resample_ess * n_particles):
+				index = _systematic_resample(log_w)
+				X, u, u_ref = X[index], u[index], u_ref[index]
+				log_w = torch.zeros_like(log_w)
+				instrumentation.count('smc_resamples')
+
+			# Moves invariant for pi_lambda
+			tempered = lambda Y: (1. - lam)*reference(Y) + lam*potential(Y)
+			n_accepted = 0
+			with torch.enable_grad():
+				for _ in range(n_moves):
+					X, accepted = hmc_batched.move(X, tempered, step_size, n_leapfrog, feasible=feasible)
+					n_accepted += accepted.sum().item()
+			rate = n_accepted / (n_moves * n_particles)
+			instrumentation.count('proposals', n_moves * n_particles)
+			instrumentation.count('accepted', n_accepted)
+			instrumentation.record('smc_acceptance', rate)
+			step_size *= 1.2 if rate > 0.8 else (0.7 if rate < 0.5 else 1.)
+			u, u_ref = evaluate(X), reference(X)
+			pbar.update(lam - pbar.n)
+		pbar.close()
+
+	return X, torch.softmax(log_w, 0), log_Z
+
+'''
+Tests
+'''
+if __name__ == '__main__':
+	from sampler.utils import set_seed
+	from sampler.stats import Stats
+
+	set_seed(9001)
+
+	# Anisotropic Gaussian target with known normalizing constant, far from the reference
+	mean, var = torch.tensor([1., -2., 0.5]), torch.tensor([0.1, 1., 0.01])
+	potential = lambda X: 0.5*((X - mean)**2 / var).sum(-1)
+	stats = Stats()
+	X, w, log_Z = sample(2000, torch.zeros(3), potential, 1., n_moves=5, step_size=0.1, n_leapfrog=5, show_progress=False, stats=stats)
+	expected = 0.5*torch.log(2*math.pi*var).sum().item()
+	m = (w[:, None] * X).sum(0)
+	v = (w[:, None] * (X - m)**2).sum(0)
+	print(f'{stats.counts["smc_stages"]} stages; log Z {log_Z:.3f} (expected {expected:.3f}); mean {m.tolist()}; var {v.tolist()}')
+	assert abs(log_Z - expected) < 0.2
+	assert torch.allclose(m, mean, atol=0.05) and torch.allclose(v, var, rtol=0.2)
+
+	# Truncated target: the constraint x_0 >= 1 halves the normalizing constant
+	X, w, log_Z = sample(5000, torch.full((3,), 1.5), potential, 1., feasible=lambda X: X[:, 0] >= 1., step_size=0.1, n_leapfrog=5, show_progress=False)
+	print(f'Truncated: log Z {log_Z:.3f} (expected {expected + math.log(0.5):.3f}); min x_0 {X[:, 0].min():.3f}')
+	assert (X[:, 0] >= 1.).all() and abs(log_Z - expected - math.log(0.5)) < 0.25
@@ -0,0 +1,163 @@
+'''
+Sampler instrumentation: counters, cumulative timers and recorded values.
+
+Instrumented code (potential evaluations, leapfrog, boundaries, proposals) reports to the Stats object made active by
+`recording(stats)` in the current process, and does nothing when none is active. Timed phases are also labelled for
+torch.profiler, so they appear in exported Chrome traces.
+'''
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+import numpy as np
+import torch
+
+class Stats:
+	def __init__(self):
+		self.counts = defaultdict(int)
+		self.times = defaultdict(float) # cumulative seconds
+		self.values = defaultdict(list)
+
+	def count(self, name: str, n=1):
+		self.counts[name] += n
+
+	def record(self, name: str, value: float):
+		self.values[name].append(float(value))
+
+	def add_time(self, name: str, seconds: float):
+		self.times[name] += seconds
+
+	@contextmanager
+	def timer(self, name: str):
+		with torch.profiler.record_function(name):
+			start = time.perf_counter()
+			try:
+				yield
+			finally:
+				self.times[name] += time.perf_counter() - start
+
+	def merge(self, other: 'Stats'):
+		'''
+		Add the counts, times and values of another run (e.g. another chain) to these.
+		'''
+		for name, n in other.counts.items():
+			self.counts[name] += n
+		for name, t in other.times.items():
+			self.times[name] += t
+		for name, v in other.values.items():
+			self.values[name].extend(v)
+		return self
+
+	def summary(self):
+		'''
+		Counts, times, and mean / standard deviation / 5-50-95% quantiles of recorded values.
+		'''
+		values = {}
+		for name, v in self.values.items():
+			v = np.asarray(v)
+			v = v[np.isfinite(v)]
+			if len(v) > 0:
+				q = np.quantile(v, [0.05, 0.5, 0.95])
+				values[name] = {'n': len(v), 'mean': float(v.mean()), 'std': float(v.std()), 'q05': float(q[0]), 'q50': float(q[1]), 'q95': float(q[2])}
+		return {'counts': dict(self.counts), 'times': dict(self.times), 'values': values}
+
+	def __repr__(self):
+		s = self.summary()
+		lines = [f'{name}: {n}' for name, n in sorted(s['counts'].items())]
+		lines += [f'{name}: {t:.3f}s' for name, t in sorted(s['times'].items())]
+		lines += [f'{name}: ' + ', '.join(f'{k}={v:.4g}' for k, v in summary.items()) for name, summary in sorted(s['values'].items())]
+		return '\n'.join(lines)
+
+_active = None
+
+@contextmanager
+def recording(stats: Stats):
+	'''
+	Make `stats` the recipient of instrumentation in this process (no-op if None).
+	'''
+	global _active
+	if stats is None:
+		yield
+		return
+	previous, _active = _active, stats
+	try:
+		yield
+	finally:
+		_active = previous
+
+def count(name: str, n=1):
+	if _active is not None:
+		_active.count(name, n)
+
+def record(name: str, value: float):
+	if _active is not None:
+		_active.record(name, value)
+
+def add_time(name: str, seconds: float):
+	if _active is not None:
+		_active.add_time(name, seconds)
+
+def timer(name: str):
+	return _active.timer(name) if _active is not None else nullcontext()
+
+@contextmanager
+def profiled(path: str):
+	'''
+	Record a torch.profiler trace of the enclosed code and export it to `path` as a Chrome trace (no-op if None).
+	'''
+	if path is None:
+		yield
+		return
+	with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU]) as prof:
+		yield
+	prof.export_chrome_trace(path)
+
+'''
+Tests
+'''
+if __name__ == '__main__':
+	import os
+	import tempfile
+	import sampler.hmc as hmc
+	import sampler.reflections as reflections
+	from sampler.utils import set_seed
+
+	set_seed(9001)
+
+	potential = lambda params: 0.5*(params[0]**2).sum()
+	boundary = reflections.lp_boundary(2, vmax=1.)
+	L = 5
+
+	chains = []
+	with tempfile.TemporaryDirectory() as tmp:
+		for i in range(2):
+			stats = Stats()
+			hmc.sample(50, (torch.zeros(3, 1),), potential, boundary, step_size=0.5, n_leapfrog=L, show_progress=False, stats=stats, trace=os.path.join(tmp, f'chain_{i}.json'))
+			assert os.path.getsize(os.path.join(tmp, f'chain_{i}.json')) > 0
+			assert stats.counts['potential'] == L*stats.counts['proposals'] + 1, 'potential evaluated more than once per position'
+			assert stats.counts['reflections'] > 0 and len(stats.values['energy_error']) == stats.counts['proposals']
+			chains.append(stats)
+
+	total = Stats().merge(chains[0]).merge(chains[1])
+	assert total.counts['proposals'] == chains[0].counts['proposals'] + chains[1].counts['proposals']
+	assert len(total.values['acceptance']) == 2
+	print(total)
+
+	# Delayed acceptance: the potential is only evaluated (without gradient) for proposals passing the surrogate's test
+	stats = Stats()
+	surrogate = lambda params: 0.6*(params[0]**2).sum()
+	hmc.sample(50, (torch.zeros(3, 1),), potential, boundary, step_size=0.5, n_leapfrog=L, show_progress=False, stats=stats, surrogate=surrogate)
+	assert stats.counts['surrogate'] == L*stats.counts['proposals'] + 1 and stats.counts['gradient'] == 0
+	assert stats.counts['potential'] == stats.counts['first_stage_accepted'] + 1
+	print(f"Delayed acceptance: {stats.counts['potential']} potential evaluations for {stats.counts['proposals']} proposals")
+
+	# Divergence: a wall of stiffness 1e6 beyond x = 2 makes trajectories entering it blow up; they are abandoned & rejected
+	stiff = lambda params: 0.5*(params[0]**2).sum() + 1e6*torch.relu(params[0] - 2).pow(2).sum()
+	stats = Stats()
+	samples, _ = hmc.sample(200, (torch.zeros(1),), stiff, reflections.nil_boundary, step_size=0.5, n_leapfrog=L, show_progress=False, stats=stats)
+	assert stats.counts['divergences'] > 0 and all(torch.isfinite(x).all() for (x,) in samples)
+	print(f"Divergences: {stats.counts['divergences']} of {stats.counts['proposals']} proposals rejected")
+	try:
+		hmc.sample(10, (torch.full((1,), 3.),), stiff, reflections.nil_boundary, step_size=0.5, n_leapfrog=L, show_progress=False, max_divergences=5)
+		assert False, 'chain inside the wall should diverge'
+	except hmc.ChainDiverged as e:
+		assert len(e.samples) == 0
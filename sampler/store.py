@@ -0,0 +1,197 @@
+'''
+Chunked, memory-mapped storage of uncertainty sets.
+
+A store is a directory holding per-sample columns (operators, posterior, ...) as appendable chunks of
+contiguous .npy arrays, whole arrays (nominal, trajectories, ...) and a JSON file of metadata.
+Chunks are opened copy-on-write memory-mapped, so reads are partial and loaded tensors are zero-copy views.
+'''
+import os
+import json
+import numpy as np
+import torch
+
+class SampleStore:
+	def __init__(self, path: str, mode='a'):
+		'''
+		path: store directory
+		mode: 'r' opens an existing store (FileNotFoundError if there is none), 'a' opens or creates one to append to,
+			'w' creates an empty store, deleting the samples, arrays and metadata of any existing one (e.g. when regenerating a set)
+		'''
+		assert mode in ('r', 'a', 'w'), f'Unknown mode {mode}'
+		self.path = path
+		index = os.path.join(path, 'store.json')
+		if mode == 'r' and not os.path.exists(index):
+			raise FileNotFoundError(f'Sample store not found at {path}')
+		if mode != 'r':
+			os.makedirs(path, exist_ok=True)
+		if os.path.exists(index):
+			with open(index) as f:
+				state = json.load(f)
+			self.chunks, self.columns, self.meta = state['chunks'], state['columns'], state['meta']
+		else:
+			self.chunks, self.columns, self.meta = [], [], {}
+		if mode == 'w':
+			self.clear()
+
+	def clear(self):
+		'''
+		Delete all samples, arrays and metadata.
+		'''
+		for name in os.listdir(self.path):
+			if name.endswith('.npy'):
+				os.remove(os.path.join(self.path, name))
+		self.chunks, self.columns, self.meta = [], [], {}
+		self._write_index()
+
+	def _write_index(self):
+		tmp = os.path.join(self.path, 'store.json.tmp')
+		with open(tmp, 'w') as f:
+			json.dump({'chunks': self.chunks, 'columns': self.columns, 'meta': self.meta}, f)
+		os.replace(tmp, os.path.join(self.path, 'store.json'))
+
+	def _save(self, name: str, array: np.ndarray):
+		tmp = os.path.join(self.path, name + '.tmp.npy')
+		np.save(tmp, array)
+		os.replace(tmp, os.path.join(self.path, name + '.npy'))
+
+	def _load(self, name: str):
+		return np.load(os.path.join(self.path, name + '.npy'), mmap_mode='c')
+
+	def __len__(self):
+		return sum(self.chunks)
+
+	def append(self, samples, **columns):
+		'''
+		Write one chunk of samples.
+
+		samples: list of d x d operators (or an n x d x d tensor/array)
+		columns: per-sample values with a leading dimension of n (e.g. posterior=...); every chunk must provide the same columns
+		'''
+		if type(samples) == list:
+			samples = torch.stack(tuple(samples)) if len(samples) > 0 and type(samples[0]) == torch.Tensor else np.array(samples)
+		if type(samples) == torch.Tensor:
+			samples = samples.detach().cpu().numpy()
+		columns = {'samples': samples, **columns}
+		n = len(samples)
+		names = sorted(columns.keys())
+		if len(self.chunks) == 0:
+			self.columns = names
+		assert names == self.columns, f'chunk columns {names} do not match store columns {self.columns}'
+
+		i = len(self.chunks)
+		for name, values in columns.items():
+			if type(values) == torch.Tensor:
+				values = values.detach().cpu().numpy()
+			values = np.asarray(values)
+			if values.dtype == np.float64:
+				values = values.astype(np.float32)
+			assert len(values) == n, f'column {name} has {len(values)} rows, expected {n}'
+			self._save(f'{name}_{i:05d}', np.ascontiguousarray(values))
+		self.chunks.append(n)
+		self._write_index()
+
+	def put(self, name: str, array):
+		'''
+		Store a whole (not per-sample) array, such as the nominal operator or trajectories.
+		'''
+		if type(array) == torch.Tensor:
+			array = array.detach().cpu().numpy()
+		self._save(name, np.asarray(array))
+
+	def get(self, name: str, as_tensor=False):
+		array = self._load(name)
+		return torch.from_numpy(array) if as_tensor else array
+
+	def set_meta(self, **meta):
+		'''
+		Record JSON-serializable metadata (beta, step, ...).
+		'''
+		self.meta.update(meta)
+		self._write_index()
+
+	def iter_chunks(self, columns=('samples',), as_tensor=True):
+		'''
+		Yield dicts of memory-mapped chunk arrays (zero-copy torch views if as_tensor), one chunk at a time.
+		'''
+		for i in range(len(self.chunks)):
+			chunk = {name: self._load(f'{name}_{i:05d}') for name in columns}
+			yield {name: torch.from_numpy(v) for name, v in chunk.items()} if as_tensor else chunk
+
+	def column(self, name: str, as_tensor=False, start=0, stop=None):
+		'''
+		Rows [start, stop) of a column, reading only the chunks which overlap them.
+		'''
+		if name not in self.columns:
+			raise KeyError(f'No column {name} in the store at {self.path} (columns: {self.columns})')
+		stop = len(self) if stop is None else min(stop, len(self))
+		parts, offset = [], 0
+		for i, n in enumerate(self.chunks):
+			if offset + n > start and offset < stop:
+				parts.append(self._load(f'{name}_{i:05d}')[max(start-offset, 0):stop-offset])
+			offset += n
+		if len(parts) == 0:
+			values = np.zeros((0,) + self._load(f'{name}_00000').shape[1:], dtype=self._load(f'{name}_00000').dtype)
+		else:
+			values = parts[0] if len(parts) == 1 else np.concatenate(parts)
+		return torch.from_numpy(values) if as_tensor else values
+
+	def samples(self):
+		'''
+		All operators as a list of zero-copy tensor views.
+		'''
+		return [s for chunk in self.iter_chunks() for s in chunk['samples'].unbind()]
+
+def load(path: str):
+	'''
+	Open the store at path for reading, converting a set saved by earlier versions as a hickle dump (path + '.hkl', a dict with
+	'samples', 'posterior' and optionally 'nominal', 'trajectories' and scalar settings such as 'beta') on first use.
+	'''
+	if not os.path.exists(os.path.join(path, 'store.json')) and os.path.exists(path + '.hkl'):
+		import hickle as hkl
+		print(f'Converting {path}.hkl to a sample store')
+		results = hkl.load(path + '.hkl')
+		store = SampleStore(path, mode='w')
+		for name in ['nominal', 'trajectories']:
+			if name in results:
+				store.put(name, np.asarray(results[name], dtype=np.float32))
+		store.set_meta(**{k: v.item() if isinstance(v, np.generic) else v for k, v in results.items() if isinstance(v, (int, float, str, np.generic))})
+		store.append([np.asarray(s, dtype=np.float32) for s in results['samples']], posterior=np.asarray(results['posterior']))
+	return SampleStore(path, mode='r')
+
+'''
+Tests
+'''
+if __name__ == '__main__':
+	import tempfile
+
+	d = 3
+	with tempfile.TemporaryDirectory() as tmp:
+		store = SampleStore(os.path.join(tmp, 'set'))
+		store.set_meta(beta=5, method='kernel')
+		store.put('nominal', torch.eye(d))
+		for i in range(3):
+			store.append([torch.full((d, d), float(i*10 + j)) for j in range(10)], posterior=np.linspace(0, 1, 10))
+
+		store = SampleStore(os.path.join(tmp, 'set'))
+		assert len(store) == 30 and store.meta['beta'] == 5
+		samples = store.samples()
+		assert len(samples) == 30 and samples[17][0, 0].item() == 17.
+		assert store.column('samples', start=8, stop=12)[:, 0, 0].tolist() == [8., 9., 10., 11.]
+		assert store.column('posterior').shape == (30,)
+		assert (store.get('nominal') == np.eye(d)).all()
+		assert store.column('posterior', start=40).shape == (0,)
+
+		# Regenerating a set replaces it instead of appending to it
+		store = SampleStore(os.path.join(tmp, 'set'), mode='w')
+		store.append([torch.eye(d)], posterior=[0.5])
+		store = SampleStore(os.path.join(tmp, 'set'), mode='r')
+		assert len(store) == 1 and store.meta == {}
+
+		# Reading a missing store neither creates it nor returns an empty one
+		missing = os.path.join(tmp, 'missing')
+		try:
+			SampleStore(missing, mode='r')
+			assert False, 'missing store opened'
+		except FileNotFoundError:
+			assert not os.path.exists(missing)
+		print('Store test passed')
@@ -0,0 +1,163 @@
+'''
+Parallel tempering (replica exchange) HMC over a ladder of potentials, e.g. one distance distribution at several beta.
+
+A ladder holds one replica per potential. Each round advances every replica by one HMC proposal, then proposes swaps
+between neighboring replicas (even and odd pairs in alternate rounds), accepted with probability
+min(1, exp(U_i(x_i) + U_j(x_j) - U_i(x_j) - U_j(x_i))), so states found under mild potentials reach the sharp ones.
+Independent ladders (one per initial condition) run in a process pool, as in sampler.hmc_parallel.
+'''
+from typing import Callable, Any
+import multiprocessing
+import cloudpickle
+from tqdm import tqdm
+import torch
+
+from sampler.utils import *
+import sampler.hmc as hmc
+import sampler.stats as instrumentation
+from sampler.stats import Stats
+
+def _propose(params: tuple, cache: hmc.PotentialCache, boundary: Callable, step_size: float, n_leapfrog: int, random_step: bool, max_energy_error=1000.):
+	# One HMC proposal; returns the next state of the replica (divergent trajectories are rejected, see hmc.leapfrog)
+	momentum = hmc.gibbs(params)
+	h_old = cache(params, pin=True)[0] + hmc.kinetic(momentum)
+	eps = torch.normal(step_size, 2*step_size, (1,)).clamp(step_size/10) if random_step else step_size
+	instrumentation.count('proposals')
+	try:
+		proposal, momentum = hmc.leapfrog(params, momentum, cache, boundary, n_leapfrog, eps, h_old=h_old, max_energy_error=max_energy_error)
+	except hmc.Divergence:
+		instrumentation.count('divergences')
+		return params
+	proposal = tuple(w.detach().requires_grad_() for w in proposal)
+	h_new = cache(proposal)[0] + hmc.kinetic(momentum)
+	instrumentation.record('energy_error', h_new - h_old)
+	if hmc.accept(h_old, h_new):
+		instrumentation.count('accepted')
+		return proposal
+	return params
+
+def ladder(
+		n_samples: int, init_params: tuple, potentials: list, boundary: Callable,
+		step_size=0.03, n_leapfrog=10, n_burn=10, swap_every=1, random_step=False, show_progress=True, stats=None
+	):
+	'''
+	Run one ladder of replicas, all started at init_params.
+	Returns the samples of each potential (the replica's state after every round past n_burn, so rejected proposals
+	repeat the current state) and the number of attempted & accepted swaps of each neighboring pair.
+
+	potentials: potential functions, ordered from the mildest to the sharpest
+	step_size: leapfrog step, shared or one per potential (sharper potentials usually need smaller steps)
+	swap_every: rounds between swap attempts
+	stats: (optional) sampler.stats.Stats receiving evaluation counts, acceptance and swaps
+	'''
+	n_levels = len(potentials)
+	step_sizes = list(step_size) if isinstance(step_size, (list, tuple)) else [step_size] * n_levels
+	states = [tuple(x.clone().requires_grad_() for x in init_params) for _ in range(n_levels)]
+	caches = [hmc.PotentialCache(u) for u in potentials]
+	samples = [[] for _ in range(n_levels)]
+	swaps = np.zeros((max(n_levels-1, 0), 2), dtype=int) # attempted, accepted
+
+	with instrumentation.recording(stats):
+		for n in tqdm(range(n_burn + n_samples), desc='Tempering', disable=not show_progress):
+			for k in range(n_levels):
+				states[k] = _propose(states[k], caches[k], boundary, step_sizes[k], n_leapfrog, random_step)
+
+			if n % swap_every == 0:
+				for i in range((n // swap_every) % 2, n_levels-1, 2):
+					j = i+1
+					u_own = caches[i](states[i])[0] + caches[j](states[j])[0]
+					u_swapped = hmc.evaluate(potentials[i], states[j]) + hmc.evaluate(potentials[j], states[i])
+					swaps[i, 0] += 1
+					instrumentation.count('swaps')
+					if hmc.accept(u_own, u_swapped):
+						states[i], states[j] = states[j], states[i]
+						swaps[i, 1] += 1
+						instrumentation.count('swaps_accepted')
+
+			if n >= n_burn:
+				for k in range(n_levels):
+					samples[k].append(tuple(w.detach() for w in states[k]))
+
+	if stats is not None:
+		for i in range(len(swaps)):
+			stats.record('swap_acceptance', swaps[i, 1] / max(swaps[i, 0], 1))
+	return samples, swaps
+
+def worker(
+		n_samples: int, ic: tuple, potentials: Any, boundary: Any,
+		step_size: Any, n_leapfrog: int, n_burn: int, swap_every: int, random_step: bool, seed: Any
+	):
+	potentials, boundary = cloudpickle.loads(potentials), cloudpickle.loads(boundary)
+	if seed is not None:
+		set_seed(seed)
+	stats = Stats()
+	samples, swaps = ladder(
+		n_samples, ic, potentials, boundary, step_size=step_size, n_leapfrog=n_leapfrog, n_burn=n_burn, swap_every=swap_every,
+		random_step=random_step, show_progress=False, stats=stats
+	)
+	return samples, swaps, stats
+
+def sample(
+		n_samples: int, initial_conditions: list, potentials: list, boundary: Callable,
+		step_size=0.03, n_leapfrog=10, n_burn=10, swap_every=1, random_step=False, deterministic=True, stats=None
+	):
+	'''
+	One ladder per initial condition, in parallel. Returns the samples of each potential over all ladders
+	(n_samples per ladder) and the swap acceptance ratio of each neighboring pair.
+
+	stats: (optional) sampler.stats.Stats into which the stats of every ladder are merged
+	'''
+	potentials, boundary = cloudpickle.dumps(potentials), cloudpickle.dumps(boundary)
+	results = []
+	with tqdm(total=len(initial_conditions), desc='Parallel tempering') as pbar:
+		with multiprocessing.Pool() as pool:
+			for i, ic in enumerate(initial_conditions):
+				seed = 1000+i if deterministic else None
+				pool.apply_async(worker, args=(
+					n_samples, ic, potentials, boundary, step_size, n_leapfrog, n_burn, swap_every, random_step, seed
+				), callback=lambda result: (results.append(result), pbar.update(1)))
+			pool.close()
+			pool.join()
+
+	if len(results) == 0:
+		return [], np.zeros(0)
+	n_levels = len(results[0][0])
+	samples = [[s for (ladder_samples, _, _) in results for s in ladder_samples[k]] for k in range(n_levels)]
+	swaps = sum(swaps for (_, swaps, _) in results)
+	if stats is not None:
+		for (_, _, ladder_stats) in results:
+			stats.merge(ladder_stats)
+	return samples, swaps[:, 1] / np.maximum(swaps[:, 0], 1)
+
+'''
+Tests
+'''
+if __name__ == '__main__':
+	import sampler.reflections as reflections
+
+	set_seed(9001)
+
+	# Bimodal 1D target at temperatures 1/T: replicas at T = 1 alone rarely cross between the modes at +-3
+	def tempered(T: float):
+		return lambda params: -torch.logsumexp(torch.stack([-(params[0] - 3).pow(2).sum(), -(params[0] + 3).pow(2).sum()]), 0) / T
+	temperatures = [8., 4., 2., 1.]
+	potentials = [tempered(T) for T in temperatures]
+
+	stats = Stats()
+	samples, swaps = ladder(
+		2000, (torch.full((1,), 3.),), potentials, reflections.nil_boundary, step_size=[0.8, 0.6, 0.4, 0.3], n_leapfrog=5, n_burn=100,
+		show_progress=False, stats=stats
+	)
+	x = torch.stack([s[0] for s in samples[-1]]).view(-1)
+	print(f'T=1: fraction in the negative mode {(x < 0).float().mean():.3f} (expected 0.5), mean {x.mean():.3f}, swap acceptance {swaps[:, 1] / swaps[:, 0]}')
+	assert 0.3 < (x < 0).float().mean() < 0.7, 'tempered chain did not cross between modes'
+	assert abs(x.abs().mean() - 3) < 0.2
+
+	alone, _ = ladder(2000, (torch.full((1,), 3.),), potentials[-1:], reflections.nil_boundary, step_size=0.3, n_leapfrog=5, n_burn=100, show_progress=False)
+	x = torch.stack([s[0] for s in alone[0]]).view(-1)
+	print(f'Without tempering: fraction in the negative mode {(x < 0).float().mean():.3f}')
+
+	# Process pool of ladders
+	samples, ratios = sample(200, [(torch.full((1,), 3.),), (torch.full((1,), -3.),)], potentials, reflections.nil_boundary, step_size=0.3, n_leapfrog=5)
+	assert len(samples) == len(potentials) and all(len(s) == 400 for s in samples)
+	print('Pool swap acceptance:', ratios)
@@ -1,72 +1,494 @@
 '''
 Sample dynamical models around a nominal.
 '''
-from typing import Callable
+from typing import Callable, Any
 from itertools import repeat
+import os
 import torch
 
 import sampler.hmc as hmc
 import sampler.hmc_parallel as hmc_parallel
+import sampler.hmc_batched as hmc_batched
+import sampler.tempering as tempering
+import sampler.smc as smc
 import sampler.reflections as reflections
 from sampler.kernel import *
+from sampler.compiled import CompiledPotential
+from sampler.pairwise import block_distances
+from sampler.eigen import EigenParametrization
+from sampler.lowrank import LowRankParametrization
 from sampler.utils import *
 
+def direct_ics(model: torch.Tensor, n_ics: int, batch_dist: Callable, pdf: Any, feasible=None, n_bisect=30, max_doublings=10):
+	'''
+	Chain initial conditions drawn all at once: the model, followed by perturbations model + s E along random directions E,
+	where the scales s are found by batched bisection so that the distances to the model match draws from the target
+	distance distribution. Along directions which leave the constraints, s is capped at the largest feasible scale.
+
+	model: nominal parameter tensor (an operator, or its parametrization)
+	batch_dist: distances to the model of a batch of parameters (n, ...)
+	pdf: distribution of target distances
+	feasible: (optional) boolean mask of a batch of parameters which satisfy the constraints
+	'''
+	n = n_ics - 1
+	if n <= 0:
+		return [(model.detach().clone(),)]
+	with torch.no_grad():
+		model = model.detach()
+		expand = lambda s: s.view((n,) + (1,)*model.dim())
+		E = torch.randn((n,) + model.shape, device=model.device)
+		E = E * model.norm() / expand(E.reshape(n, -1).norm(dim=1))
+		target = pdf.sample((n,)).view(n)
+		inside = lambda s: (batch_dist(model + expand(s)*E) < target) & (feasible(model + expand(s)*E) if feasible is not None else True)
+
+		lo, hi = torch.zeros(n, device=model.device), torch.full((n,), 1e-3, device=model.device)
+		for _ in range(max_doublings): # bracket the target on each ray
+			grow = inside(hi)
+			if not grow.any():
+				break
+			lo, hi = torch.where(grow, hi, lo), torch.where(grow, 2*hi, hi)
+		for _ in range(n_bisect):
+			mid = (lo + hi) / 2
+			ok = inside(mid)
+			lo, hi = torch.where(ok, mid, lo), torch.where(ok, hi, mid)
+		P = model + expand(lo)*E
+	return [(model.clone(),)] + [(p,) for p in P.unbind()]
+
+def _euclidean_distance(A: torch.Tensor, B: torch.Tensor):
+	# euclidean_matrix_kernel, batched over leading dimensions
+	return torch.sqrt((1 - (A*B).sum((-1, -2)).pow(2) / ((A*A).sum((-1, -2)) * (B*B).sum((-1, -2)))).clamp(1e-8))
+
+def _target_config(
+		model: torch.Tensor, beta: Any, method: str, kernel_m: int, kernel_T: int, kernel_L: Any, use_spectral_constraint: bool, parametrization: str,
+		rank: Any, alpha: float
+	):
+	''' Settings of the target distribution which checkpoints must match to be resumed (see hmc.sample) '''
+	return dict(
+		nominal=model, beta=beta, method=method, kernel_m=kernel_m, kernel_T=kernel_T, kernel_L=kernel_L, use_spectral_constraint=use_spectral_constraint,
+		parametrization=parametrization, rank=rank, alpha=alpha
+	)
+
+def _setup(
+		max_samples: int, model: torch.Tensor, beta: float, method: str, kernel_m: int, kernel_T: int, kernel_L: float, kernel_adjoint: bool, use_spectral_constraint: bool,
+		parametrization: str, rank: Any, n_ics: int, ic_method: str, ic_step: float, ic_leapfrog: int, debug: bool, alpha: float, checkpoint_dir: Any, compile_backend: Any,
+		surrogate: Any, surrogate_T: int
+	):
+	'''
+	Distance of chain parameters to the nominal, boundary, potential, chain initial conditions, the map from chain
+	parameters to operators, the (optional) surrogate potential and the batched feasibility mask (None if unconstrained),
+	shared by `perturb`, `perturb_stream`, `perturb_ladder` and `perturb_smc`. Distances and potentials are batched over
+	leading dimensions of the chain parameters.
+	With a list of betas, the potential is a list with one potential per beta, and initial conditions follow the smallest beta.
+	'''
+	assert parametrization in ('operator', 'eigen', 'lowrank'), f'Unknown parametrization {parametrization}'
+	dev = model.device
+	n_ics = min(max_samples, n_ics)
+
+	if method == 'euclidean':
+		dist_func = _euclidean_distance
+		batch_dist = lambda P: dist_func(model, P)
+	elif method == 'kernel':
+		assert len(model.shape) == 2 and model.shape[0] == model.shape[1], "Subspace kernel valid for square matrices only"
+		K = PFKernel(dev, model.shape[0], kernel_m, kernel_T, L=kernel_L, adjoint=kernel_adjoint)
+		dist_func = lambda x, y: K(x, y, normalize=True) 
+		with torch.no_grad():
+			A_model = K.powers(model.detach().unsqueeze(0))
+			diag_model = K.self_gram(A_model)
+		def batch_dist(P: torch.Tensor):
+			A = K.powers(P)
+			return block_distances(K, A_model, A, diag_model, K.self_gram(A))[0]
+
+	if use_spectral_constraint:
+		r = spectral_radius(model).item()
+
+	feasible = None
+	if parametrization == 'operator':
+		to_operator = lambda x: x
+		reference, kernel_arg = model, to_operator
+		start = model
+		prior = lambda x: 0.
+		if use_spectral_constraint:
+			boundary = reflections.fn_boundary(SpectralRadius(), vmin=r-1e-2, vmax=r+1e-2)
+			feasible = lambda P: (torch.linalg.eigvals(P).abs().max(-1)[0] - r).abs() <= 0.99e-2 # strictly inside, for the boundary's root finding
+		else:
+			boundary = reflections.nil_boundary
+	elif parametrization == 'eigen':
+		# HMC on (eigenvectors, eigenvalues) of real block-diagonal form; the spectral constraint is a box on eigenvalue moduli
+		param = EigenParametrization(model)
+		to_operator = param.decode
+		reference, kernel_arg = model, param.decode
+		start = param.encode()
+		prior = param.gauge_prior
+		if use_spectral_constraint:
+			lower, upper = param.spectral_bounds(r-1e-2, r+1e-2)
+			boundary = reflections.rect_boundary(lower, upper)
+			feasible = lambda X: ((X >= lower.to(X.device)) & (X <= upper.to(X.device))).all(-1)
+		else:
+			boundary = reflections.nil_boundary
+		batch_dist_operator = batch_dist
+		batch_dist = lambda X: batch_dist_operator(param.decode(X))
+	elif parametrization == 'lowrank':
+		# HMC on the factors of P = U V^T around the nominal's rank-r truncation; kernel power series run on r x r cores
+		assert method == 'kernel', 'Low-rank parametrization requires the PF kernel'
+		param = LowRankParametrization(model, rank)
+		to_operator = lambda x: param.decode(x).dense()
+		reference, kernel_arg = param.nominal, param.decode
+		start = param.encode()
+		prior = param.gauge_prior
+		if use_spectral_constraint:
+			# Nonzero eigenvalues of U V^T are those of the core V^T U
+			r = torch.linalg.eigvals(param.nominal.core()).abs().max().item()
+			radius = SpectralRadius()
+			boundary = reflections.fn_boundary(lambda x: radius(param.decode(x).core()), vmin=r-1e-2, vmax=r+1e-2)
+			feasible = lambda X: (torch.linalg.eigvals(param.decode(X).core()).abs().max(-1)[0] - r).abs() <= 0.99e-2
+		else:
+			boundary = reflections.nil_boundary
+		batch_dist = lambda X: dist_func(reference, kernel_arg(X))
+	distance = lambda x: dist_func(reference, kernel_arg(x))
+
+	betas = list(beta) if isinstance(beta, (list, tuple, np.ndarray)) else None
+	make_pdf = lambda b: torch.distributions.beta.Beta(torch.Tensor([alpha]).to(dev), torch.Tensor([b]).to(dev), validate_args=False)
+	pdf = make_pdf(min(betas) if betas is not None else beta)
+
+	print('Generating initial conditions...')
+	assert ic_method in ('direct', 'hmc'), f'Unknown initial condition method {ic_method}'
+	# Direct ICs are a list of states, HMC ICs an hmc.sample checkpoint, so each method has its own file
+	ic_file = {'direct': 'ics_direct.pt', 'hmc': 'ics.pt'}[ic_method]
+	ic_checkpoint = os.path.join(checkpoint_dir, ic_file) if checkpoint_dir is not None else None
+	if checkpoint_dir is not None:
+		os.makedirs(checkpoint_dir, exist_ok=True)
+	config = _target_config(model, beta, method, kernel_m, kernel_T, kernel_L, use_spectral_constraint, parametrization, rank, alpha)
+	if ic_method == 'direct':
+		fp = fingerprint(n_ics=n_ics, **config)
+		if ic_checkpoint is not None and os.path.exists(ic_checkpoint):
+			state = load_checkpoint(ic_checkpoint)
+			check_fingerprint(ic_checkpoint, state, fp)
+			ics = state['ics']
+		else:
+			ics = direct_ics(start, n_ics, batch_dist, pdf, feasible=feasible)
+			if ic_checkpoint is not None:
+				save_checkpoint(ic_checkpoint, {'ics': ics, 'fingerprint': fp})
+		if debug:
+			with torch.no_grad():
+				print('IC distances:', batch_dist(torch.stack([x for (x,) in ics])).tolist())
+	elif ic_method == 'hmc':
+		# Sample initial conditions uniformly from constraints 
+		potential = lambda _: 0 # Uniform 
+		ics, ratio = hmc.sample(n_ics, (start,), potential, boundary, step_size=ic_step, n_leapfrog=ic_leapfrog, n_burn=0, random_step=False, return_first=True, debug=debug, checkpoint=ic_checkpoint,
+			config=config
+		)
+		if debug:
+			print('IC acceptance ratio:', ratio)
+
+	def make_potential(pdf: Any):
+		def potential(params: tuple):
+			d_k = distance(params[0]).clamp(1e-8)
+			u = -pdf.log_prob(d_k) + prior(params[0])
+			return torch.where(torch.isnan(d_k), float('inf'), u) # degenerate operators (e.g. singular eigenvector bases) are rejected
+		if compile_backend is not None:
+			potential = CompiledPotential(potential, backend=compile_backend)
+		return potential
+	potential = make_potential(pdf) if betas is None else [make_potential(make_pdf(b)) for b in betas]
+
+	# Cheap approximations of the distance for delayed acceptance (see hmc.sample)
+	surrogate_potential = None
+	if surrogate is not None:
+		assert method == 'kernel', 'Surrogate distances approximate the PF kernel'
+		assert betas is None, 'Surrogates are not supported for beta ladders'
+		if surrogate == 'short':
+			K_short = PFKernel(dev, model.shape[0], kernel_m, surrogate_T, L=kernel_L)
+			surrogate_distance = lambda x: K_short(reference, kernel_arg(x), normalize=True)
+		elif surrogate == 'euclidean':
+			# Scaled to the PF distances of the initial conditions (least squares)
+			nominal = to_operator(start).detach()
+			with torch.no_grad():
+				d_e = torch.stack([euclidean_matrix_kernel(nominal, to_operator(x)) for (x,) in ics])
+				d_k = torch.stack([distance(x).view(()) for (x,) in ics])
+			scale = (d_e*d_k).sum() / (d_e*d_e).sum()
+			surrogate_distance = lambda x: scale * euclidean_matrix_kernel(nominal, to_operator(x))
+		elif surrogate == 'quadratic':
+			# Second-order model of the squared distance around the nominal; costs one Hessian over all chain parameters
+			K_full = PFKernel(dev, model.shape[0], kernel_m, kernel_T, L=kernel_L)
+			x0 = start.detach().reshape(-1)
+			def squared_distance(x: torch.Tensor):
+				P = kernel_arg(x.view(start.shape))
+				return 1 - K_full(reference, P).pow(2) / (K_full(reference, reference) * K_full(P, P))
+			H = torch.autograd.functional.hessian(squared_distance, x0).view(x0.numel(), x0.numel())
+			surrogate_distance = lambda x: torch.sqrt((0.5 * (x.reshape(-1) - x0) @ H @ (x.reshape(-1) - x0)).clamp(1e-8))
+		else:
+			raise ValueError(f'Unknown surrogate {surrogate}')
+
+		def surrogate_potential(params: tuple):
+			d_s = surrogate_distance(params[0]).clamp(1e-8)
+			return -pdf.log_prob(d_s) + prior(params[0])
+		if compile_backend is not None:
+			surrogate_potential = CompiledPotential(surrogate_potential, backend=compile_backend)
+
+	return distance, boundary, potential, ics, to_operator, surrogate_potential, feasible
 
 def perturb(
 		max_samples: int, model: torch.Tensor, beta: float,
 		# Kernel parameters
-		method='kernel', kernel_m=2, kernel_T=80, kernel_L=0, use_spectral_constraint=False,
+		method='kernel', kernel_m=2, kernel_T=80, kernel_L=0, kernel_adjoint=False, use_spectral_constraint=False, parametrization='operator', rank=None,
 		# Initial condition settings
-		n_ics=20, ic_step=1e-5, ic_leapfrog=100, 
+		n_ics=20, ic_method='hmc', ic_step=1e-5, ic_leapfrog=100, 
 		# HMC settings
-		hmc_step=1e-5, hmc_leapfrog=100, hmc_burn=0, hmc_random_step=False, hmc_deterministic=True, 
+		hmc_step=1e-5, hmc_leapfrog=100, hmc_burn=0, hmc_random_step=False, hmc_deterministic=True, hmc_max_divergences=None,
 		# Other settings
-		debug=False, alpha=1., 
+		debug=False, alpha=1., checkpoint_dir=None, target_ess=None, compile_backend=None, stats=None, surrogate=None, surrogate_T=10,
 	):
 	'''
+	Returns (samples, posterior): the accepted operators of every chain, starting with its initial condition, and their distances
+	to the nominal. Stacks of nominals are sampled in one batched job by `perturb_many`.
+
 	max_samples: number of samples returned <= this
 	model: nominal dynamics model
 	beta: distribution spread parameter (higher = smaller variance)
+	parametrization: 'operator' samples operator entries; 'eigen' samples eigenvectors & eigenvalues in real block-diagonal form (see sampler.eigen), so the spectral constraint is a box instead of a reflection on the spectral radius; 'lowrank' samples the factors of rank-`rank` operators U V^T (see sampler.lowrank), with PF-kernel distances to the nominal's rank-`rank` truncation.
+		'eigen' & 'lowrank' change the target: the Beta density of distances (times a Gaussian gauge prior) is over their parameters, without a
+		Jacobian correction, so operators follow a different distribution than with 'operator' (e.g. 'eigen' favors nearly repeated eigenvalues, and
+		'lowrank' weights operators by the volume of factorizations near the nominal's)
+	kernel_adjoint: differentiate the PF kernel with its hand-written, bounded-memory backward (see sampler.kernel.PowerSumMinors), for long horizons & large dictionaries
+	ic_method: 'hmc' takes chain initial conditions from a serial random walk of `ic_leapfrog` steps of `ic_step`; 'direct' draws them all at once (see `direct_ics`)
+	hmc_max_divergences: (optional) consecutive divergent proposals (non-finite values or energy errors, which are rejected as soon as they occur)
+		after which a chain continues from another chain's latest state, so diverging chains still return their share of samples
+	checkpoint_dir: (optional) directory for initial conditions & per-chain checkpoints; rerunning with the same directory resumes, unless the
+		checkpoints were written with another target (nominal, beta, kernel, constraint, parametrization) or HMC settings (raises CheckpointMismatch)
+	target_ess: (optional) stop sampling once the bulk & tail ESS of the distance and of every operator entry reach this
+	compile_backend: (optional) 'inductor' or 'script' to compile the potential and its gradient (see sampler.compiled)
+	stats: (optional) sampler.stats.Stats receiving per-phase counts & timings of the chains
+	surrogate: (optional) delayed acceptance with a cheap surrogate distance driving the leapfrog dynamics, so the kernel distance is only
+		evaluated for proposals passing a first accept test: 'short' (PF kernel with horizon `surrogate_T`), 'euclidean' (scaled to the initial
+		conditions' distances) or 'quadratic' (second-order model around the nominal)
 	'''
-	dev = model.device
+	assert model.dim() == 2, 'Stacks of nominals are sampled by perturb_many'
+	distance, boundary, potential, ics, to_operator, surrogate, _ = _setup(
+		max_samples, model, beta, method, kernel_m, kernel_T, kernel_L, kernel_adjoint, use_spectral_constraint, parametrization, rank, n_ics, ic_method, ic_step, ic_leapfrog, debug, alpha, checkpoint_dir, compile_backend, surrogate, surrogate_T
+	)
+
+	# Run parallel HMC on initial conditions
+	print('Sampling models...')
+	n_subsamples = int(max_samples / len(ics))
+	diagnose = target_ess is not None or debug
+	samples = hmc_parallel.sample(
+		n_subsamples, ics, potential, boundary, step_size=hmc_step, n_leapfrog=hmc_leapfrog, n_burn=hmc_burn, random_step=hmc_random_step, return_first=True, debug=debug, checkpoint_dir=checkpoint_dir,
+		target_ess=target_ess, annotate=(lambda params: distance(params[0]).item()) if diagnose else None, return_diagnostics=diagnose, stats=stats, surrogate=surrogate,
+		max_divergences=hmc_max_divergences,
+		config=_target_config(model, beta, method, kernel_m, kernel_T, kernel_L, use_spectral_constraint, parametrization, rank, alpha)
+	)
+	if diagnose:
+		samples, diagnostics = samples
+		print('Convergence diagnostics:', diagnostics)
+	n_ret = len(samples)
+	with torch.no_grad():
+		samples = [(x, to_operator(x)) for (x,) in samples]
+	samples = [(x, s) for (x, s) in samples if not torch.isnan(s).any()]
+	if len(samples) < n_ret:
+		print(f'Warning: {n_ret - len(samples)} out of {n_ret} contain NaNs, not returned.')
+	posterior = [distance(x).item() for (x, _) in samples]
+	samples = [s for (_, s) in samples]
+
+	return samples, posterior
+
+def perturb_many(
+		max_samples: int, models: torch.Tensor, beta: float,
+		# Kernel parameters
+		method='kernel', kernel_m=2, kernel_T=80, kernel_L=0, kernel_adjoint=False, use_spectral_constraint=False,
+		# Initial condition & HMC settings
+		n_ics=20, hmc_step=1e-5, hmc_leapfrog=100, hmc_burn=0,
+		# Other settings
+		debug=False, alpha=1., stats=None,
+	):
+	'''
+	Uncertainty sets of a stack of nominal operators (S, d, d) in one batched job: the chains of all nominals advance in lockstep
+	as one (S, n_ics, d, d) tensor (see sampler.hmc_batched), so every leapfrog step is a single batched kernel evaluation, which
+	pays off for many small systems. Chains sample operator entries from direct initial conditions (see `direct_ics`), and the
+	spectral constraint rejects proposals leaving the band around each nominal's spectral radius instead of reflecting them.
+
+	Returns one (samples, posterior) per nominal. Unlike `perturb`, samples are the chains' states after every proposal past
+	burn-in (rejections repeat the current state, initial conditions are not included), n_ics * int(max_samples / n_ics) per nominal.
+
+	kernel_L: discount, or one discount per nominal
+	See `perturb` for the other arguments.
+	'''
+	assert models.dim() == 3, 'perturb_many samples a stack of nominals (S, d, d)'
+	models = models.detach()
+	S, d, dev = models.shape[0], models.shape[-1], models.device
 	n_ics = min(max_samples, n_ics)
 
 	if method == 'euclidean':
-		dist_func = euclidean_matrix_kernel
+		dist_func = _euclidean_distance
+		scale = torch.ones(S, device=dev)
 	elif method == 'kernel':
-		assert len(model.shape) == 2 and model.shape[0] == model.shape[1], "Subspace kernel valid for square matrices only"
-		K = PFKernel(dev, model.shape[0], kernel_m, kernel_T, L=kernel_L)
-		dist_func = lambda x, y: K(x, y, normalize=True) 
+		# Discounting each power by e^(-L) is the undiscounted series of the operators scaled by e^(-L/2), so nominals with
+		# different discounts share one kernel
+		K = PFKernel(dev, d, kernel_m, kernel_T, adjoint=kernel_adjoint)
+		dist_func = lambda x, y: K(x, y, normalize=True)
+		scale = torch.exp(-0.5*torch.as_tensor(kernel_L, dtype=models.dtype, device=dev)).expand(S)
+	expand = lambda v: v.view(S, 1, 1, 1)
+	distance = lambda X: dist_func(expand(scale)*models[:, None], expand(scale)*X) # X: (S, n, d, d) -> (S, n)
 
+	feasible, feasible_of = None, lambda i: None
 	if use_spectral_constraint:
-		r = spectral_radius(nominal).item()
-		boundary = reflections.fn_boundary(spectral_radius, vmin=r-1e-2, vmax=r+1e-2)
-	else:
-		boundary = reflections.nil_boundary
-		
-	# Sample initial conditions uniformly from constraints 
+		r = torch.linalg.eigvals(models).abs().max(-1)[0]
+		radius = lambda X: torch.linalg.eigvals(torch.nan_to_num(X)).abs().max(-1)[0] # diverged chains are rejected by their energy
+		feasible = lambda X: (radius(X) - r[:, None]).abs() <= 1e-2
+		feasible_of = lambda i: lambda P: (radius(P) - r[i]).abs() <= 1e-2
+
+	pdf = torch.distributions.beta.Beta(torch.Tensor([alpha]).to(dev), torch.Tensor([beta]).to(dev), validate_args=False)
+	def potential(X: torch.Tensor):
+		d_k = distance(X).clamp(1e-8)
+		return torch.where(torch.isnan(d_k), float('inf'), -pdf.log_prob(d_k))
+
 	print('Generating initial conditions...')
-	potential = lambda _: 0 # Uniform 
-	ics, ratio = hmc.sample(n_ics, (model,), potential, boundary, step_size=ic_step, n_leapfrog=ic_leapfrog, n_burn=0, random_step=False, return_first=True, debug=debug)
+	ics = []
+	for i in range(S):
+		batch_dist = lambda P: dist_func(scale[i]*models[i], scale[i]*P)
+		ics.append(torch.stack([x for (x,) in direct_ics(models[i], n_ics, batch_dist, pdf, feasible=feasible_of(i))]))
+	ics = torch.stack(ics)
+
+	print('Sampling models...')
+	n_subsamples = int(max_samples / n_ics)
+	X, ratio = hmc_batched.sample(
+		n_subsamples, ics, potential, step_size=hmc_step, n_leapfrog=hmc_leapfrog, n_burn=hmc_burn, feasible=feasible, batch_dims=2, stats=stats
+	)
 	if debug:
-		print('IC acceptance ratio:', ratio)
+		print('Acceptance ratio per nominal:', ratio.mean(1).tolist())
+
+	X = X.transpose(0, 1).reshape(S, -1, d, d)
+	with torch.no_grad():
+		posterior = distance(X)
+	results = []
+	for i in range(S):
+		keep = ~torch.isnan(X[i]).any(-1).any(-1)
+		if not keep.all():
+			print(f'Warning: {(~keep).sum().item()} out of {len(keep)} samples of nominal {i} contain NaNs, not returned.')
+		results.append((list(X[i][keep].unbind()), posterior[i][keep].tolist()))
+	return results
+
+def perturb_stream(
+		max_samples: int, model: torch.Tensor, beta: float,
+		# Kernel parameters
+		method='kernel', kernel_m=2, kernel_T=80, kernel_L=0, kernel_adjoint=False, use_spectral_constraint=False, parametrization='operator', rank=None,
+		# Initial condition settings
+		n_ics=20, ic_method='hmc', ic_step=1e-5, ic_leapfrog=100, 
+		# HMC settings
+		hmc_step=1e-5, hmc_leapfrog=100, hmc_burn=0, hmc_random_step=False, hmc_deterministic=True, hmc_max_divergences=None,
+		# Other settings
+		debug=False, alpha=1., checkpoint_dir=None, max_queue=1000, compile_backend=None, stats=None, surrogate=None, surrogate_T=10,
+	):
+	'''
+	Generator variant of `perturb` which yields (sample, distance, chain index) as soon as any chain accepts a proposal.
+	Distances are computed in the workers; at most `max_queue` samples are buffered in the parent.
+	'''
+	distance, boundary, potential, ics, to_operator, surrogate, _ = _setup(
+		max_samples, model, beta, method, kernel_m, kernel_T, kernel_L, kernel_adjoint, use_spectral_constraint, parametrization, rank, n_ics, ic_method, ic_step, ic_leapfrog, debug, alpha, checkpoint_dir, compile_backend, surrogate, surrogate_T
+	)
+	annotate = lambda params: distance(params[0]).item()
 
-	# Run parallel HMC on initial conditions
 	print('Sampling models...')
-	pdf = torch.distributions.beta.Beta(torch.Tensor([alpha]).to(dev), torch.Tensor([beta]).to(dev))
-	def potential(params: tuple):
-		d_k = dist_func(model, params[0]).clamp(1e-8)
-		return -pdf.log_prob(d_k)
+	n_subsamples = int(max_samples / len(ics))
+	n_nan = 0
+	for i, (s,), d_k in hmc_parallel.stream(
+			n_subsamples, ics, potential, boundary, annotate=annotate, max_queue=max_queue, step_size=hmc_step, n_leapfrog=hmc_leapfrog, n_burn=hmc_burn, 
+			random_step=hmc_random_step, return_first=True, debug=debug, checkpoint_dir=checkpoint_dir, stats=stats, surrogate=surrogate,
+			max_divergences=hmc_max_divergences,
+			config=_target_config(model, beta, method, kernel_m, kernel_T, kernel_L, use_spectral_constraint, parametrization, rank, alpha)
+		):
+		with torch.no_grad():
+			s = to_operator(s)
+		if torch.isnan(s).any():
+			n_nan += 1
+			continue
+		yield s, d_k, i
+	if n_nan > 0:
+		print(f'Warning: {n_nan} samples contain NaNs, not returned.')
 
-	n_subsamples = int(max_samples / n_ics)
-	samples = hmc_parallel.sample(n_subsamples, ics, potential, boundary, step_size=hmc_step, n_leapfrog=hmc_leapfrog, n_burn=hmc_burn, random_step=hmc_random_step, return_first=True, debug=debug)
-	n_ret = len(samples)
-	samples = [s for (s,) in samples if not torch.isnan(s).any()]
-	if len(samples) < n_ret:
-		print(f'Warning: {n_ret - len(samples)} out of {n_ret} contain NaNs, not returned.')
-	posterior = [dist_func(model, s).item() for s in samples]
+def perturb_ladder(
+		max_samples: int, model: torch.Tensor, betas: list,
+		# Kernel parameters
+		method='kernel', kernel_m=2, kernel_T=80, kernel_L=0, kernel_adjoint=False, use_spectral_constraint=False, parametrization='operator', rank=None,
+		# Initial condition settings
+		n_ics=20, ic_method='hmc', ic_step=1e-5, ic_leapfrog=100, 
+		# HMC settings
+		hmc_step=1e-5, hmc_leapfrog=100, hmc_burn=0, hmc_random_step=False, swap_every=1,
+		# Other settings
+		debug=False, alpha=1., checkpoint_dir=None, compile_backend=None, stats=None,
+	):
+	'''
+	`perturb` for every beta in `betas` in one run, by parallel tempering (see sampler.tempering): each initial condition starts a
+	ladder of chains, one per beta, which periodically swap states with their neighbors, so sharp (high beta) chains mix through
+	the broader ones. Returns a list of (samples, posterior) per beta, in the order of `betas`.
 
-	return samples, posterior
+	hmc_step: leapfrog step, shared or one per beta
+	swap_every: HMC proposals between swap attempts
+	'''
+	order = np.argsort(betas) # ladder from the broadest distribution to the sharpest
+	steps = [hmc_step[i] for i in order] if isinstance(hmc_step, (list, tuple, np.ndarray)) else hmc_step
+	distance, boundary, potentials, ics, to_operator, _, _ = _setup(
+		max_samples, model, [betas[i] for i in order], method, kernel_m, kernel_T, kernel_L, kernel_adjoint, use_spectral_constraint, parametrization, rank,
+		n_ics, ic_method, ic_step, ic_leapfrog, debug, alpha, checkpoint_dir, compile_backend, None, None
+	)
+
+	print('Sampling models...')
+	n_subsamples = int(max_samples / len(ics))
+	samples, swap_ratios = tempering.sample(
+		n_subsamples, ics, potentials, boundary, step_size=steps, n_leapfrog=hmc_leapfrog, n_burn=hmc_burn, swap_every=swap_every,
+		random_step=hmc_random_step, stats=stats
+	)
+	if debug:
+		print('Swap acceptance between neighboring betas:', swap_ratios)
+
+	results = [None] * len(betas)
+	for k, i in enumerate(order):
+		with torch.no_grad():
+			level = [(x, to_operator(x)) for (x,) in samples[k]]
+			level = [(x, s) for (x, s) in level if not torch.isnan(s).any()]
+			results[i] = ([s for (_, s) in level], [distance(x).item() for (x, _) in level])
+	return results
+
+def perturb_smc(
+		n_particles: int, model: torch.Tensor, beta: float,
+		# Kernel parameters
+		method='kernel', kernel_m=2, kernel_T=80, kernel_L=0, kernel_adjoint=False, use_spectral_constraint=False, parametrization='operator', rank=None,
+		# SMC settings
+		smc_reference=1e-2, smc_target_ess=0.5, smc_moves=5, hmc_step=1e-3, hmc_leapfrog=10,
+		# Other settings
+		debug=False, alpha=1., compile_backend=None, stats=None,
+	):
+	'''
+	Uncertainty set by sequential Monte Carlo (see sampler.smc) instead of parallel HMC chains: a population of `n_particles`
+	operators drawn around the nominal is annealed to the target by adaptive tempering, with batched kernel evaluations,
+	resampling and `smc_moves` batched HMC steps per stage. Constraints are enforced by rejecting infeasible moves.
+	Returns (samples, posterior, weights, log_evidence), where weights are the particles' normalized importance weights and
+	log_evidence estimates the log normalizing constant of the target density (only meaningful when it is proper, e.g. under the
+	spectral constraint, since kernel distances are invariant to scaling the operator).
+
+	smc_reference: standard deviation of the Gaussian reference around the nominal (in chain parameters)
+	smc_target_ess: fraction of the population kept as ESS by each tempering increment
+	hmc_step: initial leapfrog step, adapted between stages
+	'''
+	distance, _, potential, ics, to_operator, _, feasible = _setup(
+		n_particles, model, beta, method, kernel_m, kernel_T, kernel_L, kernel_adjoint, use_spectral_constraint, parametrization, rank,
+		1, 'direct', None, None, debug, alpha, None, compile_backend, None, None
+	)
+	(start,) = ics[0] # the nominal's chain parameters
+
+	print('Sampling models...')
+	X, weights, log_evidence = smc.sample(
+		n_particles, start, lambda X: potential((X,)), smc_reference, feasible=feasible, target_ess=smc_target_ess, n_moves=smc_moves,
+		step_size=hmc_step, n_leapfrog=hmc_leapfrog, stats=stats
+	)
+	if debug:
+		print('Log evidence:', log_evidence, 'ESS:', 1. / (weights**2).sum().item())
+
+	with torch.no_grad():
+		posterior = distance(X)
+		samples = to_operator(X)
+	keep = ~torch.isnan(samples.reshape(n_particles, -1)).any(1)
+	if not keep.all():
+		print(f'Warning: {(~keep).sum().item()} out of {n_particles} contain NaNs, not returned.')
+	return list(samples[keep].unbind()), posterior[keep].tolist(), weights[keep] / weights[keep].sum(), log_evidence
 
 # if __name__ == '__main__':
 	# import matplotlib.pyplot as plt
@@ -1,5 +1,9 @@
-from typing import Callable
+from typing import Callable, Any
 from collections import OrderedDict
+import os
+import pickle
+import hashlib
+import warnings
 import numpy as np
 import random
 import torch
@@ -15,27 +19,194 @@ def set_seed(seed=None):
 	else:
 		torch.manual_seed(seed)
 
+def get_rng_state():
+	return {'random': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+
+def set_rng_state(state: dict):
+	random.setstate(state['random'])
+	np.random.set_state(state['numpy'])
+	torch.set_rng_state(state['torch'])
+
+def save_checkpoint(path: str, state: dict):
+	''' Atomically write a checkpoint, so a preempted write never corrupts the previous one '''
+	tmp = path + '.tmp'
+	torch.save(state, tmp)
+	os.replace(tmp, path)
+
+def load_checkpoint(path: str):
+	return torch.load(path, weights_only=False)
+
+class CheckpointMismatch(Exception):
+	''' A checkpoint was written with other settings than those it is resumed with '''
+
+def fingerprint(**config):
+	'''
+	Hash of settings (numbers, strings, tensors, ...), stored in checkpoints so that runs with other settings refuse to resume them.
+	'''
+	h = hashlib.sha1()
+	for key in sorted(config):
+		value = config[key]
+		if torch.is_tensor(value):
+			value = value.detach().cpu().numpy()
+		if isinstance(value, np.ndarray):
+			value = (value.dtype.str, value.shape, value.tobytes())
+		h.update(repr((key, value)).encode())
+	return h.hexdigest()
+
+def check_fingerprint(path: str, state: dict, expected: str):
+	''' Raises CheckpointMismatch if the checkpoint state at path was written with other settings '''
+	if state.get('fingerprint') is None:
+		warnings.warn(f'Checkpoint {path} has no settings fingerprint; resuming without checking its settings')
+	elif state['fingerprint'] != expected:
+		raise CheckpointMismatch(f'Checkpoint {path} was written with other settings; delete it or use another checkpoint directory')
+
+def append_records(path: str, records: list):
+	''' Appends a chunk of records (e.g. new samples) to a file, so checkpoints only write what is new '''
+	with open(path, 'ab') as f:
+		pickle.dump(records, f)
+		f.flush()
+		os.fsync(f.fileno())
+
+def load_records(path: str, n: int):
+	'''
+	First n records appended to path. Records past n (appended after the checkpoint which counted n) are dropped from the file.
+	'''
+	records, end = [], 0
+	if n > 0:
+		with open(path, 'rb') as f:
+			while len(records) < n:
+				records.extend(pickle.load(f))
+				end = f.tell()
+	if len(records) > n or (os.path.exists(path) and os.path.getsize(path) > end):
+		# Rewrite the file to exactly the counted records
+		records = records[:n]
+		tmp = path + '.tmp'
+		with open(tmp, 'wb') as f:
+			pickle.dump(records, f)
+		os.replace(tmp, path)
+	return records
+
 def zip_with(X: tuple, Y: tuple, f: Callable):
 	return tuple(f(x,y) for (x,y) in zip(X, Y))
 
+class Divergence(Exception):
+	'''
+	An HMC trajectory reached non-finite positions, potentials or gradients, exceeded the maximum energy error, or could not
+	resolve its reflections. The proposal is abandoned and counts as a rejection (see sampler.hmc.leapfrog).
+	'''
+
 def spectral_radius(A: torch.Tensor, eps=None, n_iter=None):
-	if A.shape[0] == A.shape[1] == 2: # compute directly for 2x2
-		tr, det = A.trace(), A.det()
-		if (tr**2 - 4*det) >= 0:
-			return torch.max(
-				torch.abs(tr + torch.sqrt(tr**2 - 4*det)) / 2,
-				torch.abs(tr - torch.sqrt(tr**2 - 4*det)) / 2
-			)
-		else:
-			return torch.sqrt((tr/2)**2 + (4*det-tr**2)/4)
+	if A.shape[-2:] == (2, 2): # compute directly for (batches of) 2x2
+		tr, det = A.diagonal(dim1=-2, dim2=-1).sum(-1), torch.linalg.det(A)
+		disc = tr**2 - 4*det
+		# Both branches are evaluated, so each takes a safe argument where it is not selected (keeps gradients finite)
+		sq = torch.sqrt(torch.where(disc > 0, disc, torch.ones_like(disc))) * (disc > 0)
+		real = torch.max(torch.abs(tr + sq), torch.abs(tr - sq)) / 2
+		cplx = torch.sqrt(torch.where(disc < 0, det, torch.ones_like(det))) # complex pair: |lambda|^2 = det
+		return torch.where(disc >= 0, real, cplx)
 	elif eps is None and n_iter is None:
-		# return _sp_radius_conv(A, 1e-4)
-		return _sp_radius_niter(A, 1000)
+		return SpectralRadius()(A)
 	elif eps is not None:
 		return _sp_radius_conv(A, eps)
 	elif n_iter is not None:
 		return _sp_radius_niter(A, n_iter)
 
+def _ritz_pairs(A: torch.Tensor, Q: torch.Tensor):
+	''' Eigenvalues & eigenvectors of the projection Q^T A Q, batched '''
+	lam, Y = torch.linalg.eig(Q.transpose(-1, -2)@A@Q)
+	return lam, Q.to(Y.dtype)@Y # eigenvectors in columns
+
+def _dominant_eig(A: torch.Tensor, Q: torch.Tensor, tol: float, max_iter: int, target=None):
+	'''
+	Dominant eigenpair of A (..., d, d) by subspace iteration starting from the orthonormal basis Q (..., d, p).
+	With p >= 2 this captures complex-conjugate dominant pairs, which plain power iteration cannot.
+	If `target` eigenvalues are given, the Ritz pair closest to them is returned instead of the dominant one.
+	'''
+	scale = A.abs().amax(dim=(-1, -2)).clamp(1e-12)
+	Ac = A.to(torch.complex64 if A.dtype == torch.float32 else torch.complex128)
+	for i in range(max_iter):
+		Q, _ = torch.linalg.qr(A@Q)
+		lam, V = _ritz_pairs(A, Q)
+		if target is None:
+			j = lam.abs().argmax(-1, keepdim=True)
+		else:
+			j = (lam - target.unsqueeze(-1)).abs().argmin(-1, keepdim=True)
+		lam = lam.gather(-1, j).squeeze(-1)
+		v = V.gather(-1, j.unsqueeze(-2).expand(V.shape[:-1] + (1,))).squeeze(-1)
+		v = v / v.norm(dim=-1, keepdim=True)
+		residual = ((Ac@v.unsqueeze(-1)).squeeze(-1) - lam.unsqueeze(-1)*v).norm(dim=-1)
+		converged = residual <= tol*scale
+		if converged.all():
+			break
+	return Q, lam, v, converged
+
+class _SpectralRadiusGrad(torch.autograd.Function):
+	'''
+	Returns the precomputed radius; the left eigenvector is only solved for in the backward pass, so value-only
+	evaluations (e.g. root-finding probes in sampler.reflections) cost a single subspace iteration.
+	'''
+	@staticmethod
+	def forward(ctx, A: torch.Tensor, radius: torch.Tensor, lam: torch.Tensor, v: torch.Tensor, solver: Any):
+		ctx.solver = solver
+		ctx.save_for_backward(A, lam, v)
+		return radius
+
+	@staticmethod
+	def backward(ctx, g: torch.Tensor):
+		A, lam, v = ctx.saved_tensors
+		solver = ctx.solver
+		with torch.no_grad():
+			# Left eigenvector u (u^T A = lambda u^T) for the same eigenvalue
+			At = A.transpose(-1, -2)
+			solver.left, _, u, converged = _dominant_eig(At, solver._init(At, solver.left), solver.tol, solver.max_iter, target=lam)
+			solver._check(converged, 'left')
+			c = lam.conj() / (lam.abs().clamp(1e-12) * (u*v).sum(-1))
+			grad = (c[..., None, None] * u.unsqueeze(-1) * v.unsqueeze(-2)).real.to(A.dtype)
+		return g[..., None, None]*grad, None, None, None, None
+
+class SpectralRadius:
+	def __init__(self, tol=1e-5, max_iter=1000, subspace=4):
+		'''
+		Spectral radius of (batches of) square matrices by subspace iteration, warm-started from the
+		dominant subspaces found by the previous call (e.g. the previous position of a chain).
+		The gradient d|lambda|/dA = Re(conj(lambda) u v^T / (|lambda| u^T v)) comes from the right (v) and
+		left (u) dominant eigenvectors instead of autograd through the iteration; the left one is only computed in backward.
+		Calls which reach max_iter before tol warn, and `converged` holds the per-matrix convergence of the last call.
+
+		tol: relative eigen-residual at which iteration stops
+		max_iter: iteration limit per call
+		subspace: iterated subspace dimension; larger converges faster when several eigenvalues have similar moduli
+		'''
+		self.tol = tol
+		self.max_iter = max_iter
+		self.subspace = subspace
+		self.right = None
+		self.left = None
+		self.converged = None # per-matrix convergence of the last call
+
+	def _init(self, A: torch.Tensor, Q: Any):
+		p = min(self.subspace, A.shape[-1])
+		if Q is not None and Q.shape == A.shape[:-1] + (p,) and Q.device == A.device and Q.dtype == A.dtype:
+			return Q
+		Q = torch.ones(A.shape[:-1] + (p,), device=A.device, dtype=A.dtype)
+		Q = Q * torch.cos(torch.arange(A.shape[-1], device=A.device, dtype=A.dtype).unsqueeze(-1) * torch.arange(p, device=A.device, dtype=A.dtype))
+		return torch.linalg.qr(Q)[0]
+
+	def _check(self, converged: torch.Tensor, which: str):
+		if not converged.all():
+			warnings.warn(f'Subspace iteration for the {which} dominant eigenvector did not converge in {self.max_iter} iterations '
+				f'for {(~converged).sum().item()} of {converged.numel()} matrices')
+
+	def __call__(self, A: torch.Tensor):
+		with torch.no_grad():
+			A_ = A.detach()
+			self.right, lam, v, self.converged = _dominant_eig(A_, self._init(A_, self.right), self.tol, self.max_iter)
+			self._check(self.converged, 'right')
+			radius = lam.abs().to(A.dtype)
+		if not A.requires_grad:
+			return radius
+		return _SpectralRadiusGrad.apply(A, radius, lam, v, self)
+
 def _sp_radius_conv(A: torch.Tensor, eps: float):
 	v = torch.ones((A.shape[0], 1), device=A.device)
 	v_new = v.clone()
@@ -160,6 +331,40 @@ if __name__ == '__main__':
 		print('True:', e, 'numpy:', np_e_max, 'pwr_iter:', pwr_e_max)
 		assert np.abs(e - pwr_e_max) < prec
 
+	# Nd subspace iteration test (warm-started, with gradient)
+	sr = SpectralRadius()
+	for _ in range(100):
+		d = 20
+		A = torch.randn((d, d), device=device) / np.sqrt(d)
+		A = A.requires_grad_()
+		r = sr(A)
+		(dA,) = torch.autograd.grad(r, A)
+		A_ = A.detach().double().requires_grad_()
+		r_ = torch.linalg.eigvals(A_).abs().max()
+		(dA_,) = torch.autograd.grad(r_, A_)
+		assert np.abs(r.item() - r_.item()) < prec
+		assert (dA.double() - dA_).abs().max().item() < prec
+	print('Subspace iteration matches eigvals')
+
+	# Value-only calls skip the left eigenvector; non-convergence warns
+	sr = SpectralRadius()
+	r = sr(torch.randn((d, d), device=device).requires_grad_())
+	assert sr.left is None and sr.converged.all()
+	r.backward()
+	assert sr.left is not None
+	with warnings.catch_warnings(record=True) as caught:
+		warnings.simplefilter('always')
+		SpectralRadius(max_iter=1)(torch.randn((d, d), device=device))
+	assert len(caught) == 1, 'missing non-convergence warning'
+
+	# Batched 2x2 closed form, with real & complex eigenvalues
+	A = torch.randn((1000, 2, 2), device=device, requires_grad=True)
+	r = spectral_radius(A)
+	(dA,) = torch.autograd.grad(r.sum(), A)
+	assert r.shape == (1000,) and torch.allclose(r, torch.linalg.eigvals(A).abs().max(-1)[0], atol=1e-4)
+	assert torch.isfinite(dA).all()
+	print('Batched 2x2 spectral radius matches eigvals')
+
 	# # Nd Power iteration test
 	# for _ in range(1000):
 	# 	d = 100
@@ -3,6 +3,20 @@ echo "Running tests"
 set -e
 python -m sampler.utils
 python -m sampler.kernel
+python -m sampler.compiled
+python -m sampler.rollout
+python -m sampler.pairwise
+python -m sampler.scenarios
+python -m sampler.index
+python -m sampler.store
+python -m sampler.reweight
+python -m sampler.diagnostics
+python -m sampler.stats
+python -m sampler.eigen
+python -m sampler.lowrank
 python -m sampler.hmc
 python -m sampler.hmc_parallel
+python -m sampler.hmc_batched
+python -m sampler.tempering
+python -m sampler.smc
 python -m sampler.ugen
\ No newline at end of file